@@ -0,0 +1,351 @@
+"""
+端到端的吞吐量和延遲測試：本機的假交易所 -> BinanceWebSocket / KrakenWebSocket -> Redis
+
+假交易所和 Redis（預設為 benchmarks.fake_redis 的替身，也可以用 --redis-url 指定真的 Redis）
+在另一個 process 執行，服務本身的 CPU 和 RSS 不會被它們影響。
+延遲為假交易所送出成交到 Redis 收到 PUBLISH 的時間。
+
+情境：
+- steady: 固定速率
+- burst: 每 2 秒有 0.25 秒以 burst_factor 倍速率送出，模擬連環清算
+- subscribe_storm: 每個交易對各送一個訂閱指令，量測全部開始收到資料所需的時間
+- reconnect: 跑到一半時交易所斷掉所有連線，量測恢復時間和資料中斷的最長間隔
+
+結果以 JSON 輸出，可以存下來比較不同版本：
+    python -m benchmarks.bench_e2e --symbols 100 --rate 20000 --duration 5 --output e2e.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import multiprocessing
+
+from typing import Dict, List, Optional
+
+from redis.asyncio import Redis
+
+from benchmarks.fake_exchange import FAKE_EXCHANGES
+from benchmarks.fake_redis import FakeRedis
+from shared.core.codec import get_codec
+
+SERVICES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "services")
+SCENARIOS = ("steady", "burst", "subscribe_storm", "reconnect")
+
+
+def monotonic_us() -> int:
+    return time.monotonic_ns() // 1000
+
+
+class Recorder:
+    """記錄 Redis 收到的每一筆成交：延遲、到達間隔、每個 topic 第一次出現的時間"""
+    def __init__(self):
+        self.loads = get_codec().loads
+        self.reset()
+
+    def reset(self) -> None:
+        self.latencies_us: List[int] = []
+        self.first_seen: Dict[bytes, int] = {}
+        self.max_gap_us = 0
+        self.last_at = 0
+        self.marked_at = 0
+        self.recovered: Dict[bytes, int] = {}
+
+    def mark(self) -> None:
+        """開始記錄每個 topic 在這之後送出的成交第一次出現的時間，斷線前已送出的不算"""
+        self.marked_at = monotonic_us()
+        self.recovered = {}
+
+    def observe(self, channel: bytes, payload: bytes) -> None:
+        if b"TradeId" not in payload and b"tradeId" not in payload:
+            return
+        now = monotonic_us()
+        data = self.loads(payload)
+        trade_id = data.get("aggTradeId") or data.get("tradeId")
+        if trade_id is None:
+            return
+        self.latencies_us.append(now - trade_id)
+        if self.last_at:
+            self.max_gap_us = max(self.max_gap_us, now - self.last_at)
+        self.last_at = now
+        if channel not in self.first_seen:
+            self.first_seen[channel] = now
+        if self.marked_at and trade_id > self.marked_at and channel not in self.recovered:
+            self.recovered[channel] = now
+
+    def stats(self) -> dict:
+        ordered = sorted(self.latencies_us)
+        count = len(ordered)
+
+        def quantile(q: float) -> Optional[float]:
+            return ordered[min(count - 1, int(count * q))] / 1000 if count else None
+
+        return {
+            "received": count,
+            "latency_p50_ms": quantile(0.5),
+            "latency_p99_ms": quantile(0.99),
+            "latency_p999_ms": quantile(0.999),
+            "latency_max_ms": ordered[-1] / 1000 if count else None,
+            "max_gap_ms": self.max_gap_us / 1000,
+            "topics_seen": len(self.first_seen),
+            "last_first_seen_us": max(self.first_seen.values()) if self.first_seen else None,
+            "recovered_topics": len(self.recovered),
+            "recovery_ms": (max(self.recovered.values()) - self.marked_at) / 1000 if self.recovered else None,
+        }
+
+
+def helper_main(conn, exchange: str, redis_url: Optional[str]) -> None:
+    """在另一個 process 執行假交易所和 Redis（或 Redis 的消費者），透過 pipe 接收指令"""
+    async def main():
+        recorder = Recorder()
+        fake_exchange = FAKE_EXCHANGES[exchange]()
+        exchange_port = await fake_exchange.start()
+
+        fake_redis = None
+        consumer = None
+        if redis_url is None:
+            fake_redis = FakeRedis(on_publish=recorder.observe)
+            redis_port = await fake_redis.start()
+        else:
+            redis_port = None
+            consumer = asyncio.create_task(consume(redis_url, exchange, recorder))
+        conn.send(("ready", exchange_port, redis_port))
+
+        loop = asyncio.get_running_loop()
+        while True:
+            command, *params = await loop.run_in_executor(None, conn.recv)
+            if command == "reset":
+                recorder.reset()
+                fake_exchange.sent = 0
+                conn.send(None)
+            elif command == "traffic":
+                fake_exchange.start_traffic(*params)
+                conn.send(None)
+            elif command == "stop_traffic":
+                await fake_exchange.stop_traffic()
+                conn.send(None)
+            elif command == "drop":
+                recorder.mark()
+                conn.send(await fake_exchange.drop_connections())
+            elif command == "stats":
+                stats = recorder.stats()
+                stats["sent"] = fake_exchange.sent
+                stats["exchange_connections_total"] = fake_exchange.connections_total
+                conn.send(stats)
+            elif command == "exit":
+                break
+
+        if consumer:
+            consumer.cancel()
+        await fake_exchange.close()
+        if fake_redis:
+            await fake_redis.close()
+
+    asyncio.run(main())
+
+
+async def consume(redis_url: str, exchange: str, recorder: Recorder) -> None:
+    """使用真的 Redis 時，用 PSUBSCRIBE 收下所有市場數據"""
+    redis = Redis.from_url(redis_url, decode_responses=False)
+    pubsub = redis.pubsub()
+    await pubsub.psubscribe(f"{exchange}:*")
+    async for message in pubsub.listen():
+        if message["type"] == "pmessage":
+            recorder.observe(message["channel"], message["data"])
+
+
+class Helper:
+    """主 process 這一端的 helper 控制介面"""
+    def __init__(self, exchange: str, redis_url: Optional[str]):
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=helper_main, args=(child_conn, exchange, redis_url), daemon=True)
+        self.process.start()
+        _, self.exchange_port, self.redis_port = self.conn.recv()
+
+    async def call(self, command: str, *params):
+        self.conn.send((command, *params))
+        return await asyncio.get_running_loop().run_in_executor(None, self.conn.recv)
+
+    def close(self) -> None:
+        self.conn.send(("exit",))
+        self.process.join(10)
+
+
+def make_service(exchange: str, exchange_port: int, redis_url: str, combined: bool = False):
+    """建立連到本機假交易所的服務，類別名稱維持不變，exchange_name 才會一樣"""
+    sys.path.insert(0, os.path.join(SERVICES_DIR, exchange, "src"))
+    if exchange == "binance":
+        from binance_ws import BinanceWebSocket as service_cls
+        path = "/ws"
+    else:
+        from kraken_ws import KrakenWebSocket as service_cls
+        path = "/v2"
+
+    def _get_base_url(self, market_type="spot"):
+        return f"ws://127.0.0.1:{exchange_port}{path}"
+
+    local_cls = type(service_cls.__name__, (service_cls,), {"_get_base_url": _get_base_url})
+    host, port_db = redis_url.split("//", 1)[1].split(":", 1)
+    port, db = port_db.split("/", 1)
+    kwargs = {"combined_streams": True} if combined and exchange == "binance" else {}
+    return local_cls(redis_host=host, redis_port=int(port), redis_db=int(db), metrics_redis_interval=0, **kwargs)
+
+
+def get_symbols(exchange: str, count: int) -> List[str]:
+    if exchange == "binance":
+        return [f"sym{i}usdt" for i in range(count)]
+    return [f"S{i}/USD" for i in range(count)]
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run_scenario(exchange: str, scenario: str, args) -> dict:
+    helper = Helper(exchange, args.redis_url)
+    redis_url = args.redis_url or f"redis://127.0.0.1:{helper.redis_port}/0"
+    service = make_service(exchange, helper.exchange_port, redis_url, args.combined)
+    service_task = asyncio.create_task(service.start())
+    while not hasattr(service, "publisher") or not service.publisher.running:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.2)
+
+    control = Redis.from_url(redis_url, decode_responses=False)
+    channel = f"{exchange}:control"
+    stream_type = "aggTrade" if exchange == "binance" else "trade"
+    symbols = get_symbols(exchange, args.symbols)
+
+    def command(symbols: List[str]) -> bytes:
+        return json.dumps({
+            "action": "subscribe", "symbols": symbols, "streamType": stream_type, "marketType": "spot",
+        }).encode()
+
+    result: Dict[str, object] = {}
+    try:
+        if scenario == "subscribe_storm":
+            await helper.call("traffic", args.rate)
+            await helper.call("reset")
+            cpu_started, started = cpu_seconds(), time.perf_counter()
+            storm_started_us = monotonic_us()
+            for symbol in symbols:
+                await control.publish(channel, command([symbol]))
+            deadline = time.monotonic() + args.duration * 4
+            stats = await helper.call("stats")
+            while stats["topics_seen"] < len(symbols) and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+                stats = await helper.call("stats")
+            result["storm_commands"] = len(symbols)
+            result["storm_complete_ms"] = (
+                (stats["last_first_seen_us"] - storm_started_us) / 1000
+                if stats["topics_seen"] >= len(symbols) else None
+            )
+        else:
+            await control.publish(channel, command(symbols))
+            burst_factor = args.burst_factor if scenario == "burst" else 1.0
+            await helper.call("traffic", args.rate, burst_factor)
+            await asyncio.sleep(args.warmup)
+            await helper.call("reset")
+            cpu_started, started = cpu_seconds(), time.perf_counter()
+            if scenario == "reconnect":
+                await asyncio.sleep(args.duration / 2)
+                result["dropped_connections"] = await helper.call("drop")
+                await asyncio.sleep(args.duration / 2)
+            else:
+                await asyncio.sleep(args.duration)
+            stats = await helper.call("stats")
+
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds() - cpu_started
+        await helper.call("stop_traffic")
+        received = stats["received"]
+        result.update({
+            "messages_per_sec": received / elapsed,
+            "cpu_us_per_message": cpu / received * 1_000_000 if received else None,
+            "cpu_utilization": cpu / elapsed,
+            "rss_mb": rss_mb(),
+            "loss": max(stats["sent"] - received, 0),
+            **{key: value for key, value in stats.items() if key != "last_first_seen_us"},
+        })
+        if scenario != "reconnect":
+            for key in ("recovered_topics", "recovery_ms"):
+                result.pop(key, None)
+    finally:
+        service_task.cancel()
+        await asyncio.gather(service_task, return_exceptions=True)
+        await control.close()
+        helper.close()
+    return result
+
+
+def get_git_revision() -> Optional[str]:
+    try:
+        import subprocess
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--exchanges", default="binance,kraken")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--symbols", type=int, default=100)
+    parser.add_argument("--rate", type=int, default=20_000, help="每秒總訊息數")
+    parser.add_argument("--duration", type=float, default=5.0, help="每個情境量測幾秒")
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--burst-factor", type=float, default=10.0)
+    parser.add_argument("--redis-url", default=None, help="使用真的 Redis，例如 redis://localhost:6379/15")
+    parser.add_argument("--output", default=None, help="把 JSON 結果寫到檔案")
+    parser.add_argument("--combined", action="store_true", help="Binance 使用 combined stream 網址連線")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    results: Dict[str, Dict[str, dict]] = {}
+    for exchange in args.exchanges.split(","):
+        for scenario in args.scenarios.split(","):
+            print(f"Running {exchange}/{scenario}...", file=sys.stderr)
+            results.setdefault(exchange, {})[scenario] = await run_scenario(exchange, scenario, args)
+
+    report = {
+        "meta": {
+            "revision": get_git_revision(),
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "redis": args.redis_url or "fake",
+            "symbols": args.symbols,
+            "rate": args.rate,
+            "duration": args.duration,
+            "burst_factor": args.burst_factor,
+            "combined": args.combined,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,151 @@
+"""
+比較 TransportProfile 各個設定對接收端 CPU 和延遲的影響：
+- throughput: 伺服器一次送出所有訊息，接收端每秒處理幾筆、每筆花多少 CPU
+- latency: 伺服器以固定速率送出，訊息從送出到 message_callback 收到的延遲
+
+伺服器在另一個 process 執行，CPU 時間只計算接收端。
+延遲用兩個 process 共用的 CLOCK_MONOTONIC 計算，只適用於 Linux。
+
+使用方式（在 data_stream_services 目錄下）:
+    python -m benchmarks.bench_transport --messages 50000 --rate 20000
+"""
+import json
+import time
+import asyncio
+import argparse
+import resource
+import multiprocessing
+
+from typing import Dict, List
+
+from websockets.asyncio.server import serve
+
+from shared.core.codec import get_codec
+from shared.core.transport import TransportProfile, run, uvloop
+from shared.core.ws_manager import WebSocketManager
+
+
+def make_trade(seq: int) -> dict:
+    return {
+        "e": "aggTrade", "E": 1700000000000 + seq, "s": "BTCUSDT", "a": seq,
+        "p": "43123.45000000", "q": "0.01234000", "f": seq, "l": seq,
+        "T": 1700000000000 + seq, "m": bool(seq % 2), "M": True,
+    }
+
+
+def server_main(port: int, ready) -> None:
+    """收到 {"count": N, "rate": R} 之後送出 N 筆成交，rate 為 0 時不間斷送出"""
+    async def handler(ws):
+        async for raw in ws:
+            request = json.loads(raw)
+            count, rate = request["count"], request["rate"]
+            batch = max(1, rate // 1000) if rate else count
+            started = time.monotonic()
+            for seq in range(count):
+                trade = make_trade(seq)
+                trade["sent"] = time.monotonic()
+                await ws.send(json.dumps(trade))
+                if rate and seq % batch == batch - 1:
+                    delay = started + (seq + 1) / rate - time.monotonic()
+                    await asyncio.sleep(max(delay, 0))
+
+    async def main():
+        async with serve(handler, "127.0.0.1", port, compression="deflate", max_queue=None):
+            ready.set()
+            await asyncio.Future()
+
+    asyncio.run(main())
+
+
+async def run_case(uri: str, profile: TransportProfile, count: int, rate: int) -> Dict[str, float]:
+    codec = get_codec()
+    manager = WebSocketManager(hot_swap=False, transport=profile)
+    latencies: List[float] = []
+    done = asyncio.Event()
+
+    async def on_message(connection_id: str, raw: bytes):
+        data = codec.loads(raw)
+        latencies.append(time.monotonic() - data["sent"])
+        if len(latencies) >= count:
+            done.set()
+
+    manager.set_message_callback(on_message)
+    await manager.start()
+    await manager.add_connection(uri, "spot:bench")
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_started = usage.ru_utime + usage.ru_stime
+    started = time.perf_counter()
+    await manager.send_message("spot:bench", json.dumps({"count": count, "rate": rate}))
+    await done.wait()
+    elapsed = time.perf_counter() - started
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime - cpu_started
+    await manager.close()
+
+    ordered = sorted(latencies)
+    return {
+        "messages_per_sec": count / elapsed,
+        "cpu_us_per_message": cpu / count * 1_000_000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def get_profiles() -> Dict[str, TransportProfile]:
+    profiles = {
+        "default": TransportProfile(),
+        "no_compression": TransportProfile(compression=False),
+        "rcvbuf_4mb": TransportProfile(rcvbuf=4 * 2 ** 20),
+        "max_queue_1024": TransportProfile(max_queue=1024),
+        "nodelay_off": TransportProfile(tcp_nodelay=False),
+    }
+    if uvloop is not None:
+        profiles["uvloop"] = TransportProfile(use_uvloop=True)
+        profiles["tuned"] = TransportProfile(
+            use_uvloop=True, compression=False, rcvbuf=4 * 2 ** 20, max_queue=1024
+        )
+    return profiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=50_000)
+    parser.add_argument("--rate", type=int, default=20_000, help="latency 測試每秒送出幾筆")
+    parser.add_argument("--port", type=int, default=8791)
+    parser.add_argument("--json", action="store_true", help="以 JSON 輸出結果")
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=server_main, args=(args.port, ready), daemon=True)
+    server.start()
+    ready.wait(10)
+    uri = f"ws://127.0.0.1:{args.port}"
+
+    results = {}
+    try:
+        for name, profile in get_profiles().items():
+            results[name] = {
+                "throughput": run(run_case(uri, profile, args.messages, 0), use_uvloop=profile.use_uvloop),
+                "latency": run(run_case(uri, profile, args.messages, args.rate), use_uvloop=profile.use_uvloop),
+            }
+    finally:
+        server.terminate()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for name, result in results.items():
+        throughput, latency = result["throughput"], result["latency"]
+        print(
+            f"{name:<15} {throughput['messages_per_sec']:>10.0f} msg/s  "
+            f"cpu={throughput['cpu_us_per_message']:6.2f} us/msg  |  "
+            f"@{args.rate}/s p50={latency['p50_ms']:7.3f} ms  p99={latency['p99_ms']:7.3f} ms  "
+            f"cpu={latency['cpu_us_per_message']:6.2f} us/msg"
+        )
+
+
+if __name__ == "__main__":
+    main()
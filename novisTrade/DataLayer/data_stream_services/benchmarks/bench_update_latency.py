@@ -0,0 +1,158 @@
+"""
+比較 WebSocketManager 連接更新處理的延遲：
+- subscribe-to-first-message: 建立連線並送出訂閱，到收到第一筆資料的時間
+- ping-to-pong: 伺服器送出 ping，到收到 callback 回覆的 pong 的時間
+
+before 是舊版每 100 ms 輪詢一次更新佇列的作法，after 是目前事件驅動的作法。
+伺服器在本機啟動，不需要連到交易所。
+
+使用方式（在 data_stream_services 目錄下）:
+    python -m benchmarks.bench_update_latency --samples 50
+"""
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+from typing import Dict, List
+
+from websockets.asyncio.server import serve
+
+from shared.core.ws_manager import WebSocketManager
+
+
+class PollingWebSocketManager(WebSocketManager):
+    """舊版以 100 ms 輪詢處理連接更新的管理器，只用來比較"""
+    async def _update_processor(self):
+        while self.running:
+            while not self._connection_updates.empty():
+                message = self._connection_updates.get_nowait()
+                try:
+                    await self._process_update(message)
+                finally:
+                    self._connection_updates.task_done()
+            await asyncio.sleep(0.1)
+
+
+class FakeServer:
+    """收到訂閱就回一筆成交；收到 start_ping 之後定期送 ping 並記錄 pong 的延遲"""
+    def __init__(self, ping_samples: int, ping_interval: float):
+        self.ping_samples = ping_samples
+        self.ping_interval = ping_interval
+        self.pong_latencies: List[float] = []
+        self.pings_done = asyncio.Event()
+
+    async def handler(self, ws):
+        sent_at: Dict[int, float] = {}
+        ping_task = None
+        try:
+            async for raw in ws:
+                message = json.loads(raw)
+                if message.get("method") == "SUBSCRIBE":
+                    await ws.send(json.dumps({"e": "aggTrade", "s": "BTCUSDT", "a": 1}))
+                elif message.get("method") == "START_PING":
+                    ping_task = asyncio.create_task(self._send_pings(ws, sent_at))
+                elif "pong" in message:
+                    started = sent_at.pop(message["pong"], None)
+                    if started is not None:
+                        self.pong_latencies.append(time.perf_counter() - started)
+                        if len(self.pong_latencies) >= self.ping_samples:
+                            self.pings_done.set()
+        finally:
+            if ping_task:
+                ping_task.cancel()
+
+    async def _send_pings(self, ws, sent_at: Dict[int, float]):
+        for ping_id in range(self.ping_samples):
+            sent_at[ping_id] = time.perf_counter()
+            await ws.send(json.dumps({"ping": ping_id}))
+            await asyncio.sleep(self.ping_interval)
+
+
+async def run_case(manager_cls, uri: str, server: FakeServer, samples: int) -> Dict[str, List[float]]:
+    manager = manager_cls()
+    first_message: Dict[str, asyncio.Future] = {}
+
+    async def on_message(connection_id: str, raw: bytes):
+        data = json.loads(raw)
+        if "ping" in data:
+            # 和 BinanceWebSocket._handle_message 一樣透過 send_message 回覆 pong
+            await manager.send_message(connection_id, json.dumps({"pong": data["ping"]}))
+            return
+        future = first_message.get(connection_id)
+        if future and not future.done():
+            future.set_result(time.perf_counter())
+
+    manager.set_message_callback(on_message)
+    await manager.start()
+
+    subscribe_latencies = []
+    loop = asyncio.get_running_loop()
+    for i in range(samples):
+        connection_id = f"spot:bench-{i}"
+        first_message[connection_id] = loop.create_future()
+        started = time.perf_counter()
+        await manager.add_connection(uri, connection_id)
+        await manager.send_message(
+            connection_id, json.dumps({"method": "SUBSCRIBE", "params": ["btcusdt@aggTrade"], "id": i})
+        )
+        received = await first_message[connection_id]
+        subscribe_latencies.append(received - started)
+        await manager.remove_connection(connection_id)
+
+    server.pong_latencies.clear()
+    server.pings_done.clear()
+    await manager.add_connection(uri, "spot:ping")
+    await manager.send_message("spot:ping", json.dumps({"method": "START_PING"}))
+    await server.pings_done.wait()
+    await manager.close()
+
+    return {
+        "subscribe_to_first_message": subscribe_latencies,
+        "ping_to_pong": list(server.pong_latencies),
+    }
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    ordered = sorted(latencies)
+    return {
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=30)
+    parser.add_argument("--ping-interval", type=float, default=0.02)
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--json", action="store_true", help="以 JSON 輸出結果")
+    args = parser.parse_args()
+
+    server = FakeServer(ping_samples=args.samples, ping_interval=args.ping_interval)
+    uri = f"ws://127.0.0.1:{args.port}"
+    results = {}
+    async with serve(server.handler, "127.0.0.1", args.port):
+        for name, manager_cls in (("before", PollingWebSocketManager), ("after", WebSocketManager)):
+            raw = await run_case(manager_cls, uri, server, args.samples)
+            results[name] = {metric: summarize(values) for metric, values in raw.items()}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for metric in ("subscribe_to_first_message", "ping_to_pong"):
+        print(metric)
+        for name in ("before", "after"):
+            stats = results[name][metric]
+            print(
+                f"  {name:<7} mean={stats['mean_ms']:8.3f} ms  p50={stats['p50_ms']:8.3f} ms  "
+                f"p99={stats['p99_ms']:8.3f} ms  max={stats['max_ms']:8.3f} ms"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,224 @@
+"""
+模擬 Binance 和 Kraken WebSocket 格式的本機伺服器，benchmark 用：
+- Binance: SUBSCRIBE / UNSUBSCRIBE 後送出 aggTrade；連到 /stream?streams=... 時一連上就開始送，並包上 combined stream 的外層
+- Kraken: v2 的 subscribe / unsubscribe 後送出 trade update，爆量時一個 frame 會有多筆成交
+
+成交編號（Binance 的 aggTradeId、Kraken 的 trade_id）放的是送出時的 CLOCK_MONOTONIC 微秒，
+接收端用它計算端到端延遲，同時也是遞增的，不會被去重。兩個 process 必須在同一台 Linux 主機上。
+"""
+import json
+import time
+import weakref
+import asyncio
+import logging
+
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+from websockets.asyncio.server import ServerConnection, serve
+
+logger = logging.getLogger(__name__)
+
+
+class TradeClock:
+    """產生嚴格遞增的微秒成交編號"""
+    def __init__(self):
+        self.last = 0
+
+    def next_id(self) -> int:
+        now = time.monotonic_ns() // 1000
+        self.last = now if now > self.last else self.last + 1
+        return self.last
+
+
+class FakeExchange:
+    """
+    依照目前的速率，把成交輪流送給所有已訂閱的 stream。
+
+    rate 為每秒總訊息數，burst_factor 大於 1 時每 burst_every 秒會有 burst_duration 秒
+    以 rate * burst_factor 送出，模擬連環清算時的爆量。
+    """
+    name = "fake"
+
+    def __init__(self):
+        self.clock = TradeClock()
+        # (連線, stream) 的訂閱
+        self.subscriptions: Dict[ServerConnection, Set[str]] = {}
+        self.sent = 0
+        self.connections_total = 0
+        self._targets: List[Tuple[ServerConnection, str]] = []
+        self._next_target = 0
+        self._traffic_task: Optional[asyncio.Task] = None
+        self._server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self._server = await serve(self._handler, host, port, compression=None, max_queue=None)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        await self.stop_traffic()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handler(self, ws: ServerConnection) -> None:
+        self.subscriptions[ws] = set()
+        self.connections_total += 1
+        self.on_connect(ws)
+        self._refresh_targets()
+        try:
+            async for raw in ws:
+                for reply in self.handle_request(ws, json.loads(raw)):
+                    await ws.send(json.dumps(reply))
+                self._refresh_targets()
+        except Exception:
+            pass
+        finally:
+            self.subscriptions.pop(ws, None)
+            self._refresh_targets()
+
+    def _refresh_targets(self) -> None:
+        self._targets = [(ws, stream) for ws, streams in self.subscriptions.items() for stream in sorted(streams)]
+
+    def on_connect(self, ws: ServerConnection) -> None:
+        """連線建立時呼叫，可以依照網址預先訂閱"""
+
+    def handle_request(self, ws: ServerConnection, request: dict) -> List[dict]:
+        raise NotImplementedError
+
+    def make_frames(self, ws: ServerConnection, stream: str, fills: int) -> List[str]:
+        """產生 fills 筆成交要送出的 frame"""
+        raise NotImplementedError
+
+    def start_traffic(
+        self,
+        rate: float,
+        burst_factor: float = 1.0,
+        burst_every: float = 2.0,
+        burst_duration: float = 0.25,
+    ) -> None:
+        self._traffic_task = asyncio.create_task(
+            self._traffic_loop(rate, burst_factor, burst_every, burst_duration)
+        )
+
+    async def stop_traffic(self) -> None:
+        if self._traffic_task:
+            self._traffic_task.cancel()
+            await asyncio.gather(self._traffic_task, return_exceptions=True)
+            self._traffic_task = None
+
+    async def drop_connections(self) -> int:
+        """模擬交易所斷線"""
+        connections = list(self.subscriptions)
+        for ws in connections:
+            await ws.close(1001, "going away")
+        return len(connections)
+
+    async def _traffic_loop(self, rate: float, burst_factor: float, burst_every: float, burst_duration: float) -> None:
+        started = last = time.monotonic()
+        budget = 0.0
+        while True:
+            await asyncio.sleep(0.001)
+            now = time.monotonic()
+            in_burst = burst_factor > 1 and (now - started) % burst_every < burst_duration
+            current_rate = rate * burst_factor if in_burst else rate
+            budget += (now - last) * current_rate
+            last = now
+            if not self._targets:
+                budget = 0.0
+                continue
+
+            # 爆量時交易所會把同一個 stream 的多筆成交放在同一個 frame
+            fills = int(burst_factor) if in_burst else 1
+            # 送出時會讓出控制權，斷線可能在迴圈中途清空 _targets
+            while budget >= fills and self._targets:
+                ws, stream = self._targets[self._next_target % len(self._targets)]
+                self._next_target += 1
+                budget -= fills
+                try:
+                    for frame in self.make_frames(ws, stream, fills):
+                        await ws.send(frame)
+                    self.sent += fills
+                except Exception:
+                    pass
+
+
+class FakeBinance(FakeExchange):
+    name = "binance"
+
+    def handle_request(self, ws: ServerConnection, request: dict) -> List[dict]:
+        streams = self.subscriptions[ws]
+        if request.get("method") == "SUBSCRIBE":
+            streams.update(request["params"])
+        elif request.get("method") == "UNSUBSCRIBE":
+            streams.difference_update(request["params"])
+        return [{"result": None, "id": request.get("id")}]
+
+    def __init__(self):
+        super().__init__()
+        self.combined: Set[ServerConnection] = weakref.WeakSet()
+
+    def on_connect(self, ws: ServerConnection) -> None:
+        path = ws.request.path if ws.request else ""
+        if path.startswith("/stream"):
+            self.combined.add(ws)
+            _, _, streams = path.partition("streams=")
+            self.subscriptions[ws].update(stream for stream in streams.split("/") if stream)
+
+    def make_frames(self, ws: ServerConnection, stream: str, fills: int) -> List[str]:
+        # Binance 一個 frame 只有一筆，爆量時送出多個 frame
+        frames = []
+        symbol = stream.split("@", 1)[0].upper()
+        combined = ws in self.combined
+        for _ in range(fills):
+            trade_id = self.clock.next_id()
+            data = {
+                "e": "aggTrade", "E": int(time.time() * 1000), "s": symbol, "a": trade_id,
+                "p": "43123.45000000", "q": "0.01234000", "f": trade_id, "l": trade_id,
+                "T": int(time.time() * 1000), "m": bool(trade_id % 2), "M": True,
+            }
+            frames.append(json.dumps({"stream": stream, "data": data} if combined else data))
+        return frames
+
+
+class FakeKraken(FakeExchange):
+    name = "kraken"
+
+    def handle_request(self, ws: ServerConnection, request: dict) -> List[dict]:
+        method = request.get("method")
+        params = request.get("params", {})
+        streams = self.subscriptions[ws]
+        replies = []
+        for symbol in params.get("symbol", []):
+            stream = f"{symbol}@{params.get('channel')}"
+            if method == "subscribe":
+                streams.add(stream)
+            elif method == "unsubscribe":
+                streams.discard(stream)
+            now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+            replies.append({
+                "method": method,
+                "result": {"channel": params.get("channel"), "snapshot": True, "symbol": symbol},
+                "success": True,
+                "time_in": now,
+                "time_out": now,
+            })
+        return replies
+
+    def make_frames(self, ws: ServerConnection, stream: str, fills: int) -> List[str]:
+        symbol = stream.split("@", 1)[0]
+        timestamp = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+        return [json.dumps({
+            "channel": "trade",
+            "type": "update",
+            "data": [
+                {
+                    "symbol": symbol, "side": "buy", "price": 43123.4, "qty": 0.0123,
+                    "ord_type": "market", "trade_id": self.clock.next_id(), "timestamp": timestamp,
+                }
+                for _ in range(fills)
+            ],
+        })]
+
+
+FAKE_EXCHANGES = {"binance": FakeBinance, "kraken": FakeKraken}
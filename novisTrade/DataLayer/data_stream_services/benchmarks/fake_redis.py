@@ -0,0 +1,167 @@
+"""
+只實作 benchmark 需要的指令的 Redis 替身（RESP2），不需要安裝 Redis 就能跑端到端測試：
+- PUBLISH / SUBSCRIBE / PSUBSCRIBE / UNSUBSCRIBE / PUNSUBSCRIBE / PUBSUB NUMSUB
+- publisher 和快取會用到的 SET、GET、RPUSH、LTRIM、LRANGE、HSET、XADD 只回覆，不保存資料
+- 其他指令（HELLO、CLIENT SETINFO、SELECT 等）一律回 +OK，送過 HELLO 3 的連線 HGETALL 會回覆 RESP3 的空 map
+
+on_publish(channel, payload) 會在每次 PUBLISH 時呼叫，用來記錄端到端延遲。
+"""
+import asyncio
+import fnmatch
+import logging
+
+from typing import Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+def _bulk(value: Optional[bytes]) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    return b"$" + str(len(value)).encode() + b"\r\n" + value + b"\r\n"
+
+
+def _integer(value: int) -> bytes:
+    return b":" + str(value).encode() + b"\r\n"
+
+
+def _array(items: List[bytes]) -> bytes:
+    return b"*" + str(len(items)).encode() + b"\r\n" + b"".join(items)
+
+
+class FakeRedis:
+    def __init__(self, on_publish: Optional[Callable[[bytes, bytes], None]] = None):
+        self.on_publish = on_publish
+        self.channels: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+        self.patterns: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+        self.published = 0
+        # 送過 HELLO 3 的連線，redis-py 會用 RESP3 的格式解讀回覆
+        self._resp3: Set[asyncio.StreamWriter] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._handle_client, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        if self._server:
+            self._server.close()
+
+    async def _read_command(self, reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        subscribed: Set[bytes] = set()
+        psubscribed: Set[bytes] = set()
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                writer.write(self._execute(args, writer, subscribed, psubscribed))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in subscribed:
+                self.channels.get(channel, set()).discard(writer)
+            for pattern in psubscribed:
+                self.patterns.get(pattern, set()).discard(writer)
+            self._resp3.discard(writer)
+            writer.close()
+
+    def _execute(
+        self,
+        args: List[bytes],
+        writer: asyncio.StreamWriter,
+        subscribed: Set[bytes],
+        psubscribed: Set[bytes],
+    ) -> bytes:
+        command = args[0].upper()
+
+        if command == b"PUBLISH":
+            return _integer(self._publish(args[1], args[2]))
+
+        if command in (b"SUBSCRIBE", b"PSUBSCRIBE"):
+            pattern = command == b"PSUBSCRIBE"
+            registry, joined = (self.patterns, psubscribed) if pattern else (self.channels, subscribed)
+            replies = []
+            for channel in args[1:]:
+                registry.setdefault(channel, set()).add(writer)
+                joined.add(channel)
+                replies.append(_array([
+                    _bulk(command.lower()), _bulk(channel), _integer(len(subscribed) + len(psubscribed))
+                ]))
+            return b"".join(replies)
+
+        if command in (b"UNSUBSCRIBE", b"PUNSUBSCRIBE"):
+            pattern = command == b"PUNSUBSCRIBE"
+            registry, joined = (self.patterns, psubscribed) if pattern else (self.channels, subscribed)
+            channels = args[1:] or list(joined)
+            if not channels:
+                return _array([_bulk(command.lower()), _bulk(None), _integer(0)])
+            replies = []
+            for channel in channels:
+                registry.get(channel, set()).discard(writer)
+                joined.discard(channel)
+                replies.append(_array([
+                    _bulk(command.lower()), _bulk(channel), _integer(len(subscribed) + len(psubscribed))
+                ]))
+            return b"".join(replies)
+
+        if command == b"PUBSUB" and args[1].upper() == b"NUMSUB":
+            items = []
+            for channel in args[2:]:
+                items.extend([_bulk(channel), _integer(len(self.channels.get(channel, ())))])
+            return _array(items)
+
+        if command == b"HELLO":
+            if len(args) > 1 and args[1] == b"3":
+                self._resp3.add(writer)
+            return b"+OK\r\n"
+        if command == b"PING":
+            return b"+PONG\r\n"
+        if command in (b"RPUSH", b"HSET"):
+            return _integer(1)
+        if command == b"XADD":
+            return _bulk(b"0-1")
+        if command == b"GET":
+            return _bulk(None)
+        if command == b"HGETALL" and writer in self._resp3:
+            return b"%0\r\n"
+        if command in (b"LRANGE", b"HGETALL"):
+            return _array([])
+        if command in (b"HDEL", b"DEL"):
+            return _integer(0)
+        return b"+OK\r\n"
+
+    def _publish(self, channel: bytes, payload: bytes) -> int:
+        self.published += 1
+        if self.on_publish:
+            self.on_publish(channel, payload)
+
+        receivers = 0
+        message = None
+        for writer in self.channels.get(channel, ()):
+            if message is None:
+                message = _array([_bulk(b"message"), _bulk(channel), _bulk(payload)])
+            writer.write(message)
+            receivers += 1
+        for pattern, writers in self.patterns.items():
+            if writers and fnmatch.fnmatchcase(channel.decode(), pattern.decode()):
+                pmessage = _array([_bulk(b"pmessage"), _bulk(pattern), _bulk(channel), _bulk(payload)])
+                for writer in writers:
+                    writer.write(pmessage)
+                    receivers += 1
+        return receivers
@@ -1,25 +1,91 @@
 import time
 import json
+import asyncio
 import logging
+import urllib.request
 
-from typing import List, Optional, Set, Dict
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional, Set, Dict, Tuple
 
 from shared.core.base_ws import ExchangeWebSocket
+from shared.core.orderbook import OrderBook
 
 logger = logging.getLogger(__name__)
 
+DEPTH_SNAPSHOT_URLS = {
+    "spot": "https://api.binance.com/api/v3/depth",
+    "perp": "https://fapi.binance.com/fapi/v1/depth",
+    "coin-m": "https://dapi.binance.com/dapi/v1/depth",
+}
+
+# (market_type, symbol, limit) -> {"lastUpdateId": ..., "bids": [...], "asks": [...]}
+SnapshotFetcher = Callable[[str, str, int], Awaitable[dict]]
+
+
+async def fetch_depth_snapshot(market_type: str, symbol: str, limit: int = 1000) -> dict:
+    """透過 REST API 取得訂單簿快照，在 thread 中執行避免卡住 event loop"""
+    url = f"{DEPTH_SNAPSHOT_URLS.get(market_type, DEPTH_SNAPSHOT_URLS['spot'])}?symbol={symbol.upper()}&limit={limit}"
+
+    def fetch() -> dict:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return json.loads(response.read())
+
+    return await asyncio.to_thread(fetch)
+
+
+@dataclass
+class DepthState:
+    """一個交易對的本地訂單簿以及同步狀態"""
+    book: OrderBook = field(default_factory=OrderBook)
+    # 還沒和快照對齊前收到的增量更新
+    buffer: List[dict] = field(default_factory=list)
+    synced: bool = False
+    # 套用快照後還沒收到第一筆涵蓋 lastUpdateId 的更新
+    awaiting_first: bool = False
+    dirty: bool = False
+    last_event_time: int = 0
+    snapshot_task: Optional[asyncio.Task] = None
+
 class BinanceWebSocket(ExchangeWebSocket):
+    # K 棒由歸集成交聚合
+    BAR_SOURCE_STREAM = "aggTrade"
+    # 訂閱訊息太長時交易所可能拒絕，大量訂閱時分段送出
+    MAX_STREAMS_PER_REQUEST = 200
+    # combined stream 網址的長度上限，放不下的 stream 連上之後再用 SUBSCRIBE 補上
+    COMBINED_URL_MAX_LENGTH = 8000
+
     def __init__(
         self,
         redis_host: str = "localhost",
         redis_port: int = 6379,
         redis_db: int = 0,
+        depth_levels: int = 20,
+        depth_publish_interval_ms: int = 100,
+        depth_snapshot_limit: int = 1000,
+        snapshot_fetcher: Optional[SnapshotFetcher] = None,
+        combined_streams: bool = False,
+        **kwargs,
     ):
         super().__init__(
             redis_host=redis_host,
             redis_port=redis_port,
             redis_db=redis_db,
+            **kwargs,
         )
+        # depth 的增量更新在本地維護訂單簿，定期發佈前 depth_levels 檔
+        self.depth_levels = depth_levels
+        self.depth_publish_interval_ms = depth_publish_interval_ms
+        self.depth_snapshot_limit = depth_snapshot_limit
+        self.snapshot_fetcher = snapshot_fetcher or fetch_depth_snapshot
+        # 快照還沒回來前最多暫存幾筆增量更新
+        self.depth_buffer_limit = 10_000
+        self.books: Dict[Tuple[str, str], DepthState] = {}
+        # (market_type, symbol) -> 訂閱中的增量 depth stream type，訂單簿發佈在每個 stream type 的 topic
+        self.depth_streams: Dict[Tuple[str, str], Set[str]] = defaultdict(set)
+        self._depth_task: Optional[asyncio.Task] = None
+        # 建立連線時已知要訂閱哪些 stream（新連線、重連）時，直接連到 /stream?streams=...，省掉 SUBSCRIBE 的來回
+        self.combined_streams = combined_streams
 
     def _get_topic_name(
         self, symbol: str, stream_type: str, market_type: str = "spot"
@@ -35,12 +101,35 @@ class BinanceWebSocket(ExchangeWebSocket):
         }
         return urls.get(market_type, urls["spot"])
 
-    async def _handle_message(self, connection_id: str, message: str):
+    def _get_connection_url(self, market_type: str, streams: List[str]) -> str:
+        """combined 模式下把放得下的 stream 依序帶在 /stream?streams= 後面，一個都放不下時使用 /ws"""
+        base_url = self._get_base_url(market_type)
+        if not self.combined_streams or not streams or not base_url.endswith("/ws"):
+            return base_url
+        prefix = f"{base_url[:-len('/ws')]}/stream?streams="
+        length = len(prefix) - 1
+        included = []
+        for stream in streams:
+            length += len(stream) + 1
+            if length > self.COMBINED_URL_MAX_LENGTH:
+                break
+            included.append(stream)
+        return prefix + "/".join(included) if included else base_url
+
+    def _get_url_streams(self, url: str) -> Set[str]:
+        _, combined, query = url.partition("/stream?streams=")
+        return set(query.split("/")) if combined and query else set()
+
+    async def _handle_message(self, connection_id: str, message: bytes):
         """處理接收到的 WebSocket 訊息"""
         try:
-            data = json.loads(message)
+            data = self.codec.loads(message)
             market_type = connection_id.split(":")[0]
 
+            # combined stream 的訊息包在 {"stream": ..., "data": {...}} 裡，直接取出內層的 dict，不複製
+            if "stream" in data:
+                data = data["data"]
+
             # 處理心跳訊息
             if "ping" in data:
                 await self.ws_manager.send_message(
@@ -53,115 +142,35 @@ class BinanceWebSocket(ExchangeWebSocket):
                 logger.debug(f"Received subscription confirmation: {data}")
                 return
 
+            # 增量更新只更新本地訂單簿，由 _depth_loop 定期發佈
+            if data.get("e") == "depthUpdate":
+                started = time.perf_counter()
+                self._on_depth_update(market_type, data)
+                self.metrics.observe_handler(connection_id, time.perf_counter() - started)
+                return
+
             # 處理市場數據
+            started = time.perf_counter()
             topic, mapped_data = self._map_format(market_type, data)
+            self.metrics.observe_handler(connection_id, time.perf_counter() - started)
 
-            # 發送到 Redis
-            await self.redis_producer.publish(topic, json.dumps(mapped_data))
+            # 交給 publisher 批次發送到 Redis
+            await self._publish(topic, mapped_data)
 
         except Exception as e:
             logger.error(f"Error handling message: {str(e)}")
 
-    async def _handle_reconnection(self, connection_id: str):
-        """處理重新連接"""
-        market_type = connection_id.split(":")[0]
-        streams = list(self.subscriptions.get(market_type, set()))
-
-        subscribe_message = {
-            "method": "SUBSCRIBE",
-            "params": streams,
-            "id": int(time.time() * 1000),
-        }
-
-        try:
-            await self.ws_manager.send_message(
-                connection_id, json.dumps(subscribe_message)
-            )
-
-        except Exception as e:
-            logger.error(f"Failed to restore subscriptions: {str(e)}")
-
-    async def subscribe(
+    def parse_subscription_message(
         self,
-        symbols: List[str],
-        stream_type: str,
-        market_type: str = "spot",
-        request_id: Optional[int] = None,
-    ) -> bool:
-        """訂閱指定市場的串流"""
-        if request_id is None:
-            request_id = int(time.time() * 1000)
-        streams = [f"{symbol}@{stream_type}" for symbol in symbols]
-
-        # 建立連接 ID
-        connection_id = f"{market_type}:main"
-
-        # 如果尚未建立連接
-        if connection_id not in self.ws_manager.connections:
-            try:
-                url = f"{self._get_base_url(market_type)}"
-                await self.ws_manager.add_connection(url, connection_id)
-            except Exception as e:
-                logger.error(f"Failed to establish connection: {str(e)}")
-                return False
-
-        # 發送訂閱訊息
-        subscribe_message = {"method": "SUBSCRIBE", "params": streams, "id": request_id}
-
-        try:
-            logger.debug(f"Subscribing to {streams}")
-            await self.ws_manager.send_message(
-                connection_id, json.dumps(subscribe_message)
-            )
-            logger.debug(f"Subscribed to {streams}")
-            # 更新訂閱記錄
-            logger.debug(f" Adding subscription with market_type: {market_type}")
-            self.add_subscription(streams, market_type)
-            logger.debug(f"Subscriptions: {dict(self.subscriptions)}")
-            return True
-
-        except Exception as e:
-            logger.error(f"Subscription failed: {str(e)}")
-            return False
-
-    async def unsubscribe(
-        self,
-        symbols: List[str],
-        stream_type: str,
+        method: str,
+        streams: List[str],
         market_type: str = "spot",
         request_id: Optional[int] = None,
-    ):
-        """取消訂閱一個或多個串流"""
+    ) -> List[dict]:
+        """Binance 的訂閱訊息可以一次帶多個 stream"""
         if request_id is None:
             request_id = int(time.time() * 1000)
-
-        streams = [f"{symbol}@{stream_type}" for symbol in symbols]
-        connection_id = f"{market_type}:main"
-
-        # 先移除訂閱記錄
-        self.remove_subscription(streams, market_type)
-        
-        # 如果沒有人訂閱了，就取消訂閱
-        removing_streams = self.get_zero_sub_streams(market_type)
-        logger.debug(f"Removing streams: {removing_streams}")
-        
-        # TODO 好像有點危險，因為 remove subscription 後 unsubscribe 失敗，可能會造成訂閱記錄不一致
-        
-        unsubscribe_message = {
-            "method": "UNSUBSCRIBE",
-            "params": removing_streams,
-            "id": request_id,
-        }
-
-        try:
-            await self.ws_manager.send_message(
-                connection_id, json.dumps(unsubscribe_message)
-            )
-            return True
-
-        except Exception as e:
-            logger.error(f"Unsubscription failed: {str(e)}")
-            return False
+        return [{"method": method.upper(), "params": streams, "id": request_id}]
 
     def _map_format(self, market_type: str, data: dict):
         # 原有的資料格式轉換邏輯保持不變
@@ -204,4 +213,204 @@ class BinanceWebSocket(ExchangeWebSocket):
             "quantity": data["q"],
             "side": "sell" if data["m"] else "buy",
             "tradeId": data["t"],
-        }
\ No newline at end of file
+        }
+
+    async def close(self):
+        if self._depth_task:
+            self._depth_task.cancel()
+            await asyncio.gather(self._depth_task, return_exceptions=True)
+        for state in self.books.values():
+            if state.snapshot_task:
+                state.snapshot_task.cancel()
+        await super().close()
+
+    @staticmethod
+    def _is_diff_depth(stream_type: str) -> bool:
+        """增量 depth stream（depth、depth@100ms），不包含 depth5 這類部分訂單簿"""
+        return stream_type == "depth" or stream_type.startswith("depth@")
+
+    async def subscribe(
+        self,
+        symbols: List[str],
+        stream_type: str,
+        market_type: str = "spot",
+        request_id: Optional[int] = None,
+    ) -> bool:
+        """記錄訂閱中的增量 depth stream type，訂單簿要發佈在訂閱時使用的 topic"""
+        success = await super().subscribe(symbols, stream_type, market_type, request_id)
+        if success and self._is_diff_depth(stream_type):
+            for symbol in symbols:
+                self.depth_streams[(market_type, symbol.lower())].add(stream_type)
+        return success
+
+    async def unsubscribe(
+        self,
+        symbols: List[str],
+        stream_type: str,
+        market_type: str = "spot",
+        request_id: Optional[int] = None,
+    ) -> bool:
+        """沒有人訂閱任何增量 depth stream 之後，丟掉本地訂單簿"""
+        success = await super().unsubscribe(symbols, stream_type, market_type, request_id)
+        if self._is_diff_depth(stream_type):
+            for symbol in symbols:
+                if self.get_sub_count(f"{symbol}@{stream_type}", market_type) > 0:
+                    continue
+                key = (market_type, symbol.lower())
+                self.depth_streams[key].discard(stream_type)
+                if self.depth_streams[key]:
+                    continue
+                del self.depth_streams[key]
+                state = self.books.pop(key, None)
+                if state and state.snapshot_task:
+                    state.snapshot_task.cancel()
+        return success
+
+    def _on_depth_update(self, market_type: str, data: dict) -> None:
+        """
+        依照 Binance 的規則維護本地訂單簿：
+        1. 收到第一筆增量更新時開始暫存，並取得 REST 快照
+        2. 快照回來後丟掉 u <= lastUpdateId 的更新，從涵蓋 lastUpdateId 的那筆開始套用
+        3. 之後每筆的 U 必須等於上一筆的 u + 1（合約為 pu 等於上一筆的 u），否則重新同步
+
+        hot swap 時新舊連線都會送來同一筆更新，u 沒有比目前新的更新直接忽略。
+        取消訂閱之後還在路上的更新也會忽略，不會重新建立訂單簿。
+        """
+        key = (market_type, data["s"].lower())
+        state = self.books.get(key)
+        if state is None:
+            if key not in self.depth_streams:
+                return
+            state = self.books[key] = DepthState()
+            if self._depth_task is None or self._depth_task.done():
+                self._depth_task = asyncio.create_task(self._depth_loop())
+
+        if not state.synced:
+            state.buffer.append(data)
+            if len(state.buffer) > self.depth_buffer_limit:
+                del state.buffer[: len(state.buffer) - self.depth_buffer_limit]
+            if state.snapshot_task is None or state.snapshot_task.done():
+                state.snapshot_task = asyncio.create_task(self._sync_book(market_type, key[1], state))
+            return
+
+        if not self._process_depth_event(state, data):
+            logger.warning(
+                f"Depth gap on {market_type}:{key[1]} (last u={state.book.update_id}, "
+                f"U={data['U']}, u={data['u']}), resyncing"
+            )
+            self._resync(market_type, key[1], state, data)
+
+    def _process_depth_event(self, state: DepthState, data: dict) -> bool:
+        """套用一筆增量更新，和目前的訂單簿接不起來時回傳 False"""
+        last_update_id = state.book.update_id
+        # 合約的更新帶有 pu（上一筆的 u），規則和現貨差一號
+        futures = "pu" in data
+        if state.awaiting_first:
+            # 快照已經包含的更新直接略過，第一筆要涵蓋快照的 lastUpdateId
+            if data["u"] < last_update_id or (not futures and data["u"] == last_update_id):
+                return True
+            if not data["U"] <= last_update_id + (0 if futures else 1) <= data["u"]:
+                return False
+            state.awaiting_first = False
+        else:
+            if data["u"] <= last_update_id:
+                return True
+            if not self._is_continuous(data, last_update_id):
+                return False
+        self._apply_depth(state, data)
+        return True
+
+    @staticmethod
+    def _is_continuous(data: dict, last_update_id: int) -> bool:
+        if "pu" in data:
+            return data["pu"] == last_update_id
+        return data["U"] == last_update_id + 1
+
+    @staticmethod
+    def _apply_depth(state: DepthState, data: dict) -> None:
+        state.book.apply_diff(data["b"], data["a"])
+        state.book.update_id = data["u"]
+        state.last_event_time = data.get("T", data.get("E", 0))
+        state.dirty = True
+
+    def _resync(self, market_type: str, symbol: str, state: DepthState, data: Optional[dict] = None) -> None:
+        state.synced = False
+        state.buffer = [data] if data else []
+        state.book.clear()
+        if state.snapshot_task is None or state.snapshot_task.done():
+            state.snapshot_task = asyncio.create_task(self._sync_book(market_type, symbol, state))
+
+    async def _sync_book(self, market_type: str, symbol: str, state: DepthState) -> None:
+        """取得快照並套用暫存的增量更新，快照比暫存的更新還舊時重新取得"""
+        while not state.synced:
+            try:
+                snapshot = await self.snapshot_fetcher(market_type, symbol, self.depth_snapshot_limit)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Failed to fetch depth snapshot for {market_type}:{symbol}: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+
+            last_update_id = snapshot["lastUpdateId"]
+            buffered = state.buffer
+            if buffered and buffered[0]["U"] > last_update_id + 1:
+                # 快照比第一筆暫存的更新還舊，中間缺了資料
+                logger.debug(f"Depth snapshot for {market_type}:{symbol} is stale, refetching")
+                await asyncio.sleep(0.1)
+                continue
+
+            state.book.apply_snapshot(snapshot["bids"], snapshot["asks"], last_update_id)
+            state.awaiting_first = True
+            state.buffer = []
+            for event in buffered:
+                if not self._process_depth_event(state, event):
+                    break
+            else:
+                state.synced = True
+                state.dirty = True
+                logger.info(
+                    f"Depth book {market_type}:{symbol} synced at update {state.book.update_id} "
+                    f"({len(buffered)} buffered updates)"
+                )
+                return
+
+            # 暫存的更新本身不連續，丟掉重新開始
+            logger.warning(f"Buffered depth updates for {market_type}:{symbol} are not continuous, resyncing")
+            state.book.clear()
+            await asyncio.sleep(0.1)
+
+    async def _depth_loop(self) -> None:
+        """每 depth_publish_interval_ms 發佈一次有變動的訂單簿"""
+        interval = self.depth_publish_interval_ms / 1000
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                records = [
+                    record
+                    for (market_type, symbol), state in list(self.books.items())
+                    if state.synced and state.dirty
+                    for record in self._format_book(market_type, symbol, state)
+                ]
+                for topic, record in records:
+                    await self._publish(topic, record)
+            except Exception as e:
+                logger.error(f"Error publishing depth books: {str(e)}")
+
+    def _format_book(self, market_type: str, symbol: str, state: DepthState) -> List[Tuple[str, dict]]:
+        """同一本訂單簿發佈到每個訂閱中的 depth stream type 的 topic，和控制指令的 streamType 一致"""
+        state.dirty = False
+        book = state.book
+        record = {
+            "exchTimestamp": state.last_event_time or None,
+            "localTimestamp": int(time.time() * 1000),
+            "lastUpdateId": book.update_id,
+            "bids": book.bids(self.depth_levels),
+            "asks": book.asks(self.depth_levels),
+            **book.get_metrics(self.depth_levels),
+        }
+        records = []
+        for stream_type in sorted(self.depth_streams.get((market_type, symbol), ())):
+            topic = self._get_topic_name(symbol, stream_type, market_type)
+            records.append((topic, {"topic": topic, **record}))
+        return records
@@ -1,26 +1,145 @@
+import zlib
 import time
 import json
+import asyncio
 import logging
+import urllib.request
 
-from datetime import datetime
-from typing import List, Union, Any, Optional, Dict
+from typing import Awaitable, Callable, List, Union, Any, Optional, Dict, Tuple
 
 from shared.core.base_ws import ExchangeWebSocket
+from shared.core.orderbook import OrderBook
+from shared.utils import parse_iso8601_ms
 
 logger = logging.getLogger(__name__)
 
+ASSET_PAIRS_URL = "https://api.kraken.com/0/public/AssetPairs"
+
+# () -> {"BTC/USD": (價格小數位數, 數量小數位數)}
+PrecisionFetcher = Callable[[], Awaitable[Dict[str, Tuple[int, int]]]]
+
+
+async def fetch_pair_precision() -> Dict[str, Tuple[int, int]]:
+    """透過 REST API 取得每個交易對的價格和數量小數位數，checksum 需要用到"""
+    def fetch() -> dict:
+        with urllib.request.urlopen(ASSET_PAIRS_URL, timeout=10) as response:
+            return json.loads(response.read())
+
+    result = (await asyncio.to_thread(fetch))["result"]
+    return {
+        pair["wsname"]: (pair["pair_decimals"], pair["lot_decimals"])
+        for pair in result.values()
+        if "wsname" in pair
+    }
+
+
+def _format_checksum_value(value: float, decimals: int) -> str:
+    """依照小數位數格式化之後去掉小數點和開頭的 0"""
+    return f"{value:.{decimals}f}".replace(".", "").lstrip("0")
+
+
+def _timestamp_key(timestamp: str) -> Tuple[str, str]:
+    """ISO 8601 時間的排序鍵，小數位數不同（例如 .5Z 和 .440295Z）時也能正確比較"""
+    fraction = timestamp[20:].rstrip("Z") if len(timestamp) > 20 and timestamp[19] == "." else ""
+    return timestamp[:19], fraction.ljust(9, "0")
+
+
+class KrakenBook(OrderBook):
+    """
+    Kraken v2 book channel 的本地訂單簿，額外記錄每一檔在 checksum 中的字串。
+
+    checksum 為前 10 檔 ask（由低到高）加上前 10 檔 bid（由高到低）的
+    「價格 + 數量」字串的 CRC32，格式化後的字串只在該檔變動時重新計算，
+    驗證一次只需要 20 次 dict 查詢和一次 crc32。
+    """
+    __slots__ = (
+        "depth", "price_decimals", "qty_decimals", "bid_strings", "ask_strings", "dirty", "synced", "timestamp",
+        "last_update",
+    )
+
+    def __init__(self, depth: int, price_decimals: int, qty_decimals: int):
+        super().__init__()
+        self.depth = depth
+        self.price_decimals = price_decimals
+        self.qty_decimals = qty_decimals
+        # 價格 -> checksum 中這一檔的字串
+        self.bid_strings: Dict[float, str] = {}
+        self.ask_strings: Dict[float, str] = {}
+        self.dirty = False
+        self.synced = False
+        self.timestamp: Optional[int] = None
+        # 最後套用的更新 (時間排序鍵, checksum)，用來丟掉 hot swap 時另一條連線送來的重複或較舊的更新
+        self.last_update: Optional[Tuple[Tuple[str, str], int]] = None
+
+    def _level_string(self, price: float, qty: float) -> str:
+        return (
+            _format_checksum_value(price, self.price_decimals)
+            + _format_checksum_value(qty, self.qty_decimals)
+        )
+
+    def apply_levels(self, bids: List[dict], asks: List[dict], snapshot: bool = False) -> None:
+        if snapshot:
+            self.clear()
+            self.bid_strings.clear()
+            self.ask_strings.clear()
+            self.last_update = None
+        for level in bids:
+            price, qty = float(level["price"]), float(level["qty"])
+            self.update_bid(price, qty)
+            if qty:
+                self.bid_strings[price] = self._level_string(price, qty)
+            else:
+                self.bid_strings.pop(price, None)
+        for level in asks:
+            price, qty = float(level["price"]), float(level["qty"])
+            self.update_ask(price, qty)
+            if qty:
+                self.ask_strings[price] = self._level_string(price, qty)
+            else:
+                self.ask_strings.pop(price, None)
+
+        # 超出訂閱深度的檔位要移除，否則 checksum 對不上
+        if len(self.bid_prices) > self.depth or len(self.ask_prices) > self.depth:
+            for price in self.bid_prices[:-self.depth]:
+                self.bid_strings.pop(price, None)
+            for price in self.ask_prices[self.depth:]:
+                self.ask_strings.pop(price, None)
+            self.truncate(self.depth)
+
+    def checksum(self) -> int:
+        ask_strings, bid_strings = self.ask_strings, self.bid_strings
+        parts = [ask_strings[price] for price in self.ask_prices[:10]]
+        parts.extend(bid_strings[price] for price in reversed(self.bid_prices[-10:]))
+        return zlib.crc32("".join(parts).encode())
+
 class KrakenWebSocket(ExchangeWebSocket):
     def __init__(
         self,
         redis_host: str = "localhost",
         redis_port: int = 6379,
         redis_db: int = 0,
+        book_depth: int = 10,
+        book_publish_interval_ms: int = 100,
+        precision_fetcher: Optional[PrecisionFetcher] = None,
+        **kwargs,
     ):
         super().__init__(
             redis_host=redis_host,
             redis_port=redis_port,
             redis_db=redis_db,
+            **kwargs,
         )
+        # v2 book channel 在本地維護訂單簿，驗證 checksum 後定期發佈
+        self.book_depth = book_depth
+        self.book_publish_interval_ms = book_publish_interval_ms
+        self.precision_fetcher = precision_fetcher or fetch_pair_precision
+        self.pair_precision: Dict[str, Tuple[int, int]] = {}
+        self.books: Dict[str, KrakenBook] = {}
+        self.checksum_mismatches = 0
+        self.book_duplicates = 0
+        self._book_task: Optional[asyncio.Task] = None
+        # 每個交易對最多一個進行中的重新訂閱
+        self._book_resubscribes: Dict[str, asyncio.Task] = {}
 
     def _get_topic_name(
         self, symbol: str, stream_type: str, market_type: str = "spot"
@@ -35,9 +154,9 @@ class KrakenWebSocket(ExchangeWebSocket):
         }
         return urls.get(market_type, urls["spot"])
 
-    async def _handle_message(self, connection_id: str, message: str):
+    async def _handle_message(self, connection_id: str, message: bytes):
         try:
-            data = json.loads(message)
+            data = self.codec.loads(message)
             market_type = connection_id.split(":")[0]
 
             logger.debug(f"Message before filtering: {data}")
@@ -46,10 +165,18 @@ class KrakenWebSocket(ExchangeWebSocket):
                 return
             logger.debug(f"Message after filtering: {data}")
 
-            topic, mapped_data = self._map_format(market_type, data)
+            # 訂單簿只更新本地狀態，由 _book_loop 定期發佈
+            if data.get("channel") == "book":
+                started = time.perf_counter()
+                await self._on_book_message(data)
+                self.metrics.observe_handler(connection_id, time.perf_counter() - started)
+                return
 
-            # 發送到 Redis
-            await self.redis_producer.publish(topic, json.dumps(mapped_data))
+            # 一個 frame 可能有多筆成交，整批交給 publisher 放在同一個 pipeline 送出
+            started = time.perf_counter()
+            records = self._map_format(market_type, data)
+            self.metrics.observe_handler(connection_id, time.perf_counter() - started)
+            await self._publish_batch(records)
 
         except Exception as e:
             logger.error(f"Error handling message: {str(e)}")
@@ -163,26 +290,6 @@ class KrakenWebSocket(ExchangeWebSocket):
             case _:
                 return False
 
-    async def _handle_reconnection(self, connection_id: str):
-        try:
-            market_type = connection_id.split(":")[0]
-            streams = list(self.subscriptions.get(market_type, set()))
-            # 把 streams 拆成 symbol 和 stream_type
-            symbols = [stream.split("@")[0] for stream in streams]
-            stream_type = streams[0].split("@")[1]
-            # 獲得訂閱訊息
-            subscribe_message = self._map_subscribe_message(
-                "subscribe", symbols, stream_type, market_type
-            )
-            # 重新訂閱
-            await self.ws_manager.send_message(
-                connection_id, json.dumps(subscribe_message)
-            )
-            logger.info(f"Restore {len(symbols)} subscriptions for {market_type}")
-
-        except Exception as e:
-            logger.error(f"Failed to restore subscriptions: {str(e)}")
-
     def _map_subscribe_message(
         self,
         method: str,
@@ -195,93 +302,31 @@ class KrakenWebSocket(ExchangeWebSocket):
         """
         if market_type == "spot":
             # using v2 API
-            return {
-                "method": method,
-                "params": {"channel": stream_type, "symbol": symbols},
-            }
+            params = {"channel": stream_type, "symbol": symbols}
+            if stream_type == "book":
+                params["depth"] = self.book_depth
+            return {"method": method, "params": params}
 
         elif market_type == "perp":
             return {"event": method, "feed": stream_type, "product_ids": symbols}
 
-    async def subscribe(
+    def parse_subscription_message(
         self,
-        symbols: List[str],
-        stream_type: str,
-        market_type: str = "spot",
-        request_id: Optional[int] = None,
-    ) -> bool:
-        """訂閱市場數據
-        這邊傳進來的東西一定會是在同一個 market_type 下的
-        但是會有不同的 stream type。
-        """
-        if request_id is None:
-            request_id = int(time.time() * 1000)
-
-        streams = [f"{symbol}@{stream_type}" for symbol in symbols]
-
-        connection_id = f"{market_type}:main"
-
-        if connection_id not in self.ws_manager.connections:
-            try:
-                url = f"{self._get_base_url(market_type)}"
-                await self.ws_manager.add_connection(url, connection_id)
-            except Exception as e:
-                logger.error(f"Error adding connection: {str(e)}")
-                return False
-
-        subscribe_message = self._map_subscribe_message(
-            "subscribe", symbols, stream_type, market_type
-        )
-
-        try:
-            await self.ws_manager.send_message(
-                connection_id, json.dumps(subscribe_message)
-            )
-            logger.debug(f"Subscribed to {streams}")
-            self.add_subscription(streams, market_type)
-            logger.debug(f"Subscriptions: {self.subscriptions}")
-            return True
-
-        except Exception as e:
-            logger.error(f"Subscription failed: {str(e)}")
-            return False
-
-    async def unsubscribe(
-        self,
-        symbols: List[str],
-        stream_type: str,
+        method: str,
+        streams: List[str],
         market_type: str = "spot",
         request_id: Optional[int] = None,
-    ):
-        """取消訂閱市場數據"""
-        if request_id is None:
-            request_id = int(time.time() * 1000)
-
-        streams = [f"{symbol}@{stream_type}" for symbol in symbols]
-        connection_id = f"{market_type}:main"
-
-        # 先移除訂閱紀錄
-        self.remove_subscription(streams, market_type)
-        
-        removing_streams = self.get_zero_sub_streams(market_type)
-        logger.debug(f"Removing streams: {removing_streams}")
-        
-        # get list of removing symbols
-        removing_symbols = [stream.split("@")[0] for stream in removing_streams]
-        
-        unsubscribe_message = self._map_subscribe_message(
-            "unsubscribe", removing_symbols, stream_type, market_type
-        )
-
-        try:
-            await self.ws_manager.send_message(
-                connection_id, json.dumps(unsubscribe_message)
-            )
-            return True
-
-        except Exception as e:
-            logger.error(f"Unsubscription failed: {str(e)}")
-            return False
+    ) -> List[dict]:
+        """Kraken 一則訂閱訊息只能有一種 channel，所以依照 stream type 分組"""
+        symbols_by_type: Dict[str, List[str]] = {}
+        for stream in streams:
+            symbol, stream_type = stream.split("@", 1)
+            symbols_by_type.setdefault(stream_type, []).append(symbol)
+
+        return [
+            self._map_subscribe_message(method, symbols, stream_type, market_type)
+            for stream_type, symbols in symbols_by_type.items()
+        ]
 
     def _map_format(self, market_type: str, data: dict):
         """
@@ -397,16 +442,19 @@ class KrakenWebSocket(ExchangeWebSocket):
 
         共同點
         - heartbeat 不需要回應
+        - v2 的一個 update 可能包含多筆成交，所以回傳 [(topic, 整理好的資料)]，每筆成交一組
         """
         # 透過 market_type 來判斷是哪一種 API
         if market_type == "spot":
             event_type = data.get("channel")
+            v2_format_map = {"trade": self._format_v2_trades}
+            handler = v2_format_map.get(event_type)
+            if handler:
+                return handler(data, market_type)
+
             symbol = data["data"][0].get("symbol")
             topic = self._get_topic_name(symbol, event_type, market_type)
 
-            v2_format_map = {"trade": self._format_v2_trade}
-            handler = v2_format_map.get(event_type)
-
         elif market_type == "perp":
             event_type = data.get("feed")
             symbol = data.get("product_id")
@@ -414,12 +462,11 @@ class KrakenWebSocket(ExchangeWebSocket):
 
             v1_format_map = {"trade": self._format_v1_trade}
             handler = v1_format_map.get(event_type)
+            if handler:
+                return [(topic, handler(data, topic))]
 
-        if handler:
-            return topic, handler(data, topic)
-        else:
-            logger.warning(f"Not implemented event type: {event_type}")
-            return topic, data
+        logger.warning(f"Not implemented event type: {event_type}")
+        return [(topic, data)]
 
     def _format_v1_trade(self, data: dict, topic: str):
         return {
@@ -432,18 +479,188 @@ class KrakenWebSocket(ExchangeWebSocket):
             "tradeId": data["seq"],
         }
 
-    def _format_v2_trade(self, data: dict, topic: str):
-        return {
+    def _format_v2_trades(self, data: dict, market_type: str) -> List[Tuple[str, dict]]:
+        """把 v2 update 中的每一筆成交都轉換成通用格式"""
+        local_timestamp = int(time.time() * 1000)
+        records = []
+        for trade in data["data"]:
+            topic = self._get_topic_name(trade["symbol"], "trade", market_type)
+            records.append((topic, {
+                "topic": topic,
+                "exchTimestamp": parse_iso8601_ms(trade["timestamp"]),
+                "localTimestamp": local_timestamp,
+                "price": trade["price"],
+                "quantity": trade["qty"],
+                "side": trade["side"],
+                "tradeId": trade["trade_id"],
+            }))
+        return records
+
+    async def subscribe(
+        self,
+        symbols: List[str],
+        stream_type: str,
+        market_type: str = "spot",
+        request_id: Optional[int] = None,
+    ) -> bool:
+        """訂閱 book 之前先確定有交易對的小數位數，checksum 需要用到"""
+        if stream_type == "book" and any(symbol not in self.pair_precision for symbol in symbols):
+            try:
+                self.pair_precision.update(await self.precision_fetcher())
+            except Exception as e:
+                logger.error(f"Failed to fetch pair precision: {str(e)}")
+                return False
+            missing = [symbol for symbol in symbols if symbol not in self.pair_precision]
+            if missing:
+                logger.error(f"Unknown pairs for book channel: {missing}")
+                return False
+        return await super().subscribe(symbols, stream_type, market_type, request_id)
+
+    async def unsubscribe(
+        self,
+        symbols: List[str],
+        stream_type: str,
+        market_type: str = "spot",
+        request_id: Optional[int] = None,
+    ) -> bool:
+        """沒有人訂閱 book 之後，丟掉本地訂單簿"""
+        success = await super().unsubscribe(symbols, stream_type, market_type, request_id)
+        if stream_type == "book":
+            for symbol in symbols:
+                if self.get_sub_count(f"{symbol}@book", market_type) <= 0:
+                    self.books.pop(symbol, None)
+        return success
+
+    async def close(self):
+        tasks = list(self._book_resubscribes.values())
+        if self._book_task:
+            tasks.append(self._book_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await super().close()
+
+    async def _on_book_message(self, data: dict) -> None:
+        """
+        套用 v2 book channel 的快照或更新，並驗證 checksum
+
+        Received Snapshot Format
+        ------------------------
+        {
+            "channel": "book",
+            "type": "snapshot",
+            "data": [
+                {
+                    "symbol": "MATIC/USD",
+                    "bids": [{"price": 0.5666, "qty": 4831.75496}, ...],
+                    "asks": [{"price": 0.5668, "qty": 4410.79769}, ...],
+                    "checksum": 2439117997
+                }
+            ]
+        }
+
+        Received Delta Format
+        ---------------------
+        {
+            "channel": "book",
+            "type": "update",
+            "data": [
+                {
+                    "symbol": "MATIC/USD",
+                    "bids": [{"price": 0.5657, "qty": 1098.3947558}],
+                    "asks": [],
+                    "checksum": 2114181697,
+                    "timestamp": "2023-10-06T17:35:55.440295Z"
+                }
+            ]
+        }
+
+        checksum 對不上代表本地訂單簿已經和交易所不同，在背景重新訂閱取得新的快照，不會卡住其他交易對。
+        hot swap 時新舊連線會送來同樣的更新，時間比最後套用的更新還舊、或時間和 checksum 都相同的更新直接丟掉，
+        不會被誤判成 checksum 錯誤。
+        """
+        snapshot = data.get("type") == "snapshot"
+        for update in data["data"]:
+            symbol = update["symbol"]
+            book = self.books.get(symbol)
+            if book is None:
+                if not snapshot:
+                    continue
+                price_decimals, qty_decimals = self.pair_precision[symbol]
+                book = self.books[symbol] = KrakenBook(self.book_depth, price_decimals, qty_decimals)
+                if self._book_task is None or self._book_task.done():
+                    self._book_task = asyncio.create_task(self._book_loop())
+            elif not snapshot and not book.synced:
+                # 等待重新訂閱後的快照
+                continue
+
+            stamp = _timestamp_key(update["timestamp"]) if not snapshot and "timestamp" in update else None
+            if stamp is not None and book.last_update is not None:
+                last_stamp, last_checksum = book.last_update
+                if stamp < last_stamp or (stamp == last_stamp and update["checksum"] == last_checksum):
+                    self.book_duplicates += 1
+                    continue
+
+            book.apply_levels(update.get("bids", ()), update.get("asks", ()), snapshot)
+            if book.checksum() != update["checksum"]:
+                self.checksum_mismatches += 1
+                logger.warning(f"Book checksum mismatch for {symbol}, resubscribing")
+                book.synced = False
+                self._schedule_book_resubscribe(symbol)
+                continue
+
+            book.synced = True
+            book.dirty = True
+            if stamp is not None:
+                book.last_update = (stamp, update["checksum"])
+                book.timestamp = parse_iso8601_ms(update["timestamp"])
+
+    def _schedule_book_resubscribe(self, symbol: str) -> None:
+        """在背景重新訂閱，已經有進行中的重新訂閱時不再重複送出"""
+        task = self._book_resubscribes.get(symbol)
+        if task is not None and not task.done():
+            return
+        self._book_resubscribes[symbol] = asyncio.create_task(self._resubscribe_book(symbol))
+
+    async def _resubscribe_book(self, symbol: str) -> None:
+        """在負責這個交易對的連線上重新訂閱 book，交易所會重新送出快照"""
+        stream = f"{symbol}@book"
+        try:
+            connection_id = self.shards.get_connection_id("spot", stream)
+            # 排程之後已經取消訂閱的交易對不需要重新訂閱
+            if connection_id is None or symbol not in self.books:
+                return
+            for method in ("unsubscribe", "subscribe"):
+                await self._send_stream_request(connection_id, method, [stream], "spot")
+        except Exception as e:
+            logger.error(f"Failed to resubscribe book for {symbol}: {str(e)}")
+        finally:
+            self._book_resubscribes.pop(symbol, None)
+
+    async def _book_loop(self) -> None:
+        """每 book_publish_interval_ms 發佈一次有變動的訂單簿"""
+        interval = self.book_publish_interval_ms / 1000
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                records = [
+                    self._format_book(symbol, book)
+                    for symbol, book in list(self.books.items())
+                    if book.synced and book.dirty
+                ]
+                for topic, record in records:
+                    await self._publish(topic, record)
+            except Exception as e:
+                logger.error(f"Error publishing books: {str(e)}")
+
+    def _format_book(self, symbol: str, book: KrakenBook) -> Tuple[str, dict]:
+        book.dirty = False
+        topic = self._get_topic_name(symbol, "book", "spot")
+        return topic, {
             "topic": topic,
-            "exchTimestamp": int(
-                datetime.fromisoformat(
-                    data["data"][0]["timestamp"].replace("Z", "+00:00")
-                ).timestamp()
-                * 1000
-            ),
+            "exchTimestamp": book.timestamp,
             "localTimestamp": int(time.time() * 1000),
-            "price": data["data"][0]["price"],
-            "quantity": data["data"][0]["qty"],
-            "side": data["data"][0]["side"],
-            "tradeId": data["data"][0]["trade_id"],
-        }
\ No newline at end of file
+            "bids": book.bids(),
+            "asks": book.asks(),
+            **book.get_metrics(book.depth),
+        }
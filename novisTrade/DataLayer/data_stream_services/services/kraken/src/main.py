@@ -3,8 +3,13 @@ import asyncio
 import logging
 
 from shared.utils import map_logging_level
+from shared.core.buffers import parse_stream_policies
+from shared.core.supervisor import Supervisor
+from shared.core.transport import TransportProfile, parse_compression, run
 from kraken_ws import KrakenWebSocket
 
+USE_UVLOOP = os.getenv("UVLOOP", "false").lower() == "true"
+
 def init_logger(logging_level: int):
     # 設定 root logger
     root_logger = logging.getLogger()
@@ -24,12 +29,52 @@ def init_logger(logging_level: int):
     logger.setLevel(logging_level)
     return logger
 
-async def main():
+async def main(worker_id=None):
     redis_host = os.getenv("REDIS_HOST", "localhost")
     redis_port = int(os.getenv("REDIS_PORT", 6379))
     redis_db = int(os.getenv("REDIS_DB", 0))
     logging_level = os.getenv("LOGGING_LEVEL", "INFO")
+    publish_max_batch_size = int(os.getenv("PUBLISH_MAX_BATCH_SIZE", 500))
+    publish_max_linger_us = int(os.getenv("PUBLISH_MAX_LINGER_US", 1000))
+    json_codec = os.getenv("JSON_CODEC", "auto")
+    max_streams_per_connection = int(os.getenv("MAX_STREAMS_PER_CONNECTION", 200))
+    max_load_per_connection = os.getenv("MAX_LOAD_PER_CONNECTION")
+    hot_swap = os.getenv("HOT_SWAP", "true").lower() == "true"
+    # 交易所大約 24 小時會強制斷線，預設提前在 23 小時主動輪替
+    max_connection_age = float(os.getenv("MAX_CONNECTION_AGE", 23 * 60 * 60))
+    inbound_queue_size = int(os.getenv("INBOUND_QUEUE_SIZE", 10_000))
+    publish_max_pending = int(os.getenv("PUBLISH_MAX_PENDING", 100_000))
+    stream_policies = parse_stream_policies(os.getenv("STREAM_POLICIES"))
+    redis_sink = os.getenv("REDIS_SINK", "pubsub")
+    stream_maxlen = int(os.getenv("STREAM_MAXLEN", 100_000))
+    metrics_port = int(os.getenv("METRICS_PORT", 0))
+    metrics_redis_interval = float(os.getenv("METRICS_REDIS_INTERVAL", 10))
+    bar_close_delay_ms = int(os.getenv("BAR_CLOSE_DELAY_MS", 250))
+    recent_cache_size = int(os.getenv("RECENT_CACHE_SIZE", 100))
+    compression, compression_overrides = parse_compression(os.getenv("WS_COMPRESSION"))
+    transport = TransportProfile(
+        use_uvloop=USE_UVLOOP,
+        compression=compression,
+        compression_overrides=compression_overrides,
+        tcp_nodelay=os.getenv("TCP_NODELAY", "true").lower() == "true",
+        rcvbuf=int(os.getenv("SOCKET_RCVBUF", 0)) or None,
+        max_queue=int(os.getenv("WS_MAX_QUEUE", 16)),
+        max_size=int(os.getenv("WS_MAX_SIZE", 2 ** 20)),
+    )
+    book_depth = int(os.getenv("BOOK_DEPTH", 10))
+    book_publish_interval_ms = int(os.getenv("BOOK_PUBLISH_INTERVAL_MS", 100))
 
+    # 設定 ARCHIVE_DIR 時，送出的資料也會寫進本地的 zstd segment 檔
+    archive_dir = os.getenv("ARCHIVE_DIR") or None
+    archive_rotate_seconds = float(os.getenv("ARCHIVE_ROTATE_SECONDS", 3600))
+    archive_rotate_bytes = int(float(os.getenv("ARCHIVE_ROTATE_MB", 256)) * 2 ** 20)
+    archive_compression_level = int(os.getenv("ARCHIVE_ZSTD_LEVEL", 3))
+    control_coalesce_ms = float(os.getenv("CONTROL_COALESCE_MS", 20))
+    subscription_registry = os.getenv("SUBSCRIPTION_REGISTRY", "true").lower() == "true"
+    restore_concurrency = int(os.getenv("RESTORE_CONCURRENCY", 8))
+    max_concurrent_reconnects = int(os.getenv("MAX_CONCURRENT_RECONNECTS", 4))
+    reconnect_backoff_base = float(os.getenv("RECONNECT_BACKOFF_BASE", 0.5))
+    reconnect_backoff_max = float(os.getenv("RECONNECT_BACKOFF_MAX", 30))
     logger = init_logger(map_logging_level(logging_level))
 
     logger.debug("Starting Kraken WebSocket client...")
@@ -37,11 +82,66 @@ async def main():
         redis_host=redis_host,
         redis_port=redis_port,
         redis_db=redis_db,
+        publish_max_batch_size=publish_max_batch_size,
+        publish_max_linger_us=publish_max_linger_us,
+        json_codec=json_codec,
+        max_streams_per_connection=max_streams_per_connection,
+        max_load_per_connection=float(max_load_per_connection) if max_load_per_connection else None,
+        hot_swap=hot_swap,
+        max_connection_age=max_connection_age or None,
+        inbound_queue_size=inbound_queue_size,
+        publish_max_pending=publish_max_pending,
+        stream_policies=stream_policies,
+        redis_sink=redis_sink,
+        stream_maxlen=stream_maxlen,
+        # 多行程模式下每個 worker 使用不同的埠號
+        metrics_port=metrics_port + (worker_id or 0) if metrics_port else None,
+        metrics_redis_interval=metrics_redis_interval,
+        bar_close_delay_ms=bar_close_delay_ms,
+        recent_cache_size=recent_cache_size,
+        worker_id=worker_id,
+        transport=transport,
+        archive_dir=archive_dir,
+        archive_rotate_seconds=archive_rotate_seconds,
+        archive_rotate_bytes=archive_rotate_bytes,
+        archive_compression_level=archive_compression_level,
+        control_coalesce_ms=control_coalesce_ms,
+        subscription_registry=subscription_registry,
+        restore_concurrency=restore_concurrency,
+        max_concurrent_reconnects=max_concurrent_reconnects,
+        reconnect_backoff_base=reconnect_backoff_base,
+        reconnect_backoff_max=reconnect_backoff_max,
+        book_depth=book_depth,
+        book_publish_interval_ms=book_publish_interval_ms,
     )
 
     await ws_client.start()
 
 
-if __name__ == "__main__":
-    asyncio.run(main())
+def run_worker(worker_id: int):
+    """多行程模式下每個 worker process 的進入點"""
+    run(main(worker_id), use_uvloop=USE_UVLOOP)
 
+async def supervise(workers: int):
+    redis_host = os.getenv("REDIS_HOST", "localhost")
+    redis_port = int(os.getenv("REDIS_PORT", 6379))
+    redis_db = int(os.getenv("REDIS_DB", 0))
+    init_logger(map_logging_level(os.getenv("LOGGING_LEVEL", "INFO")))
+
+    supervisor = Supervisor(
+        "kraken",
+        workers,
+        run_worker,
+        redis_url=f"redis://{redis_host}:{redis_port}/{redis_db}",
+        subscription_registry=os.getenv("SUBSCRIPTION_REGISTRY", "true").lower() == "true",
+    )
+    await supervisor.run()
+
+
+if __name__ == "__main__":
+    # WORKERS 大於 1 時，由 supervisor 啟動多個 worker process，依照交易對分攤訂閱
+    workers = int(os.getenv("WORKERS", 1))
+    if workers > 1:
+        asyncio.run(supervise(workers))
+    else:
+        run(main(), use_uvloop=USE_UVLOOP)
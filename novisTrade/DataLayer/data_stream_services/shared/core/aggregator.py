@@ -0,0 +1,181 @@
+import time
+import logging
+
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+BAR_PREFIX = "bar_"
+
+# K 棒狀態在 array 中的位置
+OPEN, HIGH, LOW, CLOSE, VOLUME, QUOTE_VOLUME, BUY_VOLUME, SELL_VOLUME, TRADES = range(9)
+
+_UNITS_MS = {"s": 1000, "m": 60_000, "h": 3_600_000}
+
+
+def parse_interval(interval: str) -> int:
+    """把 "1s"、"5m"、"1h" 轉換成毫秒"""
+    unit = interval[-1:]
+    if unit not in _UNITS_MS or not interval[:-1].isdigit() or int(interval[:-1]) <= 0:
+        raise ValueError(f"Invalid bar interval: {interval}")
+    return int(interval[:-1]) * _UNITS_MS[unit]
+
+
+def get_bar_topic(source_topic: str, interval: str) -> str:
+    """binance:spot:btcusdt:aggTrade -> binance:spot:btcusdt:bar_1s"""
+    return f"{source_topic.rsplit(':', 1)[0]}:{BAR_PREFIX}{interval}"
+
+
+class BarState:
+    """一根正在累積的 K 棒，數值放在 array 中避免每筆成交建立物件"""
+    __slots__ = ("topic", "interval", "interval_ms", "start", "closed_until", "values")
+
+    def __init__(self, topic: str, interval: str, interval_ms: int):
+        self.topic = topic
+        self.interval = interval
+        self.interval_ms = interval_ms
+        self.start = -1
+        # 已經由 flush_due 送出的最後一根的結束時間，比這更早的成交不會再開新的一根
+        self.closed_until = -1
+        self.values = array("d", bytes(8 * 9))
+
+    def reset(self, start: int, price: float) -> None:
+        values = self.values
+        self.start = start
+        values[OPEN] = values[HIGH] = values[LOW] = values[CLOSE] = price
+        values[VOLUME] = values[QUOTE_VOLUME] = values[BUY_VOLUME] = values[SELL_VOLUME] = 0.0
+        values[TRADES] = 0.0
+
+    def add(self, price: float, quantity: float, is_buy: bool) -> None:
+        values = self.values
+        if price > values[HIGH]:
+            values[HIGH] = price
+        if price < values[LOW]:
+            values[LOW] = price
+        values[CLOSE] = price
+        values[VOLUME] += quantity
+        values[QUOTE_VOLUME] += price * quantity
+        if is_buy:
+            values[BUY_VOLUME] += quantity
+        else:
+            values[SELL_VOLUME] += quantity
+        values[TRADES] += 1
+
+    def to_record(self) -> dict:
+        values = self.values
+        volume = values[VOLUME]
+        return {
+            "topic": self.topic,
+            "interval": self.interval,
+            "startTimestamp": self.start,
+            "endTimestamp": self.start + self.interval_ms,
+            "localTimestamp": int(time.time() * 1000),
+            "open": values[OPEN],
+            "high": values[HIGH],
+            "low": values[LOW],
+            "close": values[CLOSE],
+            "volume": volume,
+            "quoteVolume": values[QUOTE_VOLUME],
+            "vwap": values[QUOTE_VOLUME] / volume if volume else values[CLOSE],
+            "trades": int(values[TRADES]),
+            "buyVolume": values[BUY_VOLUME],
+            "sellVolume": values[SELL_VOLUME],
+        }
+
+
+class BarAggregator:
+    """
+    把整理好的成交聚合成固定週期的 K 棒（OHLCV、VWAP、成交筆數、主動買賣量），
+    發佈在 {exchange}:{market_type}:{symbol}:bar_{interval} 上。
+
+    K 棒依照 exchTimestamp 分段，下一個週期的成交進來時送出上一根；
+    沒有新成交的交易對則由 flush_due() 在週期結束 close_delay_ms 之後送出。
+    沒有成交的週期不會產生 K 棒。
+    已經由 flush_due() 送出的週期不會再送第二次，之後才到的成交只計入 late_trades。
+    """
+    def __init__(self, close_delay_ms: int = 250):
+        self.close_delay_ms = close_delay_ms
+        # 成交的 topic -> 這個 topic 上所有週期的 K 棒
+        self._bars: Dict[str, List[BarState]] = {}
+        # (成交的 topic, 週期) -> 訂閱數
+        self._refcounts: Dict[Tuple[str, str], int] = {}
+        # 所屬的 K 棒已經送出、因此被略過的成交數
+        self.late_trades = 0
+
+    @property
+    def active(self) -> bool:
+        return bool(self._bars)
+
+    def add(self, source_topic: str, interval: str) -> None:
+        """開始聚合某個成交 topic 的某個週期，重複加入只會增加訂閱數"""
+        interval_ms = parse_interval(interval)
+        key = (source_topic, interval)
+        self._refcounts[key] = self._refcounts.get(key, 0) + 1
+        if self._refcounts[key] > 1:
+            return
+
+        bar_topic = get_bar_topic(source_topic, interval)
+        self._bars.setdefault(source_topic, []).append(BarState(bar_topic, interval, interval_ms))
+        logger.info(f"Aggregating {source_topic} into {bar_topic}")
+
+    def remove(self, source_topic: str, interval: str) -> None:
+        """減少訂閱數，沒有人訂閱時停止聚合"""
+        key = (source_topic, interval)
+        count = self._refcounts.get(key, 0) - 1
+        if count > 0:
+            self._refcounts[key] = count
+            return
+        self._refcounts.pop(key, None)
+
+        bars = [bar for bar in self._bars.get(source_topic, []) if bar.interval != interval]
+        if bars:
+            self._bars[source_topic] = bars
+        else:
+            self._bars.pop(source_topic, None)
+
+    def update(self, source_topic: str, record: dict) -> List[Tuple[str, dict]]:
+        """加入一筆成交，回傳因此結束的 K 棒"""
+        bars = self._bars.get(source_topic)
+        if not bars:
+            return []
+
+        timestamp = record["exchTimestamp"]
+        price = float(record["price"])
+        quantity = float(record["quantity"])
+        is_buy = record["side"] == "buy"
+
+        completed = []
+        for bar in bars:
+            start = timestamp - timestamp % bar.interval_ms
+            if bar.start < 0:
+                if start < bar.closed_until:
+                    self.late_trades += 1
+                    continue
+                bar.reset(start, price)
+            elif start > bar.start:
+                if bar.values[TRADES]:
+                    completed.append((bar.topic, bar.to_record()))
+                bar.reset(start, price)
+            # 比目前這根還早的成交（例如重連時晚到的）併入目前這根，避免遺失成交量
+            bar.add(price, quantity, is_buy)
+        return completed
+
+    def flush_due(self, now_ms: Optional[int] = None) -> List[Tuple[str, dict]]:
+        """送出週期已經結束但還沒有被下一筆成交推出去的 K 棒"""
+        if now_ms is None:
+            now_ms = int(time.time() * 1000)
+
+        completed = []
+        for bars in self._bars.values():
+            for bar in bars:
+                if (
+                    bar.start >= 0
+                    and bar.values[TRADES]
+                    and now_ms >= bar.start + bar.interval_ms + self.close_delay_ms
+                ):
+                    completed.append((bar.topic, bar.to_record()))
+                    # 下一筆成交會開始新的一根，但不能早於剛送出的這根
+                    bar.closed_until = bar.start + bar.interval_ms
+                    bar.start = -1
+        return completed
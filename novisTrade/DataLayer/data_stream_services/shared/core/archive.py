@@ -0,0 +1,273 @@
+import os
+import time
+import struct
+import logging
+import threading
+
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SEGMENT_MAGIC = b"NVSG"
+SEGMENT_VERSION = 1
+SEGMENT_SUFFIX = ".seg"
+# 寫入中的 segment，關閉後才改名成 .seg
+OPEN_SUFFIX = ".seg.open"
+COMPRESSION_NONE = 0
+COMPRESSION_ZSTD = 1
+
+# magic, version, compression
+_SEGMENT_HEADER = struct.Struct("<4sBB")
+# 每個 block 的長度
+_BLOCK_HEADER = struct.Struct("<I")
+# 每筆紀錄的 topic 長度和 payload 長度
+_RECORD_HEADER = struct.Struct("<HI")
+
+
+@dataclass
+class ArchiveStats:
+    records: int = 0
+    blocks: int = 0
+    segments: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    # 暫存超過 max_pending 而丟掉的筆數
+    dropped: int = 0
+    errors: int = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "records": self.records,
+            "blocks": self.blocks,
+            "segments": self.segments,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "compression_ratio": self.bytes_in / self.bytes_out if self.bytes_out else 0.0,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+
+def encode_block(records: Iterable[Tuple[str, bytes]]) -> bytes:
+    """把多筆 (topic, payload) 接成一個未壓縮的 block"""
+    pack = _RECORD_HEADER.pack
+    parts = []
+    for topic, payload in records:
+        topic_bytes = topic.encode()
+        parts.append(pack(len(topic_bytes), len(payload)))
+        parts.append(topic_bytes)
+        parts.append(payload)
+    return b"".join(parts)
+
+
+def decode_block(block: bytes) -> Iterator[Tuple[str, bytes]]:
+    view = memoryview(block)
+    unpack = _RECORD_HEADER.unpack_from
+    header_size = _RECORD_HEADER.size
+    position = 0
+    while position < len(view):
+        topic_length, payload_length = unpack(view, position)
+        position += header_size
+        topic = bytes(view[position:position + topic_length]).decode()
+        position += topic_length
+        yield topic, bytes(view[position:position + payload_length])
+        position += payload_length
+
+
+class ArchiveWriter:
+    """
+    把送出的市場數據原封不動寫進本地的 segment 檔，不經過 Redis，Redis 斷線或消費者太慢都不會漏資料。
+
+    event loop 只把 (topic, payload) 放進暫存清單，由背景 thread 每 flush_interval 秒取走一批，
+    編碼成一個 block、以 zstd 壓縮後寫入。segment 的格式：
+
+        header: magic "NVSG" | version (u8) | compression (u8)
+        block:  長度 (u32) | 壓縮後的資料
+        解壓後的 block: 重複的 topic 長度 (u16) | payload 長度 (u32) | topic | payload
+
+    segment 依時間（對齊 rotate_seconds 的整數倍）或大小輪替，寫入中的檔名結尾為 .seg.open，
+    關閉後改名成 .seg。程序中途結束時，讀取端會忽略最後不完整的 block。
+    暫存超過 max_pending 筆時直接丟棄並計數，不會擋住 event loop。
+    沒有安裝 zstandard 時退回不壓縮。
+    """
+    def __init__(
+        self,
+        directory: str,
+        prefix: str,
+        rotate_seconds: float = 3600,
+        rotate_bytes: int = 256 * 2 ** 20,
+        compression_level: int = 3,
+        flush_interval: float = 0.5,
+        max_pending: int = 1_000_000,
+    ):
+        self.directory = directory
+        self.prefix = prefix
+        self.rotate_seconds = rotate_seconds
+        self.rotate_bytes = rotate_bytes
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.stats = ArchiveStats()
+
+        if zstandard is None:
+            logger.warning("zstandard is not installed, archive segments will not be compressed")
+            self.compression = COMPRESSION_NONE
+            self._compressor = None
+        else:
+            self.compression = COMPRESSION_ZSTD
+            self._compressor = zstandard.ZstdCompressor(level=compression_level)
+
+        self._pending: List[Tuple[str, bytes]] = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._file: Optional[BinaryIO] = None
+        self._path: Optional[str] = None
+        self._segment_size = 0
+        self._rotate_at = 0.0
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def start(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name=f"archive-{self.prefix}", daemon=True)
+        self._thread.start()
+
+    def write(self, topic: str, payload: bytes) -> None:
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.stats.dropped += 1
+                return
+            self._pending.append((topic, payload))
+
+    def write_batch(self, items: List[Tuple[str, bytes]]) -> None:
+        with self._lock:
+            room = self.max_pending - len(self._pending)
+            if room < len(items):
+                self.stats.dropped += len(items) - max(room, 0)
+                items = items[:max(room, 0)]
+            self._pending.extend(items)
+
+    def close(self) -> None:
+        """停止背景 thread，寫完剩下的資料並關閉目前的 segment（會阻塞，請在 thread 中呼叫）"""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self._flush()
+        self._close_segment()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self._flush()
+            except Exception as e:
+                self.stats.errors += 1
+                logger.error(f"Error writing archive: {e}")
+
+    def _flush(self) -> None:
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            # 沒有資料時也要依時間輪替，讓已經結束的時段可以被讀取
+            if self._file and time.time() >= self._rotate_at:
+                self._close_segment()
+            return
+
+        block = encode_block(batch)
+        data = self._compressor.compress(block) if self._compressor else block
+        if self._file is None or time.time() >= self._rotate_at or self._segment_size >= self.rotate_bytes:
+            self._open_segment()
+        self._file.write(_BLOCK_HEADER.pack(len(data)))
+        self._file.write(data)
+        self._file.flush()
+
+        self._segment_size += _BLOCK_HEADER.size + len(data)
+        self.stats.records += len(batch)
+        self.stats.blocks += 1
+        self.stats.bytes_in += len(block)
+        self.stats.bytes_out += _BLOCK_HEADER.size + len(data)
+
+    def _open_segment(self) -> None:
+        self._close_segment()
+        now = time.time()
+        self._rotate_at = (now // self.rotate_seconds + 1) * self.rotate_seconds
+        name = f"{self.prefix}-{time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))}-{int(now * 1000) % 1000:03d}"
+        self._path = os.path.join(self.directory, name)
+        self._file = open(self._path + OPEN_SUFFIX, "wb")
+        self._file.write(_SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, self.compression))
+        self._segment_size = _SEGMENT_HEADER.size
+        self.stats.segments += 1
+        logger.info(f"Opened archive segment {self._path}{OPEN_SUFFIX}")
+
+    def _close_segment(self) -> None:
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._path + OPEN_SUFFIX, self._path + SEGMENT_SUFFIX)
+        self._file = None
+
+    def get_stats(self) -> dict:
+        return {**self.stats.to_dict(), "pending": self.pending}
+
+
+def read_segment(path: str) -> Iterator[Tuple[str, bytes]]:
+    """逐個 block 讀取一個 segment，產生 (topic, payload)
+
+    也可以讀取寫入中的 .seg.open，最後不完整的 block 會被忽略。
+    """
+    with open(path, "rb") as f:
+        header = f.read(_SEGMENT_HEADER.size)
+        if len(header) < _SEGMENT_HEADER.size:
+            return
+        magic, version, compression = _SEGMENT_HEADER.unpack(header)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            raise ValueError(f"Not an archive segment: {path}")
+        if compression == COMPRESSION_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("zstandard is required to read compressed segments")
+            decompress = zstandard.ZstdDecompressor().decompress
+        else:
+            decompress = None
+
+        while True:
+            length_bytes = f.read(_BLOCK_HEADER.size)
+            if len(length_bytes) < _BLOCK_HEADER.size:
+                return
+            (length,) = _BLOCK_HEADER.unpack(length_bytes)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield from decode_block(decompress(data) if decompress else data)
+
+
+def list_segments(directory: str, include_open: bool = False) -> List[str]:
+    """依檔名（也就是開始時間）排序的 segment 路徑"""
+    suffixes = (SEGMENT_SUFFIX, OPEN_SUFFIX) if include_open else (SEGMENT_SUFFIX,)
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(suffixes)
+    )
+
+
+def iter_archive(
+    directory: str,
+    topics: Optional[Iterable[str]] = None,
+    include_open: bool = False,
+) -> Iterator[Tuple[str, bytes]]:
+    """依序讀取目錄下所有 segment，topics 不為 None 時只產生這些 topic 的紀錄"""
+    topics = set(topics) if topics is not None else None
+    for path in list_segments(directory, include_open):
+        for topic, payload in read_segment(path):
+            if topics is None or topic in topics:
+                yield topic, payload
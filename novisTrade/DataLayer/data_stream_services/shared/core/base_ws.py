@@ -1,13 +1,27 @@
 import json
+import time
 import asyncio
 import logging
 
 from redis.asyncio import Redis
-from typing import List, Dict, Set
+from typing import List, Dict, Set, Optional, Tuple
 from collections import defaultdict
 from abc import ABC, abstractmethod
 
 from .ws_manager import WebSocketManager
+from .publisher import RedisPublisher
+from .codec import get_codec
+from .sharding import ShardManager
+from .dedupe import TradeDeduplicator
+from .buffers import OverflowPolicy
+from .sinks import get_sink
+from .metrics import MetricsRegistry
+from .cache import RecentCache
+from .transport import TransportProfile
+from .aggregator import BAR_PREFIX, BarAggregator, parse_interval
+from .archive import ArchiveWriter
+from .control import CONTROL_ACTIONS, ControlBatcher, ControlCommand, get_ack_channel
+from .registry import SubscriptionRegistry, get_registry_key, group_by_level
 
 logger = logging.getLogger(__name__)
 
@@ -17,40 +31,166 @@ class ExchangeWebSocket(ABC):
     - 定義交易所共用的介面和方法
     - 使用 WebSocketManager 來管理連線
     - 提供訂閱、取消訂閱等共用功能
-    
-    TODO:
-    - _handle_delay: 利用 heartbeat 來統計延遲的 callback 介面
-    - parse_subscription_message: 把通用格式轉換成交易所的指定格式
+    - 透過 ShardManager 把 stream 分散到多條連線
+    - 透過 MetricsRegistry 記錄每個 topic 和每條連線的延遲與吞吐量
+    - 透過 BarAggregator 把成交聚合成 K 棒，發佈在 bar_{interval} 的 topic 上
+    - 透過 RecentCache 保留每個 topic 的最新值和最近幾筆，讓消費者啟動時就有資料
+    - 透過 ArchiveWriter 把送出的資料同時寫進本地壓縮檔，不依賴 Redis 和 collector
     """
+    # K 棒由哪一種成交 stream 聚合而來
+    BAR_SOURCE_STREAM = "trade"
+    # 一則訂閱訊息最多帶幾個 stream，None 代表沒有限制
+    MAX_STREAMS_PER_REQUEST: Optional[int] = None
+    
     def __init__(
         self,
         redis_host: str = "localhost",
         redis_port: int = 6379,
         redis_db: int = 0,
+        publish_max_batch_size: int = 500,
+        publish_max_linger_us: int = 1000,
+        json_codec: str = "auto",
+        max_streams_per_connection: int = 200,
+        max_load_per_connection: Optional[float] = None,
+        stream_weights: Optional[Dict[str, float]] = None,
+        hot_swap: bool = True,
+        max_connection_age: Optional[float] = None,
+        inbound_queue_size: int = 10_000,
+        publish_max_pending: int = 100_000,
+        stream_policies: Optional[Dict[str, OverflowPolicy]] = None,
+        redis_sink: str = "pubsub",
+        stream_maxlen: int = 100_000,
+        metrics_port: Optional[int] = None,
+        metrics_redis_interval: float = 10.0,
+        bar_close_delay_ms: int = 250,
+        recent_cache_size: int = 100,
+        worker_id: Optional[int] = None,
+        transport: Optional[TransportProfile] = None,
+        archive_dir: Optional[str] = None,
+        archive_rotate_seconds: float = 3600,
+        archive_rotate_bytes: int = 256 * 2 ** 20,
+        archive_compression_level: int = 3,
+        control_coalesce_ms: float = 20,
+        subscription_registry: bool = True,
+        restore_concurrency: int = 8,
+        max_concurrent_reconnects: int = 4,
+        reconnect_backoff_base: float = 0.5,
+        reconnect_backoff_max: float = 30.0,
     ):
-        self.ws_manager = WebSocketManager()
+        self.ws_manager = WebSocketManager(
+            hot_swap=hot_swap,
+            max_connection_age=max_connection_age,
+            max_queue_size=inbound_queue_size,
+            transport=transport,
+            max_concurrent_reconnects=max_concurrent_reconnects,
+            reconnect_backoff_base=reconnect_backoff_base,
+            reconnect_backoff_max=reconnect_backoff_max,
+        )
+        # hot swap 和搬移 stream 時新舊連線會重疊，用成交編號去重
+        self.deduplicator = TradeDeduplicator()
+        self.shards = ShardManager(
+            max_streams_per_connection=max_streams_per_connection,
+            max_load_per_connection=max_load_per_connection,
+            stream_weights=stream_weights,
+        )
+        # connection_id -> (網址, 網址上帶有而且還沒取消訂閱的 stream)
+        self._url_streams: Dict[str, Tuple[str, Set[str]]] = {}
+        self.codec = get_codec(json_codec)
+        logger.debug(f"Using JSON codec: {self.codec.name}")
         self.subscriptions = defaultdict(lambda: defaultdict(int))
         
+        self.metrics = MetricsRegistry(self.exchange_name)
+        self.metrics_port = metrics_port
+        self.metrics_redis_interval = metrics_redis_interval
+        self.ws_manager.metrics = self.metrics
+        # 大量斷線時，過去訊息最多的連線先重新交握
+        self.ws_manager.scheduler.priority = self._connection_traffic
+        
+        # 只有在有人訂閱 bar_{interval} 時才會聚合
+        self.aggregator = BarAggregator(close_delay_ms=bar_close_delay_ms)
+        self._bar_task: Optional[asyncio.Task] = None
+        
         self.redis_url = f"redis://{redis_host}:{redis_port}/{redis_db}"
+        # 多行程模式下每個 worker 監聽自己的控制頻道，由 Supervisor 轉送指令
+        self.worker_id = worker_id
+        if worker_id is None:
+            self.control_channel = f"{self.exchange_name}:control"
+            self.metrics_key = f"{self.exchange_name}:metrics"
+        else:
+            self.control_channel = f"{self.exchange_name}:control:{worker_id}"
+            self.metrics_key = f"{self.exchange_name}:metrics:{worker_id}"
+        self.publish_max_batch_size = publish_max_batch_size
+        self.publish_max_linger_us = publish_max_linger_us
+        self.publish_max_pending = publish_max_pending
+        self.stream_policies = stream_policies
+        # 市場數據的輸出方式：pubsub 為 PUBLISH，stream 為 XADD 到同名的 Redis Stream
+        self.sink = get_sink(redis_sink, stream_maxlen)
+        # 每個 topic 的最新值和最近 recent_cache_size 筆，同步到 {topic}:last 和 {topic}:recent
+        self.cache = RecentCache(recent_cache_size) if recent_cache_size > 0 else None
+        # 設定 archive_dir 時，送出的每一筆資料也會寫進 {archive_dir}/{exchange}-*.seg
+        self.archive = None
+        if archive_dir:
+            prefix = self.exchange_name if worker_id is None else f"{self.exchange_name}-{worker_id}"
+            self.archive = ArchiveWriter(
+                archive_dir,
+                prefix,
+                rotate_seconds=archive_rotate_seconds,
+                rotate_bytes=archive_rotate_bytes,
+                compression_level=archive_compression_level,
+            )
+        # 控制頻道的指令先累積 control_coalesce_ms 再一起處理，結果發佈到 {exchange}:control:ack
+        self.control = ControlBatcher(
+            self.subscribe,
+            self.unsubscribe,
+            on_complete=self._complete_control,
+            window_ms=control_coalesce_ms,
+            get_count=self._get_control_count,
+        )
+        self.ack_channel = get_ack_channel(self.exchange_name)
+        # 訂閱數存到 Redis，重啟後不必等下游重送指令；多行程模式下由 supervisor 負責
+        self.use_registry = subscription_registry and worker_id is None
+        self.registry: Optional[SubscriptionRegistry] = None
+        self.restore_concurrency = restore_concurrency
+        
+    @property
+    def exchange_name(self) -> str:
+        """交易所名稱，例如 BinanceWebSocket -> binance"""
+        return self.__class__.__name__.lower()[:-9]
         
     async def _init_redis(self):
         """初始化 Redis 連接"""
         logger.debug("Initializing Redis connection...")
         
         # 建立非同步的 Redis 連接
+        # 訊息一律以 bytes 收送，由 codec 負責編解碼，避免多一次 str 轉換
         self.redis_producer = await Redis.from_url(
             self.redis_url,
-            decode_responses=True
+            decode_responses=False
         )
         self.redis_subscriber = await Redis.from_url(
             self.redis_url,
-            decode_responses=True
+            decode_responses=False
         )
         self.pubsub = self.redis_subscriber.pubsub()
         
-        channel = f"{self.__class__.__name__.lower()[:-9]}:control"
-        await self.pubsub.subscribe(channel)
-        logger.debug(f"Listening to control channel: {channel}")
+        # 市場數據透過 publisher 批次送出
+        self.publisher = RedisPublisher(
+            self.redis_producer,
+            max_batch_size=self.publish_max_batch_size,
+            max_linger_us=self.publish_max_linger_us,
+            max_pending=self.publish_max_pending,
+            stream_policies=self.stream_policies,
+            sink=self.sink,
+            cache=self.cache,
+        )
+        self.publisher.metrics = self.metrics
+        await self.publisher.start()
+        
+        if self.use_registry:
+            self.registry = SubscriptionRegistry(self.redis_producer, get_registry_key(self.exchange_name))
+        
+        await self.pubsub.subscribe(self.control_channel)
+        logger.debug(f"Listening to control channel: {self.control_channel}")
         
     async def start(self):
         
@@ -60,8 +200,25 @@ class ExchangeWebSocket(ABC):
         # 啟動 WebSocket 管理器
         self.ws_manager.set_message_callback(self._handle_message)
         self.ws_manager.set_reconnect_callback(self._handle_reconnection)
+        self.ws_manager.set_remove_callback(self._handle_connection_removed)
+        self.ws_manager.set_url_callback(self._get_reconnect_url)
         await self.ws_manager.start()
         
+        # 啟動延遲與吞吐量的輸出
+        await self._start_metrics()
+        
+        # 定期送出已經結束但沒有新成交推動的 K 棒
+        self._bar_task = asyncio.create_task(self._bar_loop())
+        
+        if self.archive:
+            self.archive.start()
+        
+        self.control.start()
+        
+        # 先恢復上次的訂閱，這段期間的控制指令會留在 pubsub 中，之後依序處理
+        if self.registry is not None:
+            await self.restore_subscriptions()
+        
         # 啟動 Redis 訊息監聽
         try:
             logger.debug("Starting Redis listener...")
@@ -76,12 +233,62 @@ class ExchangeWebSocket(ABC):
         finally:
             await self.close()
             
+    async def _start_metrics(self):
+        """註冊佇列相關的 gauge，並依照設定啟動 HTTP endpoint 或 Redis hash 輸出"""
+        self.metrics.add_gauge("inbound_queue_size", self.ws_manager.message_queue.qsize)
+        self.metrics.add_gauge("inbound_queue_full_total", lambda: self.ws_manager.queue_full_count)
+        self.metrics.add_gauge("publisher_pending", lambda: self.publisher.pending)
+        self.metrics.add_gauge("publisher_errors_total", lambda: self.publisher.stats.errors)
+        self.metrics.add_gauge("publisher_blocked_total", lambda: sum(self.publisher.stats.blocked.values()))
+        self.metrics.add_gauge("publisher_dropped_total", lambda: sum(self.publisher.stats.dropped.values()))
+        self.metrics.add_gauge("publisher_conflated_total", lambda: sum(self.publisher.stats.conflated.values()))
+        self.metrics.add_gauge("duplicates_total", lambda: self.deduplicator.duplicates)
+        self.metrics.add_gauge("bar_late_trades_total", lambda: self.aggregator.late_trades)
+        self.metrics.add_gauge("control_commands_total", lambda: self.control.stats.commands)
+        self.metrics.add_gauge("control_exchange_calls_total", lambda: self.control.stats.exchange_calls)
+        self.metrics.add_gauge("control_netted_streams_total", lambda: self.control.stats.netted_streams)
+        if self.registry is not None:
+            self.metrics.add_gauge("registry_subscriptions", lambda: len(self.registry))
+        scheduler = self.ws_manager.scheduler
+        self.metrics.add_gauge("reconnect_down_connections", lambda: len(scheduler.down))
+        self.metrics.add_gauge("reconnect_attempts_total", lambda: scheduler.attempts)
+        self.metrics.add_gauge("reconnect_failures_total", lambda: scheduler.failures)
+        self.metrics.add_gauge("reconnect_recoveries_total", lambda: scheduler.recoveries)
+        self.metrics.add_gauge("reconnect_last_recovery_seconds", lambda: scheduler.last_recovery_seconds)
+        self.metrics.add_gauge("reconnect_max_recovery_seconds", lambda: scheduler.max_recovery_seconds)
+        if self.archive:
+            self.metrics.add_gauge("archive_pending", lambda: self.archive.pending)
+            self.metrics.add_gauge("archive_records_total", lambda: self.archive.stats.records)
+            self.metrics.add_gauge("archive_dropped_total", lambda: self.archive.stats.dropped)
+            self.metrics.add_gauge("archive_bytes_total", lambda: self.archive.stats.bytes_out)
+        
+        if self.metrics_port:
+            await self.metrics.start_http_server(port=self.metrics_port)
+        if self.metrics_redis_interval > 0:
+            self.metrics.start_redis_export(
+                self.redis_producer, self.metrics_key, self.metrics_redis_interval
+            )
+            
     async def close(self):
         """關閉 WebSocket 管理器"""
         logger.info("Closing Server...")
+        await self.control.close()
         logger.debug("Closing WebSocket connection...")
         await self.ws_manager.close()
         
+        if self._bar_task:
+            self._bar_task.cancel()
+            await asyncio.gather(self._bar_task, return_exceptions=True)
+        
+        # 送出還在暫存區的訊息
+        logger.debug("Flushing pending messages...")
+        await self.publisher.close()
+        await self.metrics.close()
+        
+        if self.archive:
+            logger.debug("Closing archive...")
+            await asyncio.to_thread(self.archive.close)
+        
         # 關閉 Redis 連接
         logger.debug("Closing Redis connection...")
         await self.pubsub.unsubscribe()
@@ -89,23 +296,322 @@ class ExchangeWebSocket(ABC):
         await self.redis_subscriber.close()
         await self.redis_producer.close()
         
+    async def _publish(self, topic: str, data: dict) -> None:
+        """把整理好的市場數據交給 publisher 批次送到 Redis"""
+        if self.deduplicator.is_duplicate(topic, data):
+            return
+        self._handle_delay(topic, data)
+        payload = self.codec.dumps(data)
+        if self.archive:
+            self.archive.write(topic, payload)
+        await self.publisher.publish(topic, payload)
+        if self.aggregator.active:
+            bars = self.aggregator.update(topic, data)
+            if bars:
+                await self._publish_bars(bars)
+        
+    async def _publish_batch(self, records: List[Tuple[str, dict]]) -> None:
+        """把同一個 frame 拆出來的多筆資料一起交給 publisher，確保在同一個 pipeline 中送出"""
+        dumps = self.codec.dumps
+        aggregating = self.aggregator.active
+        items = []
+        for topic, data in records:
+            if self.deduplicator.is_duplicate(topic, data):
+                continue
+            self._handle_delay(topic, data)
+            items.append((topic, dumps(data)))
+            if aggregating:
+                for bar_topic, bar in self.aggregator.update(topic, data):
+                    self._handle_delay(bar_topic, bar)
+                    items.append((bar_topic, dumps(bar)))
+        if self.archive:
+            self.archive.write_batch(items)
+        await self.publisher.publish_batch(items)
+        
+    async def _publish_bars(self, bars: List[Tuple[str, dict]]) -> None:
+        """送出結束的 K 棒"""
+        dumps = self.codec.dumps
+        items = []
+        for topic, bar in bars:
+            self._handle_delay(topic, bar)
+            items.append((topic, dumps(bar)))
+        if self.archive:
+            self.archive.write_batch(items)
+        await self.publisher.publish_batch(items)
+        
+    async def _bar_loop(self, interval: float = 0.1) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            if not self.aggregator.active:
+                continue
+            try:
+                bars = self.aggregator.flush_due()
+                if bars:
+                    await self._publish_bars(bars)
+            except Exception as e:
+                logger.error(f"Error flushing bars: {str(e)}")
+        
+    def _handle_delay(self, topic: str, data: dict) -> None:
+        """統計交易所時間到本地時間的延遲以及每個 topic 的訊息數"""
+        self.metrics.observe_record(topic, data)
+        
+    def get_buffer_stats(self) -> Dict[str, dict]:
+        """取得接收佇列以及 publisher 暫存區的統計（等待、丟棄、取代次數）"""
+        return {
+            "inbound": self.ws_manager.get_queue_stats(),
+            "publisher": self.publisher.get_stats(),
+            "deduplicator": self.deduplicator.get_stats(),
+            "archive": self.archive.get_stats() if self.archive else None,
+            "control": self.control.get_stats(),
+            "reconnect": self.ws_manager.scheduler.get_stats(),
+        }
+        
     @abstractmethod
-    async def _handle_message(self, connection_id: str, message: str):
+    async def _handle_message(self, connection_id: str, message: bytes):
         raise NotImplementedError
     
-    @abstractmethod
     async def _handle_reconnection(self, connection_id: str):
+        """重新連線後，只恢復這條連線負責的 stream
+        
+        依照 stream type 分組，流量越大的組和 stream 越先送出，
+        再由 _send_stream_request 依照 MAX_STREAMS_PER_REQUEST 分段。
+        """
+        market_type = connection_id.split(":")[0]
+        # 新的網址是依照目前的訂閱產生的，之前取消訂閱的紀錄不再適用
+        self._url_streams.pop(connection_id, None)
+        included = self._get_active_url_streams(connection_id)
+        streams = [stream for stream in self.shards.streams_for(connection_id) if stream not in included]
+        if not streams:
+            return
+
+        try:
+            await self._send_stream_request(
+                connection_id, "subscribe", self._order_by_traffic(streams, market_type),
+                market_type, int(time.time() * 1000)
+            )
+            logger.info(f"Restore {len(streams)} subscriptions for {connection_id}")
+        except Exception as e:
+            logger.error(f"Failed to restore subscriptions for {connection_id}: {str(e)}")
+    
+    async def _handle_connection_removed(self, connection_id: str):
+        """連線被移除後，把分配紀錄中還留在這條連線上的 stream 釋放掉，還有人訂閱的重新分配到其他連線
+        
+        主動關閉的空連線已經沒有分配紀錄，不會有任何動作；ws_manager 因為發送或接收錯誤移除連線時，
+        這裡會把 stream 接回來。還沒完成訂閱（訂閱數為零）的 stream 只釋放，由 subscribe 自己回報失敗。
+        """
+        market_type = connection_id.split(":")[0]
+        self._url_streams.pop(connection_id, None)
+        streams = self.shards.streams_for(connection_id)
+        if not streams:
+            return
+        self.shards.release(market_type, streams)
+        await self._close_empty_shards(market_type)
+        live = [stream for stream in streams if self.get_sub_count(stream, market_type) > 0]
+        if not live:
+            return
+        
+        logger.warning(f"Connection {connection_id} was dropped, moving {len(live)} streams to other connections")
+        placement = self.shards.assign(market_type, live)
+        try:
+            for target_id, target_streams in placement.items():
+                remaining = await self._ensure_connection(target_id, market_type, target_streams)
+                if remaining:
+                    await self._send_stream_request(
+                        target_id, "subscribe", self._order_by_traffic(remaining, market_type),
+                        market_type, int(time.time() * 1000)
+                    )
+        except Exception as e:
+            logger.error(f"Failed to move streams from dropped connection {connection_id}: {str(e)}")
+    
+    def _get_reconnect_url(self, connection_id: str) -> str:
+        """重連時依照連線目前負責的 stream 重新產生網址，流量大的 stream 優先放進網址"""
+        market_type = connection_id.split(":")[0]
+        streams = self._order_by_traffic(self.shards.streams_for(connection_id), market_type)
+        return self._get_connection_url(market_type, streams)
+    
+    def _stream_traffic(self, stream: str, market_type: str) -> int:
+        """stream 到目前為止送出的訊息數，沒有紀錄時為 0"""
+        symbol, stream_type = stream.split("@", 1)
+        metrics = self.metrics.topics.get(self._get_topic_name(symbol, stream_type, market_type))
+        return metrics.messages if metrics else 0
+    
+    def _order_by_traffic(self, streams: List[str], market_type: str) -> List[str]:
+        """同一種 stream type 排在一起，組和組內都依照訊息數由多到少排序"""
+        traffic = {stream: self._stream_traffic(stream, market_type) for stream in streams}
+        groups: Dict[str, List[str]] = defaultdict(list)
+        for stream in streams:
+            groups[stream.split("@", 1)[1]].append(stream)
+        ordered = []
+        for group in sorted(groups.values(), key=lambda group: -sum(traffic[stream] for stream in group)):
+            ordered.extend(sorted(group, key=lambda stream: -traffic[stream]))
+        return ordered
+    
+    def _connection_traffic(self, connection_id: str) -> float:
+        """連線到目前為止收到的訊息數，作為重連的優先權"""
+        metrics = self.metrics.connections.get(connection_id)
+        return metrics.messages if metrics else 0
+    
+    @abstractmethod
+    def _get_topic_name(self, symbol: str, stream_type: str, market_type: str = "spot") -> str:
         raise NotImplementedError
     
     @abstractmethod
+    def _get_base_url(self, market_type: str = "spot") -> str:
+        raise NotImplementedError
+    
+    @abstractmethod
+    def parse_subscription_message(
+        self,
+        method: str,
+        streams: List[str],
+        market_type: str = "spot",
+        request_id: Optional[int] = None,
+    ) -> List[dict]:
+        """把通用的 stream 格式 ("{symbol}@{stream_type}") 轉換成交易所的訂閱訊息
+        
+        method 為 "subscribe" 或 "unsubscribe"，回傳要依序送出的訊息。
+        """
+        raise NotImplementedError
+    
+    def _get_connection_url(self, market_type: str, streams: List[str]) -> str:
+        """建立連線時使用的網址，交易所支援時可以把 streams 直接帶在網址上，預設為 _get_base_url"""
+        return self._get_base_url(market_type)
+    
+    def _get_url_streams(self, url: str) -> Set[str]:
+        """網址上已經帶有、連上之後就會收到資料的 stream"""
+        return set()
+    
+    def _get_active_url_streams(self, connection_id: str) -> Set[str]:
+        """連線網址上帶有、之後也沒有取消訂閱過的 stream，這些 stream 不需要再送訂閱訊息
+        
+        取消訂閱之後網址不會變，所以另外記錄；網址換過（新連線或重連）時重新從網址計算。
+        """
+        conn = self.ws_manager.connections.get(connection_id)
+        if conn is None:
+            return set()
+        entry = self._url_streams.get(connection_id)
+        if entry is None or entry[0] != conn.uri:
+            entry = self._url_streams[connection_id] = (conn.uri, self._get_url_streams(conn.uri))
+        return entry[1]
+    
+    async def _ensure_connection(
+        self, connection_id: str, market_type: str, streams: Optional[List[str]] = None
+    ) -> List[str]:
+        """如果連線還沒建立，就建立連線，回傳還需要送出訂閱訊息的 stream"""
+        streams = streams or []
+        if connection_id not in self.ws_manager.connections:
+            url = self._get_connection_url(market_type, streams)
+            await self.ws_manager.add_connection(url, connection_id)
+        # 同時有其他訂閱先建立了這條連線時，網址可能不同，以實際的網址為準
+        included = self._get_active_url_streams(connection_id)
+        return [stream for stream in streams if stream not in included]
+    
+    async def _send_stream_request(
+        self,
+        connection_id: str,
+        method: str,
+        streams: List[str],
+        market_type: str,
+        request_id: Optional[int] = None,
+    ) -> None:
+        """在指定的連線上訂閱或取消訂閱 stream，超過 MAX_STREAMS_PER_REQUEST 時分成多則訊息"""
+        if method == "unsubscribe":
+            # 取消之後再訂閱時，不能因為還在網址上就略過訂閱訊息
+            self._get_active_url_streams(connection_id).difference_update(streams)
+        size = self.MAX_STREAMS_PER_REQUEST or len(streams) or 1
+        for i in range(0, len(streams), size):
+            for message in self.parse_subscription_message(method, streams[i:i + size], market_type, request_id):
+                await self.ws_manager.send_message(connection_id, json.dumps(message))
+    
     async def subscribe(
         self,
         symbols: List[str],
         stream_type: str,
         market_type: str = "spot",
-        request_id: str = "1"
+        request_id: Optional[int] = None,
     ) -> bool:
-        raise NotImplementedError
+        """訂閱指定市場的串流，新的 stream 會依照 ShardManager 分配到各條連線"""
+        if stream_type.startswith(BAR_PREFIX):
+            return await self._subscribe_bars(symbols, stream_type, market_type, request_id)
+        if request_id is None:
+            request_id = int(time.time() * 1000)
+        streams = [f"{symbol}@{stream_type}" for symbol in symbols]
+        
+        # 已經在某條連線上的 stream 不用重複訂閱
+        placement = self.shards.assign(market_type, streams)
+        
+        # 已經送出（或放在連線網址中）的 stream，失敗時要向交易所取消
+        sent: Dict[str, List[str]] = {}
+        try:
+            for connection_id, connection_streams in placement.items():
+                remaining = await self._ensure_connection(connection_id, market_type, connection_streams)
+                sent[connection_id] = connection_streams
+                if not remaining:
+                    continue
+                logger.debug(f"Subscribing to {remaining} on {connection_id}")
+                await self._send_stream_request(
+                    connection_id, "subscribe", remaining, market_type, request_id
+                )
+        except Exception as e:
+            logger.error(f"Subscription failed: {str(e)}")
+            # 取消已經送出的部分，回復分配紀錄，並關掉因為這次訂閱才開的空連線
+            await self._rollback_subscription(sent, market_type, request_id)
+            self.shards.release(
+                market_type, [stream for streams in placement.values() for stream in streams]
+            )
+            await self._close_empty_shards(market_type)
+            return False
+        
+        self.add_subscription(streams, market_type)
+        logger.debug(f"Shards: {self.shards.get_shard_info()}")
+        return True
+    
+    async def _rollback_subscription(
+        self, sent: Dict[str, List[str]], market_type: str, request_id: Optional[int] = None
+    ) -> None:
+        """訂閱失敗時取消已經送出的 stream，這些 stream 是這次才分配的，不會影響其他訂閱"""
+        for connection_id, streams in sent.items():
+            try:
+                await self._send_stream_request(connection_id, "unsubscribe", streams, market_type, request_id)
+            except Exception as e:
+                logger.error(f"Failed to roll back subscription on {connection_id}: {str(e)}")
+    
+    async def restore_subscriptions(self) -> None:
+        """依照 SubscriptionRegistry 恢復上次的訂閱
+        
+        第一層（所有交易對）依照每條連線的上限分段，最多 restore_concurrency 段同時訂閱，
+        各條連線的交握和訂閱訊息可以同時進行；之後的層只增加訂閱數，不會再送出訊息。
+        恢復失敗的訂閱仍然留在 registry 中，下次重啟會再試一次。
+        """
+        try:
+            counts = await self.registry.load()
+        except Exception as e:
+            logger.error(f"Failed to load subscription registry {self.registry.key}: {str(e)}")
+            return
+        if not counts:
+            return
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.restore_concurrency)
+        chunk_size = self.shards.max_streams_per_connection
+        
+        async def restore(symbols: List[str], stream_type: str, market_type: str) -> bool:
+            async with semaphore:
+                return await self.subscribe(symbols, stream_type, market_type)
+        
+        failed = 0
+        for groups in group_by_level(counts):
+            results = await asyncio.gather(*(
+                restore(symbols[i:i + chunk_size], stream_type, market_type)
+                for market_type, stream_type, symbols in groups
+                for i in range(0, len(symbols), chunk_size)
+            ))
+            failed += results.count(False)
+        
+        elapsed = time.perf_counter() - started
+        if failed:
+            logger.error(f"Restored subscriptions with {failed} failed chunks in {elapsed:.2f}s")
+        else:
+            logger.info(f"Restored {len(counts)} subscriptions from {self.registry.key} in {elapsed:.2f}s")
     
     def add_subscription(self, streams: List[str], market_type: str) -> None:
         """紀錄每個 market type 的每個 stream 有多少人訂閱"""
@@ -116,25 +622,130 @@ class ExchangeWebSocket(ABC):
         logger.debug(f"subscriptions after: {dict(self.subscriptions)}")
         return
     
-    @abstractmethod
     async def unsubscribe(
         self,
         symbols: List[str],
         stream_type: str,
         market_type: str = "spot",
-        request_id: str = "1"
+        request_id: Optional[int] = None,
     ) -> bool:
-        raise NotImplementedError
+        """取消訂閱，沒有人訂閱的 stream 才會真的向交易所取消，之後重新平衡各條連線"""
+        if stream_type.startswith(BAR_PREFIX):
+            return await self._unsubscribe_bars(symbols, stream_type, market_type, request_id)
+        if request_id is None:
+            request_id = int(time.time() * 1000)
+        streams = [f"{symbol}@{stream_type}" for symbol in symbols]
+        
+        # 先移除訂閱記錄
+        self.remove_subscription(streams, market_type)
+        removing_streams = [
+            stream for stream in streams if self.get_sub_count(stream, market_type) <= 0
+        ]
+        logger.debug(f"Removing streams: {removing_streams}")
+        
+        # 訂閱數和 registry 一樣不論成功與否都會減少；UNSUBSCRIBE 送不出去時 ws_manager 會關掉那條連線，
+        # 所以釋放的 stream 不會繼續收到資料，訂閱記錄和交易所不會不一致
+        placement = self.shards.release(market_type, removing_streams)
+        
+        try:
+            for connection_id, connection_streams in placement.items():
+                await self._send_stream_request(
+                    connection_id, "unsubscribe", connection_streams, market_type, request_id
+                )
+        except Exception as e:
+            logger.error(f"Unsubscription failed: {str(e)}")
+            return False
+        
+        await self._rebalance(market_type)
+        return True
+    
+    async def _subscribe_bars(
+        self,
+        symbols: List[str],
+        stream_type: str,
+        market_type: str,
+        request_id: Optional[int] = None,
+    ) -> bool:
+        """訂閱 K 棒：先訂閱底層的成交 stream，再開始聚合"""
+        interval = stream_type[len(BAR_PREFIX):]
+        try:
+            parse_interval(interval)
+        except ValueError as e:
+            logger.error(f"Subscription failed: {str(e)}")
+            return False
+        
+        if not await self.subscribe(symbols, self.BAR_SOURCE_STREAM, market_type, request_id):
+            return False
+        for symbol in symbols:
+            source_topic = self._get_topic_name(symbol, self.BAR_SOURCE_STREAM, market_type)
+            self.aggregator.add(source_topic, interval)
+        return True
+    
+    async def _unsubscribe_bars(
+        self,
+        symbols: List[str],
+        stream_type: str,
+        market_type: str,
+        request_id: Optional[int] = None,
+    ) -> bool:
+        """取消訂閱 K 棒，同時減少底層成交 stream 的訂閱數"""
+        interval = stream_type[len(BAR_PREFIX):]
+        for symbol in symbols:
+            source_topic = self._get_topic_name(symbol, self.BAR_SOURCE_STREAM, market_type)
+            self.aggregator.remove(source_topic, interval)
+        return await self.unsubscribe(symbols, self.BAR_SOURCE_STREAM, market_type, request_id)
+    
+    async def _rebalance(self, market_type: str) -> None:
+        """把負載最低的連線合併到其他連線上，並關閉沒有 stream 的連線
+        
+        每一批先在目標連線訂閱，再在來源連線取消訂閱，兩邊都成功才更新分配紀錄，搬移過程中不會漏資料；
+        中途失敗時這一批回復原狀（取消目標連線的訂閱），已經搬完的批次不受影響，stream 不會同時留在兩條連線上。
+        """
+        for source_id, target_id, streams in self.shards.plan_rebalance(market_type):
+            request_id = int(time.time() * 1000)
+            try:
+                await self._send_stream_request(target_id, "subscribe", streams, market_type, request_id)
+            except Exception as e:
+                logger.error(f"Error rebalancing {market_type} shards: {str(e)}")
+                break
+            try:
+                await self._send_stream_request(source_id, "unsubscribe", streams, market_type, request_id)
+            except Exception as e:
+                logger.error(f"Error rebalancing {market_type} shards: {str(e)}")
+                await self._rollback_subscription({target_id: streams}, market_type, request_id)
+                break
+            self.shards.move(market_type, streams, target_id)
+            logger.info(f"Moved {len(streams)} streams from {source_id} to {target_id}")
+        
+        await self._close_empty_shards(market_type)
+    
+    async def _close_empty_shards(self, market_type: str) -> None:
+        for connection_id in self.shards.pop_empty_shards(market_type):
+            self._url_streams.pop(connection_id, None)
+            if connection_id in self.ws_manager.connections:
+                logger.info(f"Closing empty connection {connection_id}")
+                await self.ws_manager.remove_connection(connection_id)
     
     def remove_subscription(self, streams: List[str], market_type: str) -> None:
-        """紀錄每個 market type 的每個 stream 有多少人訂閱"""
+        """紀錄每個 market type 的每個 stream 有多少人訂閱，歸零的 stream 直接移除"""
+        subscriptions = self.subscriptions[market_type]
         for stream in streams:
-            self.subscriptions[market_type][stream] -= 1
+            count = subscriptions.get(stream, 0) - 1
+            if count > 0:
+                subscriptions[stream] = count
+            else:
+                subscriptions.pop(stream, None)
         return
     
     def get_sub_count(self, stream: str, market_type: str) -> int:
         """取得特定 stream 的訂閱數"""
-        return self.subscriptions[market_type][stream]
+        return self.subscriptions[market_type].get(stream, 0)
+    
+    def _get_control_count(self, market_type: str, stream_type: str, symbol: str) -> int:
+        """控制指令合併時使用的目前訂閱數，K 棒算在底層的成交 stream 上"""
+        if stream_type.startswith(BAR_PREFIX):
+            stream_type = self.BAR_SOURCE_STREAM
+        return self.get_sub_count(f"{symbol}@{stream_type}", market_type)
     
     def get_zero_sub_streams(self, market_type: str) -> List[str]:
         """取得沒有訂閱的 stream"""
@@ -157,38 +768,62 @@ class ExchangeWebSocket(ABC):
             # 重試機制
             await asyncio.sleep(1)
             
-    async def _on_redis_message(self, event: str):
-        """處理 Redis 訊息"""
+    async def _on_redis_message(self, event: bytes):
+        """解析控制指令並交給 ControlBatcher，不等待交易所回應，下一個指令可以馬上進到同一批"""
         try:
-            command = json.loads(event)
+            command = self.codec.loads(event)
             action = command.get("action")
             symbols = command.get("symbols")
             stream_type = command.get("streamType")
             market_type = command.get("marketType")
-            request_id = command.get("requestId")
 
-            if action == "subscribe":
-                success = await self.subscribe(
-                    symbols=symbols,
-                    stream_type=stream_type,
-                    market_type=market_type,
-                    request_id=request_id,
-                )
-                logger.info(
-                    f"Subscribe {'success' if success else 'failed'} for {symbols}"
-                )
+            if action not in CONTROL_ACTIONS:
+                logger.error(f"Unknown control action: {action}")
+                return
+            if not symbols or not stream_type or not market_type:
+                logger.error(f"Invalid control command: {command}")
+                return
 
-            elif action == "unsubscribe":
-                success = await self.unsubscribe(
-                    symbols=symbols,
-                    stream_type=stream_type,
-                    market_type=market_type,
-                    request_id=request_id,
-                )
-                logger.info(
-                    f"Unsubscribe {'success' if success else 'failed'} for {symbols}"
-                )
-        except json.JSONDecodeError as e:
+            self.control.submit(ControlCommand(
+                action=action,
+                symbols=symbols,
+                stream_type=stream_type,
+                market_type=market_type,
+                request_id=command.get("requestId"),
+            ))
+        except ValueError as e:
             logger.error(f"Error decoding JSON: {str(e)}")
         except Exception as e:
             logger.error(f"Error handling Redis command: {str(e)}")
+
+    async def _complete_control(self, command: ControlCommand, success: bool) -> None:
+        """更新 registry 並回報一個指令的結果，帶有 requestId 的指令才會發佈到 ack 頻道
+        
+        只依這個指令自己的結果更新：訂閱時只記錄成功的交易對；取消訂閱不論成功與否都會減少，
+        和記憶體中的訂閱數一致。
+        """
+        logger.info(
+            f"{command.action.capitalize()} {'success' if success else 'failed'} for {command.symbols}"
+        )
+        if self.registry is not None:
+            symbols = command.symbols
+            if command.action == "subscribe" and command.failed:
+                symbols = [symbol for symbol in symbols if symbol not in command.failed]
+            if symbols:
+                await self.registry.update(command.action, command.market_type, command.stream_type, symbols)
+        if command.request_id is None:
+            return
+        ack = {
+            "requestId": command.request_id,
+            "action": command.action,
+            "symbols": command.symbols,
+            "streamType": command.stream_type,
+            "marketType": command.market_type,
+            "success": success,
+            "latencyMs": round((time.perf_counter() - command.received_at) * 1000, 3),
+        }
+        if command.failed:
+            ack["failedSymbols"] = command.failed
+        if self.worker_id is not None:
+            ack["worker"] = self.worker_id
+        await self.redis_producer.publish(self.ack_channel, self.codec.dumps(ack))
@@ -0,0 +1,47 @@
+from enum import Enum
+from typing import Dict, Optional
+
+
+class OverflowPolicy(str, Enum):
+    """暫存區滿了的時候怎麼處理新訊息"""
+    # 等到有空間為止，不能掉資料的 stream（例如成交）使用
+    BLOCK = "block"
+    # 直接丟掉新訊息
+    DROP = "drop"
+    # 同一個 topic 只保留最新的一筆，只在乎最新值的 stream（例如 ticker）使用
+    # 暫存區沒滿的時候照常送出每一筆
+    CONFLATE = "conflate"
+
+
+# stream type -> 預設的處理方式，沒有列出的 stream type 一律 BLOCK
+DEFAULT_STREAM_POLICIES: Dict[str, OverflowPolicy] = {
+    "aggTrade": OverflowPolicy.BLOCK,
+    "trade": OverflowPolicy.BLOCK,
+    "ticker": OverflowPolicy.CONFLATE,
+    "miniTicker": OverflowPolicy.CONFLATE,
+    "bookTicker": OverflowPolicy.CONFLATE,
+    "markPrice": OverflowPolicy.CONFLATE,
+    "markPriceUpdate": OverflowPolicy.CONFLATE,
+    # 本地訂單簿的前 N 檔快照
+    "depth": OverflowPolicy.CONFLATE,
+    "book": OverflowPolicy.CONFLATE,
+}
+
+
+def get_stream_type(topic: str) -> str:
+    """topic 的格式為 {exchange}:{market_type}:{symbol}:{stream_type}"""
+    return topic.rsplit(":", 1)[-1]
+
+
+def parse_stream_policies(value: Optional[str]) -> Dict[str, OverflowPolicy]:
+    """解析 "bookTicker=conflate,trade=block" 格式的設定"""
+    policies: Dict[str, OverflowPolicy] = {}
+    if not value:
+        return policies
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        stream_type, policy = item.split("=", 1)
+        policies[stream_type.strip()] = OverflowPolicy(policy.strip().lower())
+    return policies
@@ -0,0 +1,70 @@
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from redis.asyncio import Redis
+
+
+def get_last_key(topic: str) -> str:
+    return f"{topic}:last"
+
+
+def get_recent_key(topic: str) -> str:
+    return f"{topic}:recent"
+
+
+class RecentCache:
+    """
+    每個 topic 保留最新一筆以及最近 size 筆訊息，並同步到 Redis：
+    - {topic}:last: 最新一筆（STRING）
+    - {topic}:recent: 最近 size 筆，由舊到新（LIST）
+
+    寫入 Redis 的指令加在 publisher 每次 flush 的 pipeline 中，
+    同一批裡同一個 topic 只會有一次 RPUSH、LTRIM、SET，不會多出額外的來回。
+    """
+    def __init__(self, size: int = 100):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self._recent: Dict[str, Deque[Any]] = {}
+
+    def add(self, pipe, batch: List[Tuple[str, Any]]) -> None:
+        """把一批已經編碼好的訊息記進快取，並把同步到 Redis 的指令加進 pipeline"""
+        grouped: Dict[str, List[Any]] = {}
+        for topic, payload in batch:
+            payloads = grouped.get(topic)
+            if payloads is None:
+                payloads = grouped[topic] = []
+            payloads.append(payload)
+
+        size = self.size
+        for topic, payloads in grouped.items():
+            recent = self._recent.get(topic)
+            if recent is None:
+                recent = self._recent[topic] = deque(maxlen=size)
+            payloads = payloads[-size:]
+            recent.extend(payloads)
+
+            recent_key = get_recent_key(topic)
+            pipe.rpush(recent_key, *payloads)
+            pipe.ltrim(recent_key, -size, -1)
+            pipe.set(get_last_key(topic), payloads[-1])
+
+    def get_last(self, topic: str) -> Optional[Any]:
+        recent = self._recent.get(topic)
+        return recent[-1] if recent else None
+
+    def get_recent(self, topic: str, count: Optional[int] = None) -> List[Any]:
+        """由舊到新回傳最近 count 筆"""
+        recent = list(self._recent.get(topic, ()))
+        return recent[-count:] if count else recent
+
+
+async def fetch_recent(
+    redis: Redis, topic: str, count: Optional[int] = None
+) -> Tuple[Optional[bytes], List[bytes]]:
+    """消費者啟動時用一次來回取得某個 topic 的最新一筆和最近 count 筆（由舊到新）"""
+    pipe = redis.pipeline(transaction=False)
+    pipe.get(get_last_key(topic))
+    pipe.lrange(get_recent_key(topic), -count if count else 0, -1)
+    last, recent = await pipe.execute()
+    return last, recent
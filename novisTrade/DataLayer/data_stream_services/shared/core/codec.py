@@ -0,0 +1,92 @@
+import json
+import logging
+
+from typing import Any, Callable, Dict, Union
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+class JsonCodec:
+    """
+    JSON 編解碼器，負責熱路徑上的序列化：
+    - loads: 直接吃 websocket / Redis 收到的 bytes（也接受 str）
+    - dumps: 直接輸出 bytes，可以不經過 str 就送進 Redis
+
+    支援的 backend 依速度排序為 orjson、msgspec、json（標準庫）。
+    """
+    def __init__(
+        self,
+        name: str,
+        loads: Callable[[Union[bytes, str]], Any],
+        dumps: Callable[[Any], bytes],
+    ):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self) -> str:
+        return f"JsonCodec({self.name})"
+
+
+def _orjson_codec() -> JsonCodec:
+    return JsonCodec("orjson", orjson.loads, orjson.dumps)
+
+
+def _msgspec_codec() -> JsonCodec:
+    decoder = msgspec.json.Decoder()
+    encoder = msgspec.json.Encoder()
+    return JsonCodec("msgspec", decoder.decode, encoder.encode)
+
+
+def _stdlib_codec() -> JsonCodec:
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    return JsonCodec("json", json.loads, dumps)
+
+
+_BACKENDS: Dict[str, Callable[[], JsonCodec]] = {
+    "orjson": _orjson_codec,
+    "msgspec": _msgspec_codec,
+    "json": _stdlib_codec,
+}
+
+
+def _is_available(name: str) -> bool:
+    if name == "orjson":
+        return orjson is not None
+    if name == "msgspec":
+        return msgspec is not None
+    return name == "json"
+
+
+def get_codec(name: str = "auto") -> JsonCodec:
+    """取得 JSON codec
+
+    name 為 "auto" 時會依序嘗試 orjson、msgspec，都沒有安裝才用標準庫。
+    指定的 backend 沒有安裝時會退回標準庫並記錄警告。
+    """
+    if name == "auto":
+        for candidate in ("orjson", "msgspec"):
+            if _is_available(candidate):
+                return _BACKENDS[candidate]()
+        return _stdlib_codec()
+
+    if name not in _BACKENDS:
+        raise ValueError(f"Unknown JSON codec: {name}")
+
+    if not _is_available(name):
+        logger.warning(f"JSON codec {name} is not installed, falling back to json")
+        return _stdlib_codec()
+
+    return _BACKENDS[name]()
@@ -0,0 +1,223 @@
+import time
+import asyncio
+import logging
+
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+CONTROL_ACTIONS = ("subscribe", "unsubscribe")
+
+
+def get_ack_channel(exchange: str) -> str:
+    """每個訂閱指令處理完之後，結果會發佈在這個頻道，消費者依 requestId 對應自己的指令"""
+    return f"{exchange}:control:ack"
+
+
+@dataclass
+class ControlCommand:
+    action: str
+    symbols: List[str]
+    stream_type: str
+    market_type: str
+    request_id: Optional[int] = None
+    received_at: float = field(default_factory=time.perf_counter)
+    future: Optional[asyncio.Future] = None
+    # 處理完之後填入：這個指令中送給交易所失敗的交易對
+    failed: List[str] = field(default_factory=list)
+
+
+@dataclass
+class ControlStats:
+    commands: int = 0
+    batches: int = 0
+    # 實際呼叫 subscribe / unsubscribe 的次數，每次呼叫每條連線最多一個 frame
+    exchange_calls: int = 0
+    # 同一批中訂閱又取消（或反過來）互相抵銷、不需要送給交易所的 stream 數
+    netted_streams: int = 0
+    max_batch_size: int = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "commands": self.commands,
+            "batches": self.batches,
+            "exchange_calls": self.exchange_calls,
+            "netted_streams": self.netted_streams,
+            "max_batch_size": self.max_batch_size,
+        }
+
+
+class ControlBatcher:
+    """
+    把控制頻道上短時間內收到的 subscribe / unsubscribe 合併處理，避免每個指令各送一個 frame 撞到交易所的速率限制。
+
+    收到第一個指令後等待 window_ms，把這段期間的指令依 (market type, stream type) 分組，
+    從 get_count 取得每個交易對目前的訂閱數，依序套用指令（取消訂閱最多減到零，和逐一處理時相同），
+    只有處理前後訂閱數不同的交易對才會呼叫 subscribe / unsubscribe：
+    - 淨增加 n 的交易對呼叫 subscribe n 次，第一次才會送出 frame，之後只增加訂閱數
+    - 淨減少 n 的交易對呼叫 unsubscribe n 次，訂閱數歸零時才會送出 frame
+    - 某一次 subscribe 失敗的交易對不會再出現在之後的呼叫，避免留下沒有人擁有的訂閱
+    每一次呼叫都帶上同一組交易對，所以不論有幾個指令，每組每條連線只會送出一個（依交易所上限分段的）frame。
+    沒有 get_count 時當作訂閱數都很大，變化直接相加。
+
+    每個指令的結果只看它自己的交易對：同方向的呼叫中這些交易對都成功才算成功，
+    被抵銷或淨變化方向相反的交易對不會送出，視為成功。失敗的交易對記在 command.failed，
+    結果會交給 on_complete，submit 回傳的 future 也會收到同樣的結果。
+    處理中收到的指令會留到下一批，批次之間依序執行。
+    """
+    def __init__(
+        self,
+        subscribe: Callable[..., Awaitable[bool]],
+        unsubscribe: Callable[..., Awaitable[bool]],
+        on_complete: Optional[Callable[[ControlCommand, bool], Awaitable[None]]] = None,
+        window_ms: float = 20,
+        get_count: Optional[Callable[[str, str, str], int]] = None,
+    ):
+        self._subscribe = subscribe
+        self._unsubscribe = unsubscribe
+        self._on_complete = on_complete
+        # (market_type, stream_type, symbol) -> 目前的訂閱數
+        self._get_count = get_count
+        self.window = window_ms / 1000
+        self.stats = ControlStats()
+        self._pending: List[ControlCommand] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        # 取消可能在 Redis 指令中途被吞掉，另外用旗標讓迴圈自己結束
+        self._closed = True
+        self._wakeup.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for command in self._pending:
+            if command.future and not command.future.done():
+                command.future.set_result(False)
+        self._pending = []
+
+    def submit(self, command: ControlCommand) -> asyncio.Future:
+        """加入下一批，回傳的 future 在處理完之後得到是否成功"""
+        command.future = asyncio.get_running_loop().create_future()
+        self._pending.append(command)
+        self.stats.commands += 1
+        self._wakeup.set()
+        return command.future
+
+    async def _run(self) -> None:
+        while not self._closed:
+            await self._wakeup.wait()
+            if self._closed:
+                return
+            await asyncio.sleep(self.window)
+            self._wakeup.clear()
+            batch, self._pending = self._pending, []
+            if not batch:
+                continue
+            try:
+                await self.process(batch)
+            except Exception as e:
+                logger.error(f"Error processing control commands: {str(e)}")
+                for command in batch:
+                    if not command.future.done():
+                        command.future.set_result(False)
+
+    async def process(self, batch: List[ControlCommand]) -> None:
+        self.stats.batches += 1
+        self.stats.max_batch_size = max(self.stats.max_batch_size, len(batch))
+
+        groups: Dict[Tuple[str, str], List[ControlCommand]] = {}
+        for command in batch:
+            groups.setdefault((command.market_type, command.stream_type), []).append(command)
+
+        for (market_type, stream_type), commands in groups.items():
+            deltas = self._net_deltas(market_type, stream_type, commands)
+            self.stats.netted_streams += sum(1 for delta in deltas.values() if delta == 0)
+            # 兩個方向各自帶上該方向第一個指令的 requestId，分別記錄失敗的交易對
+            failed: Dict[str, Set[str]] = {}
+            for action, method, sign in (
+                ("subscribe", self._subscribe, 1),
+                ("unsubscribe", self._unsubscribe, -1),
+            ):
+                request_id = next(
+                    (c.request_id for c in commands if c.action == action and c.request_id is not None), None
+                )
+                failed[action] = await self._apply(method, deltas, sign, stream_type, market_type, request_id)
+            if len(commands) > 1:
+                logger.info(
+                    f"Coalesced {len(commands)} control commands for {market_type} {stream_type} "
+                    f"into {sum(1 for delta in deltas.values() if delta)} stream changes"
+                )
+
+            for command in commands:
+                command.failed = [symbol for symbol in command.symbols if symbol in failed[command.action]]
+                success = not command.failed
+                if self._on_complete:
+                    try:
+                        await self._on_complete(command, success)
+                    except Exception as e:
+                        logger.error(f"Error acknowledging control command: {str(e)}")
+                if not command.future.done():
+                    command.future.set_result(success)
+
+    def _net_deltas(self, market_type: str, stream_type: str, commands: List[ControlCommand]) -> Dict[str, int]:
+        """依序套用指令後每個交易對訂閱數的變化，維持第一次出現的順序"""
+        start: Dict[str, int] = {}
+        counts: Dict[str, int] = {}
+        for command in commands:
+            for symbol in command.symbols:
+                if symbol not in counts:
+                    count = self._get_count(market_type, stream_type, symbol) if self._get_count else None
+                    start[symbol] = counts[symbol] = len(commands) if count is None else count
+                if command.action == "subscribe":
+                    counts[symbol] += 1
+                else:
+                    counts[symbol] = max(counts[symbol] - 1, 0)
+        return {symbol: count - start[symbol] for symbol, count in counts.items()}
+
+    async def _apply(
+        self,
+        method: Callable[..., Awaitable[bool]],
+        deltas: Dict[str, int],
+        sign: int,
+        stream_type: str,
+        market_type: str,
+        request_id: Optional[int],
+    ) -> Set[str]:
+        """依照淨變化的絕對值分層呼叫，第 n 層帶上變化至少 n 的交易對，回傳任何一層失敗的交易對
+
+        訂閱失敗的交易對不會再送出之後的層；取消訂閱照常減少，和 registry 一律減少的做法一致。
+        """
+        failed: Set[str] = set()
+        level = 1
+        while True:
+            symbols = [
+                symbol for symbol, delta in deltas.items()
+                if delta * sign >= level and not (sign > 0 and symbol in failed)
+            ]
+            if not symbols:
+                return failed
+            self.stats.exchange_calls += 1
+            try:
+                success = await method(
+                    symbols=symbols, stream_type=stream_type, market_type=market_type, request_id=request_id
+                )
+            except Exception as e:
+                logger.error(f"Control command failed: {str(e)}")
+                success = False
+            if not success:
+                failed.update(symbols)
+            level += 1
+
+    def get_stats(self) -> dict:
+        return {**self.stats.to_dict(), "pending": self.pending}
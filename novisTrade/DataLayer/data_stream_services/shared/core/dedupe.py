@@ -0,0 +1,56 @@
+import logging
+
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class TradeDeduplicator:
+    """
+    依照每個 topic 的成交編號過濾重複的成交。
+
+    hot swap 或搬移 stream 時，新舊兩條連線會同時送出同一段成交，
+    這邊記住每個 topic 最近 window 筆成交編號，重複的就丟掉。
+    用集合而不是只記最大值，是因為兩條連線的進度不同，
+    新連線的成交可能比舊連線還沒送完的成交先到。
+    """
+    ID_FIELDS: Tuple[str, ...] = ("aggTradeId", "tradeId")
+
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self.duplicates = 0
+        self._seen: Dict[str, Set[int]] = {}
+        self._order: Dict[str, Deque[int]] = {}
+
+    def _get_trade_id(self, record: dict) -> Optional[int]:
+        for field in self.ID_FIELDS:
+            trade_id = record.get(field)
+            if trade_id is not None:
+                return trade_id
+        return None
+
+    def is_duplicate(self, topic: str, record: dict) -> bool:
+        """檢查是否為重複的成交，不是的話會記下它的編號"""
+        trade_id = self._get_trade_id(record)
+        if trade_id is None:
+            return False
+
+        seen = self._seen.get(topic)
+        if seen is None:
+            seen = self._seen[topic] = set()
+            self._order[topic] = deque()
+
+        if trade_id in seen:
+            self.duplicates += 1
+            return True
+
+        order = self._order[topic]
+        seen.add(trade_id)
+        order.append(trade_id)
+        if len(order) > self.window:
+            seen.discard(order.popleft())
+        return False
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"duplicates": self.duplicates, "topics": len(self._seen)}
@@ -0,0 +1,258 @@
+import time
+import asyncio
+import logging
+
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# 毫秒為單位的延遲 bucket
+LATENCY_MS_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# 微秒為單位的處理時間 bucket
+DURATION_US_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 100000)
+
+
+class Histogram:
+    """固定 bucket 的直方圖，每次記錄只需要一次 bisect 和幾個加法"""
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """用 bucket 上界估計分位數，落在最後一個 bucket 之外時回傳 inf"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float("inf")
+
+    def render(self, name: str, labels: str) -> List[str]:
+        """輸出 Prometheus 格式（bucket 為累積數量）"""
+        lines = []
+        cumulative = 0
+        prefix = f"{labels}," if labels else ""
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class TopicMetrics:
+    """單一 topic 的統計：訊息數量、交易所到本地的延遲"""
+    __slots__ = ("messages", "exchange_latency_ms")
+
+    def __init__(self):
+        self.messages = 0
+        self.exchange_latency_ms = Histogram(LATENCY_MS_BUCKETS)
+
+
+class ConnectionMetrics:
+    """單一連線的統計：訊息數量、在接收佇列等待的時間、處理時間"""
+    __slots__ = ("messages", "queue_wait_ms", "handler_us")
+
+    def __init__(self):
+        self.messages = 0
+        self.queue_wait_ms = Histogram(LATENCY_MS_BUCKETS)
+        self.handler_us = Histogram(DURATION_US_BUCKETS)
+
+
+class MetricsRegistry:
+    """
+    記錄每個 topic 和每條連線的延遲與吞吐量：
+    - exchange_latency_ms: exchTimestamp 到 localTimestamp 的延遲（per topic）
+    - queue_wait_ms: 在 WebSocketManager.message_queue 等待的時間（per connection）
+    - handler_us: _map_format 的處理時間（per connection）
+    - publish_flush_us: 一次 pipeline 寫入 Redis 的時間
+    - messages_total: 訊息數量，每秒訊息數由 Prometheus 的 rate() 或 Redis hash 中的 rate 取得
+
+    記錄的路徑上只有 dict 查詢和整數運算，可以在正式環境一直開著。
+    輸出方式有兩種：Prometheus 格式的 HTTP endpoint，或是定期寫進 Redis hash。
+    """
+    def __init__(self, exchange: str):
+        self.exchange = exchange
+        self.topics: Dict[str, TopicMetrics] = {}
+        self.connections: Dict[str, ConnectionMetrics] = {}
+        self.publish_flush_us = Histogram(DURATION_US_BUCKETS)
+        self.publish_batch_size = Histogram((1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048))
+        # 額外的 gauge，例如佇列長度，輸出時才呼叫
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._export_task: Optional[asyncio.Task] = None
+        self._last_export: Dict[str, int] = {}
+        self._last_export_at = time.monotonic()
+
+    def _topic(self, topic: str) -> TopicMetrics:
+        metrics = self.topics.get(topic)
+        if metrics is None:
+            metrics = self.topics[topic] = TopicMetrics()
+        return metrics
+
+    def _connection(self, connection_id: str) -> ConnectionMetrics:
+        metrics = self.connections.get(connection_id)
+        if metrics is None:
+            metrics = self.connections[connection_id] = ConnectionMetrics()
+        return metrics
+
+    def observe_record(self, topic: str, data: dict) -> None:
+        """記錄一筆整理好的市場數據"""
+        metrics = self._topic(topic)
+        metrics.messages += 1
+        exch_timestamp = data.get("exchTimestamp")
+        local_timestamp = data.get("localTimestamp")
+        if exch_timestamp is not None and local_timestamp is not None:
+            metrics.exchange_latency_ms.observe(local_timestamp - exch_timestamp)
+
+    def observe_queue_wait(self, connection_id: str, seconds: float) -> None:
+        metrics = self._connection(connection_id)
+        metrics.messages += 1
+        metrics.queue_wait_ms.observe(seconds * 1000)
+
+    def observe_handler(self, connection_id: str, seconds: float) -> None:
+        self._connection(connection_id).handler_us.observe(seconds * 1_000_000)
+
+    def observe_publish(self, batch_size: int, seconds: float) -> None:
+        self.publish_flush_us.observe(seconds * 1_000_000)
+        self.publish_batch_size.observe(batch_size)
+
+    def add_gauge(self, name: str, getter: Callable[[], float]) -> None:
+        self.gauges[name] = getter
+
+    def render_prometheus(self) -> str:
+        """輸出 Prometheus text format"""
+        exchange = f'exchange="{self.exchange}"'
+        lines = ["# TYPE novis_messages_total counter"]
+        for topic, metrics in self.topics.items():
+            lines.append(f'novis_messages_total{{{exchange},topic="{topic}"}} {metrics.messages}')
+
+        lines.append("# TYPE novis_exchange_latency_ms histogram")
+        for topic, metrics in self.topics.items():
+            lines.extend(metrics.exchange_latency_ms.render(
+                "novis_exchange_latency_ms", f'{exchange},topic="{topic}"'
+            ))
+
+        lines.append("# TYPE novis_connection_messages_total counter")
+        for connection_id, metrics in self.connections.items():
+            lines.append(
+                f'novis_connection_messages_total{{{exchange},connection="{connection_id}"}} {metrics.messages}'
+            )
+
+        lines.append("# TYPE novis_queue_wait_ms histogram")
+        for connection_id, metrics in self.connections.items():
+            lines.extend(metrics.queue_wait_ms.render(
+                "novis_queue_wait_ms", f'{exchange},connection="{connection_id}"'
+            ))
+
+        lines.append("# TYPE novis_handler_us histogram")
+        for connection_id, metrics in self.connections.items():
+            lines.extend(metrics.handler_us.render(
+                "novis_handler_us", f'{exchange},connection="{connection_id}"'
+            ))
+
+        lines.append("# TYPE novis_publish_flush_us histogram")
+        lines.extend(self.publish_flush_us.render("novis_publish_flush_us", exchange))
+        lines.append("# TYPE novis_publish_batch_size histogram")
+        lines.extend(self.publish_batch_size.render("novis_publish_batch_size", exchange))
+
+        for name, getter in self.gauges.items():
+            lines.append(f"# TYPE novis_{name} gauge")
+            lines.append(f"novis_{name}{{{exchange}}} {getter()}")
+
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, str]:
+        """整理成 Redis hash 的欄位，rate 為和上一次 snapshot 之間的每秒訊息數"""
+        now = time.monotonic()
+        elapsed = max(now - self._last_export_at, 1e-9)
+        fields: Dict[str, str] = {}
+
+        for topic, metrics in self.topics.items():
+            previous = self._last_export.get(topic, 0)
+            fields[f"{topic}:rate"] = f"{(metrics.messages - previous) / elapsed:.2f}"
+            fields[f"{topic}:messages"] = str(metrics.messages)
+            fields[f"{topic}:latency_p50_ms"] = str(metrics.exchange_latency_ms.quantile(0.5))
+            fields[f"{topic}:latency_p99_ms"] = str(metrics.exchange_latency_ms.quantile(0.99))
+            self._last_export[topic] = metrics.messages
+
+        for connection_id, metrics in self.connections.items():
+            key = f"connection:{connection_id}"
+            previous = self._last_export.get(key, 0)
+            fields[f"{key}:rate"] = f"{(metrics.messages - previous) / elapsed:.2f}"
+            fields[f"{key}:queue_wait_p99_ms"] = str(metrics.queue_wait_ms.quantile(0.99))
+            fields[f"{key}:handler_p99_us"] = str(metrics.handler_us.quantile(0.99))
+            self._last_export[key] = metrics.messages
+
+        fields["publish_flush_p50_us"] = str(self.publish_flush_us.quantile(0.5))
+        fields["publish_flush_p99_us"] = str(self.publish_flush_us.quantile(0.99))
+        for name, getter in self.gauges.items():
+            fields[name] = str(getter())
+
+        self._last_export_at = now
+        return fields
+
+    async def start_http_server(self, host: str = "0.0.0.0", port: int = 9100) -> None:
+        """啟動 Prometheus 可以抓取的 /metrics endpoint"""
+        self._server = await asyncio.start_server(self._handle_http, host, port)
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    async def _handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await reader.readline()
+            # 略過 header
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[1] == b"/metrics":
+                body = self.render_prometheus().encode()
+                status = b"200 OK"
+            else:
+                body = b"not found\n"
+                status = b"404 Not Found"
+
+            writer.write(
+                b"HTTP/1.1 " + status + b"\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.error(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+
+    def start_redis_export(self, redis, key: str, interval: float = 10.0) -> None:
+        """定期把統計寫進 Redis hash"""
+        self._export_task = asyncio.create_task(self._export_loop(redis, key, interval))
+        logger.info(f"Exporting metrics to Redis hash {key} every {interval} seconds")
+
+    async def _export_loop(self, redis, key: str, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await redis.hset(key, mapping=self.snapshot())
+            except Exception as e:
+                logger.error(f"Error exporting metrics to Redis: {e}")
+
+    async def close(self) -> None:
+        if self._export_task:
+            self._export_task.cancel()
+            await asyncio.gather(self._export_task, return_exceptions=True)
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
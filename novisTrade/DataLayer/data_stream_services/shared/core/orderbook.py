@@ -0,0 +1,120 @@
+from array import array
+from bisect import bisect_left
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+Level = Tuple[float, float]
+
+
+def _set_level(prices: array, sizes: array, price: float, size: float) -> None:
+    """在由小到大排序的價格陣列中更新一檔，size 為 0 代表刪除"""
+    i = bisect_left(prices, price)
+    if i < len(prices) and prices[i] == price:
+        if size:
+            sizes[i] = size
+        else:
+            del prices[i]
+            del sizes[i]
+    elif size:
+        prices.insert(i, price)
+        sizes.insert(i, size)
+
+
+class OrderBook:
+    """
+    本地 L2 訂單簿，每一邊用兩個 array('d') 存價格和數量，價格由小到大排序：
+    - bid 的最佳價在陣列最後面
+    - ask 的最佳價在陣列最前面
+
+    相較於 {價格字串: 數量字串} 的 dict，更新時只需要一次 bisect，
+    取前 N 檔也不用排序。
+    """
+    __slots__ = ("bid_prices", "bid_sizes", "ask_prices", "ask_sizes", "update_id")
+
+    def __init__(self):
+        self.bid_prices = array("d")
+        self.bid_sizes = array("d")
+        self.ask_prices = array("d")
+        self.ask_sizes = array("d")
+        self.update_id = 0
+
+    def clear(self) -> None:
+        for values in (self.bid_prices, self.bid_sizes, self.ask_prices, self.ask_sizes):
+            del values[:]
+        self.update_id = 0
+
+    def apply_snapshot(
+        self,
+        bids: Iterable[Sequence],
+        asks: Iterable[Sequence],
+        update_id: int = 0,
+    ) -> None:
+        """用快照重建整本訂單簿，價格和數量可以是字串或數字"""
+        self.clear()
+        for price, size in sorted((float(p), float(q)) for p, q, *_ in bids):
+            if size:
+                self.bid_prices.append(price)
+                self.bid_sizes.append(size)
+        for price, size in sorted((float(p), float(q)) for p, q, *_ in asks):
+            if size:
+                self.ask_prices.append(price)
+                self.ask_sizes.append(size)
+        self.update_id = update_id
+
+    def update_bid(self, price: float, size: float) -> None:
+        _set_level(self.bid_prices, self.bid_sizes, price, size)
+
+    def update_ask(self, price: float, size: float) -> None:
+        _set_level(self.ask_prices, self.ask_sizes, price, size)
+
+    def apply_diff(self, bids: Iterable[Sequence], asks: Iterable[Sequence]) -> None:
+        """套用增量更新，數量為 0 的檔位會被刪除"""
+        for price, size, *_ in bids:
+            _set_level(self.bid_prices, self.bid_sizes, float(price), float(size))
+        for price, size, *_ in asks:
+            _set_level(self.ask_prices, self.ask_sizes, float(price), float(size))
+
+    def truncate(self, depth: int) -> None:
+        """只保留最好的 depth 檔"""
+        if len(self.bid_prices) > depth:
+            del self.bid_prices[:-depth]
+            del self.bid_sizes[:-depth]
+        if len(self.ask_prices) > depth:
+            del self.ask_prices[depth:]
+            del self.ask_sizes[depth:]
+
+    def bids(self, n: Optional[int] = None) -> List[Level]:
+        """由好到差回傳前 n 檔 bid"""
+        count = len(self.bid_prices) if n is None else min(n, len(self.bid_prices))
+        prices, sizes = self.bid_prices, self.bid_sizes
+        return [(prices[i], sizes[i]) for i in range(len(prices) - 1, len(prices) - 1 - count, -1)]
+
+    def asks(self, n: Optional[int] = None) -> List[Level]:
+        """由好到差回傳前 n 檔 ask"""
+        count = len(self.ask_prices) if n is None else min(n, len(self.ask_prices))
+        return list(zip(self.ask_prices[:count], self.ask_sizes[:count]))
+
+    @property
+    def best_bid(self) -> Optional[float]:
+        return self.bid_prices[-1] if self.bid_prices else None
+
+    @property
+    def best_ask(self) -> Optional[float]:
+        return self.ask_prices[0] if self.ask_prices else None
+
+    def get_metrics(self, depth: int) -> dict:
+        """最佳價、中間價、價差，以及前 depth 檔的買賣量失衡 (bid - ask) / (bid + ask)"""
+        best_bid, best_ask = self.best_bid, self.best_ask
+        bid_size = sum(self.bid_sizes[-depth:]) if self.bid_sizes else 0.0
+        ask_size = sum(self.ask_sizes[:depth])
+        total = bid_size + ask_size
+        both = best_bid is not None and best_ask is not None
+        return {
+            "bestBid": best_bid,
+            "bestAsk": best_ask,
+            "mid": (best_bid + best_ask) / 2 if both else None,
+            "spread": best_ask - best_bid if both else None,
+            "imbalance": (bid_size - ask_size) / total if total else 0.0,
+        }
+
+    def __len__(self) -> int:
+        return len(self.bid_prices) + len(self.ask_prices)
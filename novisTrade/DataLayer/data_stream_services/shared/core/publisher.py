@@ -0,0 +1,282 @@
+import time
+import asyncio
+import logging
+
+from typing import Any, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
+
+from redis.asyncio import Redis
+
+from .buffers import DEFAULT_STREAM_POLICIES, OverflowPolicy, get_stream_type
+from .sinks import PubSubSink
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PublishStats:
+    """批次發送的統計資訊，用來在吞吐量和延遲之間做取捨"""
+    batches: int = 0
+    messages: int = 0
+    errors: int = 0
+    # 因為暫存區滿了而等待、丟棄、被新值取代的次數，key 為 stream type
+    blocked: Dict[str, int] = field(default_factory=dict)
+    dropped: Dict[str, int] = field(default_factory=dict)
+    conflated: Dict[str, int] = field(default_factory=dict)
+    last_batch_size: int = 0
+    max_batch_size: int = 0
+    last_flush_us: float = 0.0
+    max_flush_us: float = 0.0
+    total_flush_us: float = 0.0
+    # key 為 2 的次方的上界，例如 8 代表 batch size 落在 (4, 8]
+    batch_size_buckets: Dict[int, int] = field(default_factory=dict)
+
+    def record(self, batch_size: int, flush_us: float) -> None:
+        self.batches += 1
+        self.messages += batch_size
+        self.last_batch_size = batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+        self.last_flush_us = flush_us
+        self.max_flush_us = max(self.max_flush_us, flush_us)
+        self.total_flush_us += flush_us
+
+        bucket = 1 << (batch_size - 1).bit_length()
+        self.batch_size_buckets[bucket] = self.batch_size_buckets.get(bucket, 0) + 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "errors": self.errors,
+            "blocked": dict(self.blocked),
+            "dropped": dict(self.dropped),
+            "conflated": dict(self.conflated),
+            "avg_batch_size": self.messages / self.batches if self.batches else 0.0,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "avg_flush_us": self.total_flush_us / self.batches if self.batches else 0.0,
+            "last_flush_us": self.last_flush_us,
+            "max_flush_us": self.max_flush_us,
+            "batch_size_buckets": dict(sorted(self.batch_size_buckets.items())),
+        }
+
+
+class RedisPublisher:
+    """
+    將要送往 Redis 的訊息先暫存，再用 pipeline 批次送出：
+    - 累積到 max_batch_size 筆時立即送出
+    - 第一筆訊息等待超過 max_linger_us 微秒時送出
+
+    所有訊息都由同一個 flush 迴圈依照進來的順序送出，
+    所以同一個 topic 的訊息順序不會被打亂。
+
+    暫存區最多 max_pending 筆，Redis 變慢時依照 stream type 的 OverflowPolicy 處理：
+    - BLOCK: publish 會等到暫存區有空間，壓力一路傳回 WebSocket 的接收端
+    - DROP: 丟掉新訊息
+    - CONFLATE: 同一個 topic 最後一筆還沒送出的訊息直接被新值取代，不佔用額外空間
+
+    實際寫入 Redis 的指令由 sink 決定（PUBLISH 或 XADD），預設為 PubSubSink。
+    設定 cache（RecentCache）時，最新值和最近幾筆會在同一個 pipeline 中一起寫入。
+    """
+    def __init__(
+        self,
+        redis: Redis,
+        max_batch_size: int = 500,
+        max_linger_us: int = 1000,
+        report_interval: float = 60.0,
+        max_pending: int = 100_000,
+        stream_policies: Optional[Dict[str, OverflowPolicy]] = None,
+        sink=None,
+        cache=None,
+    ):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+
+        self.redis = redis
+        self.sink = sink or PubSubSink()
+        self.cache = cache
+        self.max_batch_size = max_batch_size
+        self.max_linger_us = max_linger_us
+        self.report_interval = report_interval
+        self.max_pending = max_pending
+        self.stream_policies = {**DEFAULT_STREAM_POLICIES, **(stream_policies or {})}
+        self.stats = PublishStats()
+        # 設定 MetricsRegistry 之後會記錄每次 flush 的時間和筆數
+        self.metrics = None
+        self.running = False
+
+        self._buffer: List[Tuple[str, Any]] = []
+        # topic -> 該 topic 在暫存區中最後一筆的位置，只有 CONFLATE 的 topic 會記錄
+        self._conflate_index: Dict[str, int] = {}
+        self._topic_policies: Dict[str, OverflowPolicy] = {}
+        self._space = asyncio.Event()
+        self._space.set()
+        self._first_enqueued_at = 0.0
+        self._pending = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._report_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """啟動 flush 迴圈"""
+        if self._flush_task is None or self._flush_task.done():
+            self.running = True
+            self._flush_task = asyncio.create_task(self._flush_loop())
+            if self.report_interval > 0:
+                self._report_task = asyncio.create_task(self._report_loop())
+            logger.info(
+                f"Started Redis publisher (sink={self.sink.name}, max_batch_size={self.max_batch_size}, "
+                f"max_linger_us={self.max_linger_us})"
+            )
+
+    @property
+    def pending(self) -> int:
+        """暫存區中還沒送出的訊息數"""
+        return len(self._buffer)
+
+    def get_policy(self, topic: str) -> OverflowPolicy:
+        policy = self._topic_policies.get(topic)
+        if policy is None:
+            policy = self.stream_policies.get(get_stream_type(topic), OverflowPolicy.BLOCK)
+            self._topic_policies[topic] = policy
+        return policy
+
+    async def publish(self, topic: str, payload: Any) -> None:
+        """把訊息放進暫存區，實際送出由 flush 迴圈負責"""
+        if len(self._buffer) >= self.max_pending and self.get_policy(topic) is OverflowPolicy.BLOCK:
+            await self._wait_for_space(topic, 1)
+        self._append(topic, payload)
+
+    async def publish_batch(self, items: List[Tuple[str, Any]]) -> None:
+        """一次放進多筆訊息，中間不會讓出執行權，所以它們會在同一個 pipeline 中送出"""
+        if not items:
+            return
+        if len(self._buffer) + len(items) > self.max_pending and any(
+            self.get_policy(topic) is OverflowPolicy.BLOCK for topic, _ in items
+        ):
+            await self._wait_for_space(items[0][0], len(items))
+        for topic, payload in items:
+            self._append(topic, payload)
+
+    async def _wait_for_space(self, topic: str, count: int) -> None:
+        self._count(self.stats.blocked, topic)
+        # 暫存區是空的時候，就算一批超過上限也直接放進去
+        while self._buffer and len(self._buffer) + count > self.max_pending and self.running:
+            self._space.clear()
+            await self._space.wait()
+
+    def _append(self, topic: str, payload: Any) -> None:
+        policy = self.get_policy(topic)
+
+        if policy is OverflowPolicy.CONFLATE:
+            # 暫存區還有空間時照常排隊，滿了才用新值取代這個 topic 最後一筆還沒送出的訊息
+            index = self._conflate_index.get(topic)
+            if index is not None and len(self._buffer) >= self.max_pending:
+                self._buffer[index] = (topic, payload)
+                self._count(self.stats.conflated, topic)
+                return
+            self._conflate_index[topic] = len(self._buffer)
+
+        elif policy is OverflowPolicy.DROP and len(self._buffer) >= self.max_pending:
+            self._count(self.stats.dropped, topic)
+            return
+
+        if not self._buffer:
+            self._first_enqueued_at = time.perf_counter()
+            self._pending.set()
+        self._buffer.append((topic, payload))
+        if len(self._buffer) >= self.max_batch_size:
+            self._full.set()
+
+    @staticmethod
+    def _count(counter: Dict[str, int], topic: str) -> None:
+        stream_type = get_stream_type(topic)
+        counter[stream_type] = counter.get(stream_type, 0) + 1
+
+    async def _flush_loop(self) -> None:
+        while self.running or self._buffer:
+            await self._pending.wait()
+
+            # 還沒滿就等到 linger 時間到或是 batch 滿了
+            if self.running and len(self._buffer) < self.max_batch_size:
+                elapsed = time.perf_counter() - self._first_enqueued_at
+                remaining = self.max_linger_us / 1_000_000 - elapsed
+                if remaining > 0:
+                    try:
+                        await asyncio.wait_for(self._full.wait(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        pass
+
+            await self._flush_buffer()
+
+    async def _flush_buffer(self) -> None:
+        """把目前暫存區的訊息透過 pipeline 一次送出"""
+        batch = self._buffer
+        self._buffer = []
+        self._conflate_index = {}
+        self._pending.clear()
+        self._full.clear()
+        self._space.set()
+        if not batch:
+            return
+
+        started = time.perf_counter()
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            add = self.sink.add
+            for topic, payload in batch:
+                add(pipe, topic, payload)
+            if self.cache:
+                self.cache.add(pipe, batch)
+            await pipe.execute()
+        except Exception as e:
+            self.stats.errors += 1
+            logger.error(f"Error flushing {len(batch)} messages to Redis: {e}")
+            return
+
+        elapsed = time.perf_counter() - started
+        self.stats.record(len(batch), elapsed * 1_000_000)
+        if self.metrics:
+            self.metrics.observe_publish(len(batch), elapsed)
+
+    async def flush(self) -> None:
+        """立即送出暫存區的訊息"""
+        await self._flush_buffer()
+
+    async def _report_loop(self) -> None:
+        while self.running:
+            await asyncio.sleep(self.report_interval)
+            self.log_stats()
+
+    def log_stats(self) -> None:
+        stats = self.stats.to_dict()
+        logger.info(
+            f"Publisher stats: batches={stats['batches']}, messages={stats['messages']}, "
+            f"avg_batch_size={stats['avg_batch_size']:.1f}, max_batch_size={stats['max_batch_size']}, "
+            f"avg_flush_us={stats['avg_flush_us']:.0f}, max_flush_us={stats['max_flush_us']:.0f}, "
+            f"errors={stats['errors']}, blocked={stats['blocked']}, dropped={stats['dropped']}, "
+            f"conflated={stats['conflated']}"
+        )
+
+    def get_stats(self) -> Dict[str, Any]:
+        """取得批次大小、flush 延遲以及暫存區滿載時的統計"""
+        stats = self.stats.to_dict()
+        stats["pending"] = self.pending
+        return stats
+
+    async def close(self) -> None:
+        """送出剩下的訊息並停止 flush 迴圈"""
+        if not self.running:
+            return
+        self.running = False
+
+        # 喚醒 flush 迴圈和等待空間的 publish，讓它把剩下的訊息送完
+        self._pending.set()
+        self._full.set()
+        self._space.set()
+        if self._flush_task:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        if self._report_task:
+            self._report_task.cancel()
+            await asyncio.gather(self._report_task, return_exceptions=True)
+        logger.debug("Redis publisher closed")
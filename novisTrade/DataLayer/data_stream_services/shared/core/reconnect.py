@@ -0,0 +1,121 @@
+import time
+import heapq
+import random
+import asyncio
+import logging
+
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BackoffPolicy:
+    """指數退避加上 full jitter：第 n 次重試前等待 uniform(0, min(max_delay, base * 2 ** n)) 秒
+
+    第一次（n = 0）也會等待 0 ~ base 秒，交易所同時切斷所有連線時，重連會被打散，不會同一瞬間湧入。
+    """
+    base: float = 0.5
+    max_delay: float = 30.0
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base * 2 ** attempt))
+
+
+class ReconnectScheduler:
+    """
+    控制重連的節奏：
+    - 同時最多 max_concurrent 條連線在交握，其餘依照 priority（預設為 0）由高到低排隊，
+      上層可以把過去的流量當作優先權，讓最繁忙的連線先恢復
+    - 記錄斷線中的連線，從第一條斷線到全部恢復（包含重新訂閱）的時間就是一次完整的恢復時間
+    """
+    def __init__(
+        self,
+        max_concurrent: int = 4,
+        backoff: Optional[BackoffPolicy] = None,
+        priority: Optional[Callable[[str], float]] = None,
+    ):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+        self.max_concurrent = max_concurrent
+        self.backoff = backoff or BackoffPolicy()
+        self.priority = priority
+        self._active = 0
+        self._waiters: List[Tuple[float, int, asyncio.Future]] = []
+        self._sequence = 0
+
+        # connection_id -> 斷線的時間（monotonic）
+        self.down: Dict[str, float] = {}
+        self._outage_started: Optional[float] = None
+        self.attempts = 0
+        self.failures = 0
+        self.recoveries = 0
+        self.last_recovery_seconds = 0.0
+        self.max_recovery_seconds = 0.0
+
+    @asynccontextmanager
+    async def slot(self, connection_id: str) -> AsyncIterator[None]:
+        """取得一個交握的名額，名額不足時依照優先權排隊"""
+        await self._acquire(connection_id)
+        self.attempts += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, connection_id: str) -> None:
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            return
+        priority = self.priority(connection_id) if self.priority else 0.0
+        future = asyncio.get_running_loop().create_future()
+        self._sequence += 1
+        heapq.heappush(self._waiters, (-priority, self._sequence, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 已經分到名額才被取消的話要還回去
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # 名額直接交給下一個，_active 不變
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    def mark_down(self, connection_id: str) -> None:
+        if connection_id in self.down:
+            return
+        now = time.monotonic()
+        if not self.down:
+            self._outage_started = now
+        self.down[connection_id] = now
+
+    def mark_up(self, connection_id: str) -> None:
+        """連線恢復或被移除，斷線中的連線全部處理完時記錄這次的恢復時間"""
+        if self.down.pop(connection_id, None) is None or self.down:
+            return
+        elapsed = time.monotonic() - self._outage_started
+        self._outage_started = None
+        self.recoveries += 1
+        self.last_recovery_seconds = elapsed
+        self.max_recovery_seconds = max(self.max_recovery_seconds, elapsed)
+        logger.info(f"All connections recovered in {elapsed:.2f}s")
+
+    def get_stats(self) -> dict:
+        return {
+            "down": len(self.down),
+            "waiting": len(self._waiters),
+            "attempts": self.attempts,
+            "failures": self.failures,
+            "recoveries": self.recoveries,
+            "last_recovery_seconds": self.last_recovery_seconds,
+            "max_recovery_seconds": self.max_recovery_seconds,
+        }
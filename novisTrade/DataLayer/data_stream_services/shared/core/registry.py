@@ -0,0 +1,96 @@
+import logging
+
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+# (market_type, stream_type, symbol)
+SubscriptionKey = Tuple[str, str, str]
+
+
+def get_registry_key(exchange: str) -> str:
+    return f"{exchange}:subscriptions"
+
+
+def _encode_field(key: SubscriptionKey) -> bytes:
+    return "|".join(key).encode()
+
+
+def _decode_field(field: bytes) -> SubscriptionKey:
+    # 交易對放在最後，Kraken 的 BTC/USD 之類的名稱不受影響
+    market_type, stream_type, symbol = field.decode().split("|", 2)
+    return market_type, stream_type, symbol
+
+
+def group_by_level(counts: Dict[SubscriptionKey, int]) -> List[List[Tuple[str, str, List[str]]]]:
+    """把訂閱數整理成每一層的 (market_type, stream_type, symbols)，訂閱數 n 的交易對會出現在前 n 層
+
+    第一層包含所有交易對，真正需要送給交易所；之後的層只會增加訂閱數。
+    """
+    levels: List[Dict[Tuple[str, str], List[str]]] = []
+    for (market_type, stream_type, symbol), count in counts.items():
+        for level in range(count):
+            if level == len(levels):
+                levels.append(defaultdict(list))
+            levels[level][(market_type, stream_type)].append(symbol)
+    return [
+        [(market_type, stream_type, symbols) for (market_type, stream_type), symbols in groups.items()]
+        for groups in levels
+    ]
+
+
+class SubscriptionRegistry:
+    """
+    把每個 (market type, stream type, 交易對) 的訂閱數存在 Redis hash {exchange}:subscriptions，
+    服務重啟後不必等下游重新送出訂閱指令就能恢復。
+
+    記憶體中保留一份相同的計數，每次變更只寫入有變動的 field：大於零時 HSET 目前的數量，
+    歸零時直接 HDEL，hash 中不會留下沒人訂閱的 stream。每個 hash 只應該有一個寫入者
+    （單一行程模式下是服務本身，多行程模式下是 supervisor）。
+    寫入失敗只記錄錯誤，不影響訂閱本身。
+    """
+    def __init__(self, redis: Redis, key: str):
+        self.redis = redis
+        self.key = key
+        self.counts: Dict[SubscriptionKey, int] = {}
+
+    async def load(self) -> Dict[SubscriptionKey, int]:
+        """讀取 Redis 中的訂閱數，格式不正確或不大於零的 field 會被忽略"""
+        self.counts = {}
+        for field, value in (await self.redis.hgetall(self.key)).items():
+            try:
+                key, count = _decode_field(field), int(value)
+            except ValueError:
+                logger.warning(f"Ignoring invalid registry field {field!r} in {self.key}")
+                continue
+            if count > 0:
+                self.counts[key] = count
+        return dict(self.counts)
+
+    async def update(self, action: str, market_type: str, stream_type: str, symbols: Iterable[str]) -> None:
+        """subscribe 時每個交易對加一，unsubscribe 時減一，歸零就刪除"""
+        change = 1 if action == "subscribe" else -1
+        pipe = self.redis.pipeline(transaction=False)
+        for symbol in symbols:
+            key = (market_type, stream_type, symbol)
+            count = self.counts.get(key, 0) + change
+            if count > 0:
+                self.counts[key] = count
+                pipe.hset(self.key, _encode_field(key), count)
+            else:
+                self.counts.pop(key, None)
+                pipe.hdel(self.key, _encode_field(key))
+        try:
+            await pipe.execute()
+        except Exception as e:
+            logger.error(f"Failed to update subscription registry {self.key}: {str(e)}")
+
+    async def clear(self) -> None:
+        self.counts = {}
+        await self.redis.delete(self.key)
+
+    def __len__(self) -> int:
+        return len(self.counts)
@@ -0,0 +1,191 @@
+import logging
+
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Shard:
+    """一條 WebSocket 連線以及它負責的 stream"""
+    connection_id: str
+    market_type: str
+    streams: Dict[str, float] = field(default_factory=dict)  # stream -> 預估負載
+
+    @property
+    def load(self) -> float:
+        return sum(self.streams.values())
+
+    def __len__(self) -> int:
+        return len(self.streams)
+
+
+class ShardManager:
+    """
+    把同一個 market type 的 stream 分散到多條 WebSocket 連線上：
+    - 每條連線最多 max_streams_per_connection 個 stream
+    - 每條連線的預估負載不超過 max_load_per_connection（None 代表不限制）
+    - 新的 stream 會放到還有空間且負載最低的連線，都滿了才開新連線
+
+    這邊只負責「哪個 stream 該放在哪條連線」，真正的訂閱和連線管理
+    由 ExchangeWebSocket 透過 WebSocketManager 執行。
+    stream 的格式和 ExchangeWebSocket.subscriptions 一樣是 "{symbol}@{stream_type}"。
+    """
+    def __init__(
+        self,
+        max_streams_per_connection: int = 200,
+        max_load_per_connection: Optional[float] = None,
+        stream_weights: Optional[Dict[str, float]] = None,
+        load_estimator: Optional[Callable[[str], float]] = None,
+    ):
+        if max_streams_per_connection < 1:
+            raise ValueError("max_streams_per_connection must be at least 1")
+
+        self.max_streams_per_connection = max_streams_per_connection
+        self.max_load_per_connection = max_load_per_connection
+        self.stream_weights = stream_weights or {}
+        self.load_estimator = load_estimator
+        self.shards: Dict[str, Dict[str, Shard]] = {}
+        self._stream_index: Dict[Tuple[str, str], str] = {}
+
+    def estimate_load(self, stream: str) -> float:
+        """估計單一 stream 的負載，預設依照 stream type 的權重"""
+        if self.load_estimator:
+            return self.load_estimator(stream)
+        stream_type = stream.split("@", 1)[-1]
+        return self.stream_weights.get(stream_type, 1.0)
+
+    def _fits(self, shard: Shard, load: float) -> bool:
+        if len(shard) >= self.max_streams_per_connection:
+            return False
+        if self.max_load_per_connection is not None and shard.streams:
+            return shard.load + load <= self.max_load_per_connection
+        return True
+
+    def _new_shard(self, market_type: str) -> Shard:
+        shards = self.shards.setdefault(market_type, {})
+        index = 0
+        while f"{market_type}:shard-{index}" in shards:
+            index += 1
+        shard = Shard(connection_id=f"{market_type}:shard-{index}", market_type=market_type)
+        shards[shard.connection_id] = shard
+        logger.debug(f"Created shard {shard.connection_id}")
+        return shard
+
+    def get_connection_id(self, market_type: str, stream: str) -> Optional[str]:
+        """取得 stream 目前所在的連線"""
+        return self._stream_index.get((market_type, stream))
+
+    def get_shard(self, connection_id: str) -> Optional[Shard]:
+        market_type = connection_id.split(":")[0]
+        return self.shards.get(market_type, {}).get(connection_id)
+
+    def streams_for(self, connection_id: str) -> List[str]:
+        """取得某條連線負責的所有 stream"""
+        shard = self.get_shard(connection_id)
+        return list(shard.streams) if shard else []
+
+    def assign(self, market_type: str, streams: List[str]) -> Dict[str, List[str]]:
+        """為還沒有連線的 stream 分配連線
+
+        已經分配過的 stream 會被略過。
+        回傳 {connection_id: [新分配到這條連線的 stream]}
+        """
+        placement: Dict[str, List[str]] = {}
+        shards = self.shards.setdefault(market_type, {})
+
+        for stream in streams:
+            if (market_type, stream) in self._stream_index:
+                continue
+
+            load = self.estimate_load(stream)
+            candidates = [shard for shard in shards.values() if self._fits(shard, load)]
+            if candidates:
+                shard = min(candidates, key=lambda s: (s.load, len(s)))
+            else:
+                shard = self._new_shard(market_type)
+
+            shard.streams[stream] = load
+            self._stream_index[(market_type, stream)] = shard.connection_id
+            placement.setdefault(shard.connection_id, []).append(stream)
+
+        return placement
+
+    def release(self, market_type: str, streams: List[str]) -> Dict[str, List[str]]:
+        """把 stream 從連線上移除
+
+        回傳 {connection_id: [從這條連線移除的 stream]}，沒有分配過的 stream 會被略過。
+        """
+        placement: Dict[str, List[str]] = {}
+        for stream in streams:
+            connection_id = self._stream_index.pop((market_type, stream), None)
+            if connection_id is None:
+                continue
+            self.shards[market_type][connection_id].streams.pop(stream, None)
+            placement.setdefault(connection_id, []).append(stream)
+        return placement
+
+    def plan_rebalance(self, market_type: str) -> List[Tuple[str, str, List[str]]]:
+        """在 stream 減少之後，嘗試把負載最低的連線清空，合併到其他連線
+
+        只會規劃「整條連線都搬得走」的搬移，避免搬了一半反而多一條半滿的連線。
+        回傳 [(來源 connection_id, 目標 connection_id, [stream])]，
+        呼叫端訂閱完目標連線後再呼叫 move() 更新紀錄。
+        """
+        shards = [shard for shard in self.shards.get(market_type, {}).values() if shard.streams]
+        if len(shards) < 2:
+            return []
+
+        source = min(shards, key=lambda s: (s.load, len(s)))
+        targets = {shard.connection_id: (shard.load, len(shard)) for shard in shards if shard is not source}
+
+        moves: Dict[str, List[str]] = {}
+        for stream, load in sorted(source.streams.items(), key=lambda item: -item[1]):
+            target_id = None
+            for connection_id, (target_load, target_count) in sorted(targets.items(), key=lambda item: item[1]):
+                if target_count >= self.max_streams_per_connection:
+                    continue
+                if (
+                    self.max_load_per_connection is not None
+                    and target_load + load > self.max_load_per_connection
+                ):
+                    continue
+                target_id = connection_id
+                break
+
+            if target_id is None:
+                return []
+
+            target_load, target_count = targets[target_id]
+            targets[target_id] = (target_load + load, target_count + 1)
+            moves.setdefault(target_id, []).append(stream)
+
+        return [(source.connection_id, target_id, streams) for target_id, streams in moves.items()]
+
+    def move(self, market_type: str, streams: List[str], target_id: str) -> None:
+        """把 stream 的紀錄改到另一條連線"""
+        target = self.shards[market_type][target_id]
+        for stream in streams:
+            source_id = self._stream_index.get((market_type, stream))
+            if source_id is None:
+                continue
+            load = self.shards[market_type][source_id].streams.pop(stream)
+            target.streams[stream] = load
+            self._stream_index[(market_type, stream)] = target_id
+
+    def pop_empty_shards(self, market_type: str) -> List[str]:
+        """移除已經沒有 stream 的連線紀錄，回傳它們的 connection_id"""
+        shards = self.shards.get(market_type, {})
+        empty = [connection_id for connection_id, shard in shards.items() if not shard.streams]
+        for connection_id in empty:
+            del shards[connection_id]
+        return empty
+
+    def get_shard_info(self) -> Dict[str, dict]:
+        """取得每條連線的 stream 數量和預估負載"""
+        return {
+            connection_id: {"streams": len(shard), "load": shard.load}
+            for shards in self.shards.values()
+            for connection_id, shard in shards.items()
+        }
@@ -0,0 +1,35 @@
+from typing import Any
+
+from redis.asyncio.client import Pipeline
+
+
+class PubSubSink:
+    """以 PUBLISH 送出，沒有訂閱的人就收不到，也無法補資料"""
+    name = "pubsub"
+
+    def add(self, pipe: Pipeline, topic: str, payload: Any) -> None:
+        pipe.publish(topic, payload)
+
+
+class StreamSink:
+    """
+    以 XADD 寫進每個 topic 同名的 Redis Stream，並用 MAXLEN ~ 修剪長度。
+    消費者可以從上次讀到的 ID 繼續讀，也可以透過 consumer group 分攤負載。
+    """
+    name = "stream"
+
+    def __init__(self, maxlen: int = 100_000, field: str = "data"):
+        self.maxlen = maxlen
+        self.field = field
+
+    def add(self, pipe: Pipeline, topic: str, payload: Any) -> None:
+        pipe.xadd(topic, {self.field: payload}, maxlen=self.maxlen, approximate=True)
+
+
+def get_sink(name: str = "pubsub", stream_maxlen: int = 100_000):
+    """依照名稱取得輸出方式：pubsub 或 stream"""
+    if name == PubSubSink.name:
+        return PubSubSink()
+    if name == StreamSink.name:
+        return StreamSink(maxlen=stream_maxlen)
+    raise ValueError(f"Unknown Redis sink: {name}")
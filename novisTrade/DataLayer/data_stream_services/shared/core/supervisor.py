@@ -0,0 +1,311 @@
+import zlib
+import asyncio
+import logging
+import itertools
+import multiprocessing
+
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from redis.asyncio import Redis
+
+from .codec import get_codec
+from .control import CONTROL_ACTIONS, get_ack_channel
+from .registry import SubscriptionRegistry, get_registry_key, group_by_level
+
+logger = logging.getLogger(__name__)
+
+
+def get_worker_index(symbol: str, workers: int) -> int:
+    """依照交易對的 CRC32 決定由哪一個 worker 負責，重啟之後結果也不會變"""
+    return zlib.crc32(symbol.encode()) % workers
+
+
+def get_worker_channel(exchange: str, worker_id: int) -> str:
+    return f"{exchange}:control:{worker_id}"
+
+
+class Supervisor:
+    """
+    多行程模式：啟動 workers 個 worker process，每個 worker 是一個完整的 ExchangeWebSocket，
+    有自己的 WebSocketManager 和 Redis 連線，只負責一部分的交易對。
+
+    supervisor 監聽 {exchange}:control，依照交易對把指令拆開轉送到
+    {exchange}:control:{worker_id}，並記錄每個 worker 目前的訂閱。
+    轉送的訂閱指令一律帶上 requestId，收到 worker 在 {exchange}:control:ack 的回應後才記錄：
+    訂閱只記錄成功的交易對，取消訂閱不論成功與否都會減少，和 worker 記憶體中的訂閱數一致。
+    worker 掛掉或 ready_timeout 內沒有開始監聽時只重啟那一個，等它開始監聽控制頻道後重送它的訂閱，其他 worker 不受影響；
+    還沒收到回應的指令會在重送之後再送一次。
+    訂閱數同時存在 SubscriptionRegistry，整個服務重啟時先讀回來，worker 準備好之後就會收到原本的訂閱。
+
+    worker_target 會在新的 process 中以 worker_target(worker_id) 執行，
+    必須是可以 pickle 的 module-level 函式。
+    """
+    def __init__(
+        self,
+        exchange: str,
+        workers: int,
+        worker_target: Callable[[int], None],
+        redis_url: str = "redis://localhost:6379/0",
+        restart_delay: float = 1.0,
+        ready_timeout: float = 30.0,
+        subscription_registry: bool = True,
+    ):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.exchange = exchange
+        self.workers = workers
+        self.worker_target = worker_target
+        self.redis_url = redis_url
+        self.restart_delay = restart_delay
+        self.ready_timeout = ready_timeout
+        self.use_registry = subscription_registry
+        self.registry = None
+        self.codec = get_codec()
+        self.running = False
+        self.restarts = 0
+
+        # asyncio 的 event loop 和 Redis 連線不能安全地 fork，worker 一律用 spawn 啟動
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: Dict[int, multiprocessing.Process] = {}
+        # worker 重啟後還沒準備好之前，指令先排隊，等重送完原本的訂閱再依序送出
+        self._ready: Dict[int, bool] = {}
+        self._ready_tasks: Dict[int, asyncio.Task] = {}
+        self._queued: Dict[int, List[dict]] = defaultdict(list)
+        # 已經送出、還沒收到 ack 的訂閱指令，依送出順序排列
+        self._in_flight: Dict[int, List[dict]] = defaultdict(list)
+        # 原本沒有 requestId 的指令由 supervisor 補上
+        self._request_ids = itertools.count(1)
+        self.ack_channel = get_ack_channel(exchange)
+        # worker_id -> (market_type, stream_type, symbol) -> 訂閱數
+        self.subscriptions: Dict[int, Dict[Tuple[str, str, str], int]] = defaultdict(lambda: defaultdict(int))
+
+    async def run(self) -> None:
+        """啟動所有 worker，監聽控制頻道並監控 worker 直到被取消"""
+        self.running = True
+        self.redis = await Redis.from_url(self.redis_url, decode_responses=False)
+        self.pubsub = self.redis.pubsub()
+        if self.use_registry:
+            await self._load_registry()
+        channel = f"{self.exchange}:control"
+        await self.pubsub.subscribe(channel, self.ack_channel)
+        logger.info(f"Supervisor listening to {channel} with {self.workers} workers")
+
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+            self._ready_tasks[worker_id] = asyncio.create_task(self._wait_ready(worker_id))
+        tasks = [
+            asyncio.create_task(self._listen()),
+            asyncio.create_task(self._monitor()),
+        ]
+
+        try:
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            logger.info("Shutting down supervisor...")
+        finally:
+            tasks.extend(self._ready_tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.close()
+
+    async def _load_registry(self) -> None:
+        """讀回上次的訂閱，依照交易對分給各個 worker，讀取失敗時從空的訂閱開始"""
+        self.registry = SubscriptionRegistry(self.redis, get_registry_key(self.exchange))
+        try:
+            counts = await self.registry.load()
+        except Exception as e:
+            logger.error(f"Failed to load subscription registry {self.registry.key}: {str(e)}")
+            return
+        for (market_type, stream_type, symbol), count in counts.items():
+            worker_id = get_worker_index(symbol, self.workers)
+            self.subscriptions[worker_id][(market_type, stream_type, symbol)] = count
+        if counts:
+            logger.info(f"Loaded {len(counts)} subscriptions from {self.registry.key}")
+
+    def _spawn(self, worker_id: int) -> None:
+        process = self._context.Process(
+            target=self.worker_target,
+            args=(worker_id,),
+            name=f"{self.exchange}-worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[worker_id] = process
+        self._ready[worker_id] = False
+        # 舊的 worker 不會再回應，還沒確認的指令排回佇列最前面，重送訂閱之後再送一次
+        in_flight = self._in_flight.pop(worker_id, [])
+        if in_flight:
+            self._queued[worker_id][:0] = in_flight
+            logger.warning(f"Requeued {len(in_flight)} unacknowledged commands for worker {worker_id}")
+        logger.info(f"Started worker {worker_id} (pid={process.pid})")
+
+    async def _wait_ready(self, worker_id: int) -> None:
+        """等 worker 開始監聽自己的控制頻道，再重送它負責的訂閱，逾時就重新啟動 worker"""
+        channel = get_worker_channel(self.exchange, worker_id)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.ready_timeout
+        while loop.time() < deadline:
+            (_, listeners), = await self.redis.pubsub_numsub(channel)
+            if listeners:
+                break
+            await asyncio.sleep(0.1)
+        else:
+            # 停止這個 worker，由 _monitor 重新啟動並再等一次，排隊中的指令等新的 worker 準備好再送
+            logger.error(
+                f"Worker {worker_id} did not listen to {channel} within {self.ready_timeout} seconds, restarting"
+            )
+            process = self._processes.get(worker_id)
+            if process is not None and process.is_alive():
+                process.terminate()
+            return
+
+        commands = self._replay_commands(worker_id)
+        for command in commands:
+            await self.redis.publish(channel, self.codec.dumps(command))
+        if commands:
+            logger.info(f"Replayed {len(commands)} subscribe commands to worker {worker_id}")
+        # 重送期間收到的指令也會排進佇列，全部送完才開始直接轉送，維持指令的順序
+        queued = self._queued[worker_id]
+        while queued:
+            await self._send(worker_id, queued.pop(0))
+        self._ready[worker_id] = True
+
+    def _replay_commands(self, worker_id: int) -> List[dict]:
+        """把 worker 的訂閱記錄整理成訂閱指令，訂閱數 n 的 stream 會重送 n 次以恢復訂閱數"""
+        return [
+            {"action": "subscribe", "symbols": symbols, "streamType": stream_type, "marketType": market_type}
+            for groups in group_by_level(self.subscriptions[worker_id])
+            for market_type, stream_type, symbols in groups
+        ]
+
+    async def _monitor(self, interval: float = 1.0) -> None:
+        """定期檢查 worker，掛掉的重新啟動"""
+        while self.running:
+            await asyncio.sleep(interval)
+            for worker_id, process in list(self._processes.items()):
+                if process.is_alive():
+                    continue
+                logger.error(f"Worker {worker_id} exited with code {process.exitcode}, restarting")
+                process.join(timeout=0)
+                self.restarts += 1
+                await asyncio.sleep(self.restart_delay)
+                self._spawn(worker_id)
+                self._ready_tasks[worker_id] = asyncio.create_task(self._wait_ready(worker_id))
+
+    async def _listen(self) -> None:
+        ack_channel = self.ack_channel.encode()
+        async for message in self.pubsub.listen():
+            if message and message["type"] == "message":
+                try:
+                    if message["channel"] == ack_channel:
+                        await self._on_ack(self.codec.loads(message["data"]))
+                    else:
+                        await self._route(self.codec.loads(message["data"]))
+                except ValueError as e:
+                    logger.error(f"Error decoding JSON: {str(e)}")
+                except Exception as e:
+                    logger.error(f"Error routing control command: {str(e)}")
+
+    async def _route(self, command: dict) -> None:
+        """依照交易對把指令拆給負責的 worker，沒有交易對的指令送給所有 worker"""
+        symbols = command.get("symbols")
+        if symbols and command.get("action") in CONTROL_ACTIONS and command.get("requestId") is None:
+            command = {**command, "requestId": next(self._request_ids)}
+        if not symbols:
+            targets = {worker_id: command for worker_id in range(self.workers)}
+        else:
+            partitions: Dict[int, List[str]] = defaultdict(list)
+            for symbol in symbols:
+                partitions[get_worker_index(symbol, self.workers)].append(symbol)
+            targets = {
+                worker_id: {**command, "symbols": worker_symbols}
+                for worker_id, worker_symbols in partitions.items()
+            }
+
+        for worker_id, worker_command in targets.items():
+            if self._ready.get(worker_id):
+                await self._send(worker_id, worker_command)
+            else:
+                self._queued[worker_id].append(worker_command)
+
+    async def _send(self, worker_id: int, command: dict) -> None:
+        if command.get("symbols") and command.get("action") in CONTROL_ACTIONS:
+            self._in_flight[worker_id].append(command)
+        await self.redis.publish(get_worker_channel(self.exchange, worker_id), self.codec.dumps(command))
+
+    async def _on_ack(self, ack: dict) -> None:
+        """worker 回應之後才記錄訂閱並更新 registry，不是這裡送出的指令（例如重送）會被忽略"""
+        command = self._pop_in_flight(ack)
+        if command is None:
+            return
+        symbols = command["symbols"]
+        if command["action"] == "subscribe" and not ack.get("success"):
+            # 沒有列出失敗交易對的 ack 當作全部失敗
+            failed = set(ack.get("failedSymbols") or symbols)
+            symbols = [symbol for symbol in symbols if symbol not in failed]
+        if not symbols:
+            return
+        command = {**command, "symbols": symbols}
+        self._record(ack["worker"], command)
+        if self.registry is not None:
+            await self.registry.update(command["action"], command.get("marketType"), command.get("streamType"), symbols)
+
+    def _pop_in_flight(self, ack: dict) -> Optional[dict]:
+        """找出 ack 對應的指令，requestId 可能由使用者重複使用，所以內容也要一致"""
+        in_flight = self._in_flight.get(ack.get("worker"))
+        for i, command in enumerate(in_flight or []):
+            if (
+                command["requestId"] == ack.get("requestId")
+                and command["action"] == ack.get("action")
+                and command["symbols"] == ack.get("symbols")
+                and command.get("marketType") == ack.get("marketType")
+                and command.get("streamType") == ack.get("streamType")
+            ):
+                return in_flight.pop(i)
+        return None
+
+    def _record(self, worker_id: int, command: dict) -> None:
+        action = command.get("action")
+        if action not in CONTROL_ACTIONS:
+            return
+        subscriptions = self.subscriptions[worker_id]
+        market_type = command.get("marketType")
+        stream_type = command.get("streamType")
+        for symbol in command.get("symbols") or []:
+            key = (market_type, stream_type, symbol)
+            if action == "subscribe":
+                subscriptions[key] += 1
+            elif subscriptions.get(key, 0) > 1:
+                subscriptions[key] -= 1
+            else:
+                subscriptions.pop(key, None)
+
+    def get_worker_info(self) -> Dict[int, dict]:
+        return {
+            worker_id: {
+                "pid": process.pid,
+                "alive": process.is_alive(),
+                "ready": self._ready.get(worker_id, False),
+                "subscriptions": sum(self.subscriptions[worker_id].values()),
+                "in_flight": len(self._in_flight.get(worker_id, [])),
+                "queued": len(self._queued.get(worker_id, [])),
+            }
+            for worker_id, process in self._processes.items()
+        }
+
+    async def close(self) -> None:
+        """停止所有 worker 並關閉 Redis 連線"""
+        if not self.running:
+            return
+        self.running = False
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self._processes.values():
+            await asyncio.to_thread(process.join, 10)
+        await self.pubsub.unsubscribe()
+        await self.pubsub.close()
+        await self.redis.close()
+        logger.info("Supervisor closed")
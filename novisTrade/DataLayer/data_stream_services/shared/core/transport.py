@@ -0,0 +1,92 @@
+import socket
+import asyncio
+import logging
+
+from dataclasses import dataclass, field
+from typing import Any, Coroutine, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+@dataclass
+class TransportProfile:
+    """
+    WebSocket 連線和 event loop 的調校設定：
+    - use_uvloop: 用 uvloop 取代預設的 event loop
+    - compression: 是否協商 permessage-deflate，compression_overrides 可以依 market type 覆寫
+    - tcp_nodelay: 關閉 Nagle（asyncio 和 uvloop 預設已經開啟，這裡是明確設定）
+    - rcvbuf: socket 接收緩衝區大小，None 代表使用系統預設
+    - max_queue: websockets 接收端暫存的 frame 數上限，滿了之後停止從 socket 讀取
+    - max_size: 單一訊息的大小上限（bytes）
+
+    預設值和 websockets 的預設相同，也就是不調整任何東西。
+    """
+    use_uvloop: bool = False
+    compression: bool = True
+    compression_overrides: Dict[str, bool] = field(default_factory=dict)
+    tcp_nodelay: bool = True
+    rcvbuf: Optional[int] = None
+    max_queue: Optional[int] = 16
+    max_size: Optional[int] = 2 ** 20
+
+    def use_compression(self, market_type: str) -> bool:
+        return self.compression_overrides.get(market_type, self.compression)
+
+    def connect_kwargs(self, market_type: str) -> Dict[str, Any]:
+        """傳給 websockets.asyncio.client.connect 的參數"""
+        return {
+            "compression": "deflate" if self.use_compression(market_type) else None,
+            "max_queue": self.max_queue,
+            "max_size": self.max_size,
+        }
+
+    def configure_socket(self, ws) -> None:
+        """連線建立後設定 socket 選項
+
+        SO_RCVBUF 在連線建立後才設定，TCP window scale 已經依照系統預設協商好，
+        但緩衝區上限仍然會生效，足以吸收短暫的爆量。
+        """
+        sock = ws.transport.get_extra_info("socket")
+        if sock is None:
+            return
+        try:
+            if self.tcp_nodelay:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.rcvbuf:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        except OSError as e:
+            logger.warning(f"Failed to set socket options: {e}")
+
+
+def parse_compression(value: Optional[str]) -> tuple:
+    """解析 "true"、"false" 或 "spot=false,perp=true"，回傳 (預設值, 各 market type 的設定)"""
+    default, overrides = True, {}
+    if not value:
+        return default, overrides
+    for item in value.split(","):
+        item = item.strip().lower()
+        if not item:
+            continue
+        if "=" in item:
+            market_type, enabled = item.split("=", 1)
+            overrides[market_type.strip()] = enabled.strip() == "true"
+        else:
+            default = item == "true"
+    return default, overrides
+
+
+def run(main: Coroutine, use_uvloop: bool = False) -> Any:
+    """和 asyncio.run 相同，use_uvloop 時改用 uvloop，沒有安裝則退回預設的 event loop"""
+    loop_factory = None
+    if use_uvloop:
+        if uvloop is None:
+            logger.warning("uvloop is not installed, falling back to the default event loop")
+        else:
+            loop_factory = uvloop.new_event_loop
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        return runner.run(main)
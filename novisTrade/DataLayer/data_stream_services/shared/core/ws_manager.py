@@ -1,12 +1,17 @@
+import time
 import asyncio
 import websockets
-from typing import Dict, Set, Any
+from typing import Dict, Set, Any, Optional
 import logging
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 
 import websockets.asyncio
 import websockets.asyncio.client
+from websockets.protocol import State
+
+from .transport import TransportProfile
+from .reconnect import BackoffPolicy, ReconnectScheduler
 
 logger = logging.getLogger(__name__)
 
@@ -17,22 +22,58 @@ class WebSocketConnection:
     uri: str
     created_at: datetime
     closed: bool = False
+    # hot swap 時，已經訂閱好但還沒接手的新連線
+    standby_ws: Optional[websockets.asyncio.client.ClientConnection] = None
+    standby_ready: asyncio.Event = field(default_factory=asyncio.Event)
+    swapping: bool = False
 
 class WebSocketManager:
     """ 基礎的 WebSocket 連線管理器，負責處理：
     - WebSocket 連線的建立和管理
     - 訊息的接收和發送
     - 錯誤處理和重連邏輯
+    - hot swap 重連：先建立並訂閱新連線，確認新連線開始送資料後才關閉舊連線
+    - 在交易所強制斷線（例如 24 小時）之前主動輪替連線
+    - 斷線後透過 ReconnectScheduler 限制同時交握的數量，失敗時以指數退避加上 jitter 重試
     """
-    def __init__(self):
+    def __init__(
+        self,
+        hot_swap: bool = True,
+        swap_timeout: float = 10.0,
+        swap_overlap: float = 0.5,
+        max_connection_age: Optional[float] = None,
+        max_queue_size: int = 10_000,
+        transport: Optional[TransportProfile] = None,
+        max_concurrent_reconnects: int = 4,
+        reconnect_backoff_base: float = 0.5,
+        reconnect_backoff_max: float = 30.0,
+    ):
+        self.hot_swap = hot_swap
+        # 壓縮、socket 選項和 websockets 緩衝區的設定
+        self.transport = transport or TransportProfile()
+        self.swap_timeout = swap_timeout
+        self.swap_overlap = swap_overlap
+        self.max_connection_age = max_connection_age
+        self.reconnect_callback = None
+        # 連線被移除之後呼叫，參數為 connection_id（例如發送失敗時由 manager 自己移除）
+        self.remove_callback = None
+        # 重連時產生新的網址，沒有設定時沿用原本的網址
+        self.url_callback = None
+        self.scheduler = ReconnectScheduler(
+            max_concurrent=max_concurrent_reconnects,
+            backoff=BackoffPolicy(base=reconnect_backoff_base, max_delay=reconnect_backoff_max),
+        )
         self.connections: Dict[str, WebSocketConnection] = {}
         self._connection_locks: Dict[str, asyncio.Lock] = {}
         self.running = True
         self.message_callback = None
-        self.message_queue = asyncio.Queue()
+        # 有上限的接收佇列，滿了之後接收端會等待，壓力會傳回 TCP 而不是無限制吃記憶體
+        self.message_queue = asyncio.Queue(maxsize=max_queue_size)
+        self.queue_full_count = 0
+        # 設定 MetricsRegistry 之後會記錄每筆訊息在佇列等待的時間
+        self.metrics = None
         self.main_task = None
         self._connection_updates = asyncio.Queue()
-        self._update_event = asyncio.Event()
         self._active_tasks: Set[asyncio.Task] = set()
         self.ACTION_ADD = "add"
         self.ACTION_REMOVE = "remove"
@@ -45,6 +86,9 @@ class WebSocketManager:
             self.running = True
             self.main_task = asyncio.create_task(self._main_receive_loop())
             logger.info("Started main receive loop")
+            if self.max_connection_age:
+                self._create_task(self._rotation_loop())
+                logger.info(f"Rotating connections every {self.max_connection_age} seconds")
 
     def _create_task(self, coro) -> asyncio.Task:
         """創建任務並追蹤它"""
@@ -69,7 +113,9 @@ class WebSocketManager:
         """處理接收到的消息"""
         try:
             while self.running:
-                connection_id, message = await self.message_queue.get()
+                connection_id, message, enqueued_at = await self.message_queue.get()
+                if self.metrics:
+                    self.metrics.observe_queue_wait(connection_id, time.perf_counter() - enqueued_at)
                 if self.message_callback:
                     await self.message_callback(connection_id, message)
                 self.message_queue.task_done()
@@ -77,57 +123,74 @@ class WebSocketManager:
             logger.error(f"Error processing message: {e}")
             
     async def _update_processor(self):
-        """處理連接更新"""
+        """處理連接更新
+
+        直接等待佇列中的指令，有指令進來就立刻處理，不用輪詢。
+        """
         while self.running:
-            if not self._connection_updates.empty():
-                await self._process_updates()
-            await asyncio.sleep(0.1)
+            message: Dict[str, Any] = await self._connection_updates.get()
+            try:
+                await self._process_update(message)
+            finally:
+                self._connection_updates.task_done()
 
-    async def _process_updates(self):
-        """處理連接更新佇列"""
+    async def _process_update(self, message: Dict[str, Any]):
+        """處理單一連接更新指令"""
+        conn_id: str = message.get("connection_id")
         try:
-            while not self._connection_updates.empty():
-                message: Dict[str, Any] = await self._connection_updates.get()
-                conn_id: str = message.get("connection_id")
-                try:
-                    match message:
-                        case {"action": self.ACTION_ADD}:
-                            await self._handle_add(conn_id, message["uri"], message.get("ready"))
-                            
-                        case {"action": self.ACTION_REMOVE}:
-                            await self._handle_remove(conn_id)
-                            
-                        case {"action": self.ACTION_RECONNECT}:
-                            await self._handle_reconnect(conn_id)
-                            
-                        case {"action": self.ACTION_SEND}:
-                            await self._handle_send(conn_id, message["message"], message.get("sent"))
-                            
-                except Exception as e:
-                    logger.error(f"Error processing message {message}: {e}")
-                finally:
-                    self._connection_updates.task_done()
+            match message:
+                case {"action": self.ACTION_ADD}:
+                    # 建立連線要等交握，另開任務避免擋住其他連線的指令
+                    self._create_task(
+                        self._handle_add(conn_id, message["uri"], message.get("ready"))
+                    )
+                    
+                case {"action": self.ACTION_REMOVE}:
+                    await self._handle_remove(conn_id)
+                    
+                case {"action": self.ACTION_RECONNECT}:
+                    await self._handle_reconnect(conn_id)
+                    
+                case {"action": self.ACTION_SEND}:
+                    await self._handle_send(conn_id, message["message"], message.get("sent"))
+                    
         except Exception as e:
-            logger.error(f"Error processing updates: {e}")
+            logger.error(f"Error processing message {message}: {e}")
+            # 讓等待結果的呼叫端收到錯誤，而不是一直卡住
+            for key in ("ready", "sent"):
+                future = message.get(key)
+                if future and not future.done():
+                    future.set_exception(e)
+
+    async def _receive_message(
+        self, connection_id: str, ws: websockets.asyncio.client.ClientConnection
+    ):
+        """從單個 WebSocket 接收消息
 
-    async def _receive_message(self, connection_id: str):
-        """從單個 WebSocket 接收消息"""
+        每個 ws 物件都有自己的接收任務，hot swap 期間新舊連線會同時接收。
+        """
         if connection_id not in self.connections or self.connections[connection_id].closed:
             return
 
         conn = self.connections[connection_id]
         try:
             while not conn.closed:
-                message = await conn.ws.recv()
-                await self.message_queue.put((connection_id, message))
+                # 直接以 bytes 取得訊息，交給 codec 解析，省掉 UTF-8 decode
+                message = await ws.recv(decode=False)
+                if ws is conn.standby_ws:
+                    conn.standby_ready.set()
+                if self.message_queue.full():
+                    self.queue_full_count += 1
+                await self.message_queue.put((connection_id, message, time.perf_counter()))
             
         except websockets.exceptions.ConnectionClosed:
-            if not conn.closed:
+            # 只有目前使用中的連線斷掉才需要重連，被換掉的舊連線直接結束
+            if not conn.closed and ws is conn.ws and not conn.swapping:
                 logger.info(f"Connection closed for {connection_id}")
                 await self.reconnect(connection_id)
         except Exception as e:
             logger.error(f"Error receiving from {connection_id}: {e}")
-            if not conn.closed:
+            if not conn.closed and ws is conn.ws:
                 await self.remove_connection(connection_id)
                 
     def _get_connection_lock(self, connection_id: str) -> asyncio.Lock:
@@ -138,6 +201,9 @@ class WebSocketManager:
     async def add_connection(self, uri: str, connection_id: str) -> str:
         """添加新的 WebSocket 連接"""
         async with self._get_connection_lock(connection_id):
+            # 同時有多個訂閱要建立同一條連線時，只建立一次
+            if connection_id in self.connections:
+                return connection_id
             connection_ready = asyncio.Future()
             await self._connection_updates.put({
                 "action": self.ACTION_ADD,
@@ -145,15 +211,21 @@ class WebSocketManager:
                 "uri": uri,
                 "ready": connection_ready
             })
-            self._update_event.set()
             # 等待連接建立完成
             await connection_ready
             return connection_id
         
+    async def _connect(self, uri: str, connection_id: str) -> websockets.asyncio.client.ClientConnection:
+        """依照 transport 設定建立連線，connection_id 的開頭為 market type"""
+        market_type = connection_id.split(":")[0]
+        ws = await websockets.asyncio.client.connect(uri, **self.transport.connect_kwargs(market_type))
+        self.transport.configure_socket(ws)
+        return ws
+        
     async def _handle_add(self, connection_id: str, uri: str, ready: asyncio.Future):
         try:
             logger.info(f"Connecting to {uri} with ID {connection_id}")
-            ws = await websockets.asyncio.client.connect(uri)
+            ws = await self._connect(uri, connection_id)
             logger.info(f"Successfully connected to {uri} with ID {connection_id}")
             
             self.connections[connection_id] = WebSocketConnection(
@@ -163,7 +235,7 @@ class WebSocketManager:
                 closed=False
             )
             
-            self._create_task(self._receive_message(connection_id))
+            self._create_task(self._receive_message(connection_id, ws))
             
             if ready and not ready.done():
                 ready.set_result(True)
@@ -184,7 +256,6 @@ class WebSocketManager:
                 "action": "remove",
                 "connection_id": connection_id
             })
-            self._update_event.set()
             return None
         
     async def _handle_remove(self, connection_id: str) -> None:
@@ -198,21 +269,27 @@ class WebSocketManager:
             conn.closed = True
             del self.connections[connection_id]
             self._create_task(self._close_websocket(conn.ws))
+            if conn.standby_ws:
+                self._create_task(self._close_websocket(conn.standby_ws))
             logger.info(f"Successfully removed connection {connection_id}")
+            # 上層可能需要透過 send_message 重新訂閱，另開任務避免卡住更新處理
+            if self.remove_callback and self.running:
+                self._create_task(self.remove_callback(connection_id))
         except Exception as e:
             logger.error(f"Error removing connection {connection_id}: {e}")
 
     async def reconnect(self, connection_id: str) -> None:
         """重新建立指定的連線
         
-        目前的作法是等到連線關閉後才重新連線。之後可以改成 hot swap 的方式。
+        hot_swap 開啟且舊連線還活著時，會先建立並訂閱新連線，兩條連線同時接收，
+        等新連線開始送資料後才關閉舊連線，重疊的資料由上層依照成交編號去重。
+        舊連線已經斷掉時就直接換上新連線。
         """
         async with self._get_connection_lock(connection_id):
             await self._connection_updates.put({
                 "action": "reconnect",
                 "connection_id": connection_id
             })
-            self._update_event.set()
             return None
             
     async def _close_websocket(self, ws: websockets.asyncio.client.ClientConnection) -> None:
@@ -227,17 +304,116 @@ class WebSocketManager:
         if connection_id not in self.connections:
             raise ValueError(f"Connection {connection_id} not found")
         
-        conn = self.connections[connection_id]
-        new_ws = await websockets.asyncio.client.connect(conn.uri)
+        # 重新訂閱需要透過 send_message 經過更新佇列，所以另開任務避免卡住更新處理
+        self._create_task(self._swap_connection(connection_id))
+        
+    async def _swap_connection(self, connection_id: str) -> None:
+        """建立新連線並取代舊連線，失敗時以指數退避重試，直到成功或連線被移除
+        
+        舊連線已經斷掉才算中斷，會先等待一小段 jitter 再交握，並計入恢復時間；
+        主動輪替時舊連線還活著，失敗就繼續用舊連線。
+        """
+        conn = self.connections.get(connection_id)
+        if conn is None or conn.closed or conn.swapping:
+            return
+        
+        conn.swapping = True
+        attempt = 0
+        try:
+            while not conn.closed and self.running:
+                outage = conn.ws.state is not State.OPEN
+                if outage:
+                    self.scheduler.mark_down(connection_id)
+                    await asyncio.sleep(self.scheduler.backoff.delay(attempt))
+                previous_uri, new_ws = conn.uri, None
+                try:
+                    # 只有交握需要排隊，重新訂閱不佔名額
+                    uri = self.url_callback(connection_id) if self.url_callback else conn.uri
+                    async with self.scheduler.slot(connection_id):
+                        new_ws = await self._connect(uri, connection_id)
+                    # reconnect_callback 依照新的網址決定要補訂閱哪些 stream
+                    conn.uri = uri
+                    if self.hot_swap and conn.ws.state is State.OPEN:
+                        await self._hot_swap(connection_id, conn, new_ws)
+                    else:
+                        old_ws = conn.ws
+                        conn.ws = new_ws
+                        conn.created_at = datetime.now()
+                        self._create_task(self._receive_message(connection_id, new_ws))
+                        self._create_task(self._close_websocket(old_ws))
+                        if self.reconnect_callback:
+                            await self.reconnect_callback(connection_id)
+                    logger.info(f"Successfully reconnected {connection_id}")
+                    return
+                except Exception as e:
+                    self.scheduler.failures += 1
+                    logger.error(f"Error reconnecting {connection_id} (attempt {attempt + 1}): {e}")
+                    # 新連線沒有接手（例如 hot swap 失敗）時，網址也要換回舊連線的
+                    if conn.ws is not new_ws:
+                        conn.uri = previous_uri
+                    # 舊連線還活著的話就繼續用舊連線
+                    if not conn.closed and conn.ws.state is State.OPEN:
+                        return
+                    attempt += 1
+        finally:
+            conn.swapping = False
+            self.scheduler.mark_up(connection_id)
+            # 換上的新連線在重新訂閱期間斷掉時，接收任務因為 swapping 不會重連，這裡補上
+            if not conn.closed and self.running and conn.ws.state is not State.OPEN:
+                logger.warning(f"Connection {connection_id} closed during swap, reconnecting")
+                self._create_task(self.reconnect(connection_id))
+            
+    async def _hot_swap(
+        self,
+        connection_id: str,
+        conn: WebSocketConnection,
+        new_ws: websockets.asyncio.client.ClientConnection,
+    ) -> None:
+        """新舊連線並行，確認新連線開始送資料後才關閉舊連線"""
+        conn.standby_ws = new_ws
+        conn.standby_ready.clear()
+        self._create_task(self._receive_message(connection_id, new_ws))
+        
+        try:
+            # 這段期間送出的訊息都會送到新連線
+            if self.reconnect_callback:
+                await self.reconnect_callback(connection_id)
+            
+            # 訂閱完成後才開始計算新連線是否在送資料
+            conn.standby_ready.clear()
+            try:
+                await asyncio.wait_for(conn.standby_ready.wait(), timeout=self.swap_timeout)
+                await asyncio.sleep(self.swap_overlap)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"Standby connection for {connection_id} sent nothing in "
+                    f"{self.swap_timeout}s, switching anyway"
+                )
+            if new_ws.state is not State.OPEN:
+                raise ConnectionError("Standby connection closed before taking over")
+        except Exception:
+            conn.standby_ws = None
+            self._create_task(self._close_websocket(new_ws))
+            raise
+        
         old_ws = conn.ws
         conn.ws = new_ws
-        conn.closed = False
+        conn.standby_ws = None
         conn.created_at = datetime.now()
         self._create_task(self._close_websocket(old_ws))
-        if self.reconnect_callback:
-            await self.reconnect_callback(connection_id)
-            
-        logger.info(f"Successfully reconnected {connection_id}")
+        logger.info(f"Hot swapped connection {connection_id}")
+        
+    async def _rotation_loop(self) -> None:
+        """在交易所強制斷線之前，主動用 hot swap 輪替太舊的連線"""
+        check_interval = min(60.0, self.max_connection_age / 10)
+        while self.running:
+            await asyncio.sleep(check_interval)
+            now = datetime.now()
+            for connection_id, conn in list(self.connections.items()):
+                age = (now - conn.created_at).total_seconds()
+                if not conn.closed and not conn.swapping and age >= self.max_connection_age:
+                    logger.info(f"Rotating {connection_id} after {age:.0f} seconds")
+                    await self.reconnect(connection_id)
 
     def set_message_callback(self, callback):
         """設置消息回調函數"""
@@ -246,6 +422,14 @@ class WebSocketManager:
     def set_reconnect_callback(self, callback):
         """設置重連回調函數"""
         self.reconnect_callback = callback
+        
+    def set_remove_callback(self, callback):
+        """設置連線被移除後的回調函數"""
+        self.remove_callback = callback
+        
+    def set_url_callback(self, callback):
+        """設置重連時產生網址的函數，參數為 connection_id"""
+        self.url_callback = callback
 
     async def send_message(self, connection_id: str, message: str) -> None:
         """向指定的 WebSocket 發送消息"""
@@ -257,7 +441,6 @@ class WebSocketManager:
                 "message": message,
                 "sent": message_sent
             })
-            self._update_event.set()
             await message_sent
             
     async def _handle_send(self, connection_id: str, message: str, message_sent: asyncio.Future) -> None:
@@ -268,7 +451,10 @@ class WebSocketManager:
         if conn.closed:
             raise ValueError(f"Connection {connection_id} is closed")
         try:
-            await conn.ws.send(message)
+            if conn.standby_ws:
+                await self._send_during_swap(connection_id, conn, message)
+            else:
+                await conn.ws.send(message)
             logger.debug(f"Sent message to {connection_id}: {message}")
             if message_sent and not message_sent.done():
                 message_sent.set_result(True)
@@ -278,10 +464,25 @@ class WebSocketManager:
                 message_sent.set_exception(e)
             await self.remove_connection(connection_id)
 
+    async def _send_during_swap(self, connection_id: str, conn: WebSocketConnection, message: str) -> None:
+        """hot swap 期間新舊連線都送，不論最後哪一條留下來都收過這則訊息（例如使用者的訂閱變更）
+
+        重新訂閱的訊息也會送到舊連線，對已經訂閱的 stream 重複訂閱不影響資料。
+        只要有一條送成功就算成功，兩條都失敗才拋出例外。
+        """
+        errors = []
+        for ws in (conn.standby_ws, conn.ws):
+            try:
+                await ws.send(message)
+            except Exception as e:
+                logger.warning(f"Error sending message to {connection_id} during swap: {e}")
+                errors.append(e)
+        if len(errors) == 2:
+            raise errors[0]
+
     async def close(self) -> None:
         """關閉所有連接及主循環"""
         self.running = False
-        self._update_event.set()
 
         # 清空更新隊列
         while not self._connection_updates.empty():
@@ -311,10 +512,23 @@ class WebSocketManager:
             self._active_tasks.clear()
 
 
-        # 關閉所有連接
+        # 關閉所有連接；更新處理器已經停止，所以直接關閉而不經過佇列
         for conn_id in list(self.connections.keys()):
-            if not self.connections[conn_id].closed:
-                await self.remove_connection(conn_id)
+            conn = self.connections.pop(conn_id)
+            if conn.closed:
+                continue
+            conn.closed = True
+            await self._close_websocket(conn.ws)
+            if conn.standby_ws:
+                await self._close_websocket(conn.standby_ws)
+
+    def get_queue_stats(self) -> Dict[str, int]:
+        """取得接收佇列的使用狀況"""
+        return {
+            "size": self.message_queue.qsize(),
+            "max_size": self.message_queue.maxsize,
+            "full_count": self.queue_full_count,
+        }
 
     def get_connection_info(self) -> Dict[str, dict]:
         """獲取所有連接的資訊"""
@@ -1,4 +1,7 @@
 import logging
+import calendar
+
+from functools import lru_cache
 
 
 def map_logging_level(logging_level: str) -> int:
@@ -10,4 +13,30 @@ def map_logging_level(logging_level: str) -> int:
         "ERROR": logging.ERROR,
         "CRITICAL": logging.CRITICAL
     }
-    return levels.get(logging_level, logging.INFO)
\ No newline at end of file
+    return levels.get(logging_level, logging.INFO)
+
+
+@lru_cache(maxsize=4096)
+def _epoch_seconds(prefix: str) -> int:
+    """把 "YYYY-MM-DDTHH:MM:SS" 轉換成 UTC epoch 秒數"""
+    return calendar.timegm((
+        int(prefix[0:4]), int(prefix[5:7]), int(prefix[8:10]),
+        int(prefix[11:13]), int(prefix[14:16]), int(prefix[17:19]),
+    ))
+
+
+def parse_iso8601_ms(timestamp: str) -> int:
+    """把 UTC 的 ISO 8601 時間（例如 "2023-09-25T07:49:37.708706Z"）轉換成毫秒 timestamp
+
+    同一秒內的成交共用秒數的計算結果，只有小數部分需要每次解析。
+    """
+    millis = 0
+    if len(timestamp) > 20 and timestamp[19] == ".":
+        digits = timestamp[20:23]
+        end = 0
+        while end < len(digits) and digits[end].isdigit():
+            end += 1
+        if end:
+            # 小數不足三位（例如 ".5Z"）時補零
+            millis = int(digits[:end].ljust(3, "0"))
+    return _epoch_seconds(timestamp[:19]) * 1000 + millis
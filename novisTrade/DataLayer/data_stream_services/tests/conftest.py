@@ -0,0 +1,47 @@
+import os
+import sys
+import json
+
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 和各服務的 main.py 一樣，從 src 目錄匯入 binance_ws / kraken_ws
+for path in (
+    ROOT,
+    os.path.join(ROOT, "services", "binance", "src"),
+    os.path.join(ROOT, "services", "kraken", "src"),
+):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+class FakeManager:
+    """取代 WebSocketManager，只記錄建立的連線和送出的訊息，不連到交易所
+
+    failing 中的 (connection_id, method) 送出時會拋出例外。
+    """
+    def __init__(self):
+        self.connections = {}
+        self.sent = []
+        self.failing = set()
+
+    async def add_connection(self, uri, connection_id):
+        self.connections.setdefault(connection_id, SimpleNamespace(uri=uri))
+        return connection_id
+
+    async def remove_connection(self, connection_id):
+        self.connections.pop(connection_id, None)
+
+    async def send_message(self, connection_id, message):
+        data = json.loads(message)
+        if (connection_id, data["method"]) in self.failing:
+            raise ConnectionError(f"{connection_id} is closed")
+        self.sent.append((connection_id, data["method"], data["params"]))
+
+
+@pytest.fixture
+def fake_manager():
+    return FakeManager()
@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+from binance_ws import BinanceWebSocket, DepthState
+
+
+@pytest.fixture
+def service():
+    return BinanceWebSocket()
+
+
+def make_state(last_update_id: int) -> DepthState:
+    state = DepthState()
+    state.book.apply_snapshot([["100.0", "1.0"]], [["101.0", "1.0"]], last_update_id)
+    state.awaiting_first = True
+    return state
+
+
+def spot_event(first: int, last: int, bids=(), asks=()) -> dict:
+    return {"e": "depthUpdate", "E": last, "U": first, "u": last, "b": list(bids), "a": list(asks)}
+
+
+def futures_event(first: int, last: int, previous: int, bids=(), asks=()) -> dict:
+    return {**spot_event(first, last, bids, asks), "pu": previous, "T": last}
+
+
+class TestSpot:
+    def test_skips_events_already_in_snapshot(self, service):
+        state = make_state(100)
+        assert service._process_depth_event(state, spot_event(90, 100, bids=[["100.0", "5.0"]]))
+        assert state.awaiting_first
+        assert state.book.update_id == 100
+        assert state.book.bids() == [(100.0, 1.0)]
+
+    def test_first_event_must_cover_last_update_id_plus_one(self, service):
+        state = make_state(100)
+        assert service._process_depth_event(state, spot_event(95, 105, bids=[["100.0", "2.0"]]))
+        assert not state.awaiting_first
+        assert state.book.update_id == 105
+        assert state.book.bids() == [(100.0, 2.0)]
+
+    def test_first_event_after_gap_is_rejected(self, service):
+        state = make_state(100)
+        assert not service._process_depth_event(state, spot_event(102, 105))
+        assert state.book.update_id == 100
+
+    def test_continuous_events_apply_and_gap_is_detected(self, service):
+        state = make_state(100)
+        assert service._process_depth_event(state, spot_event(101, 101))
+        assert service._process_depth_event(state, spot_event(102, 104, asks=[["101.0", "0"]]))
+        assert state.book.asks() == []
+        # 重疊連線送來的舊更新直接略過
+        assert service._process_depth_event(state, spot_event(103, 104))
+        assert not service._process_depth_event(state, spot_event(106, 107))
+        assert state.book.update_id == 104
+
+
+class TestFutures:
+    def test_first_event_may_end_at_last_update_id(self, service):
+        # 合約的第一筆只要 U <= lastUpdateId <= u，u 等於 lastUpdateId 也要套用
+        state = make_state(100)
+        assert service._process_depth_event(state, futures_event(98, 100, 97, bids=[["99.0", "1.0"]]))
+        assert not state.awaiting_first
+        assert state.book.bids() == [(100.0, 1.0), (99.0, 1.0)]
+
+    def test_skips_events_older_than_snapshot(self, service):
+        state = make_state(100)
+        assert service._process_depth_event(state, futures_event(90, 99, 89))
+        assert state.awaiting_first
+
+    def test_continuity_uses_previous_update_id(self, service):
+        state = make_state(100)
+        assert service._process_depth_event(state, futures_event(99, 103, 98))
+        assert service._process_depth_event(state, futures_event(110, 112, 103))
+        assert state.book.update_id == 112
+        assert not service._process_depth_event(state, futures_event(113, 115, 111))
+        assert state.book.update_id == 112
+
+
+def test_stale_snapshot_is_refetched(service):
+    snapshots = [
+        # 比第一筆暫存的更新（U = 105）還舊，中間缺了 101 ~ 104
+        {"lastUpdateId": 100, "bids": [["100.0", "1.0"]], "asks": [["101.0", "1.0"]]},
+        {"lastUpdateId": 105, "bids": [["100.0", "1.0"]], "asks": [["101.0", "1.0"]]},
+    ]
+    calls = []
+
+    async def fetcher(market_type, symbol, limit):
+        calls.append((market_type, symbol))
+        return snapshots[len(calls) - 1]
+
+    service.snapshot_fetcher = fetcher
+    state = DepthState()
+    state.buffer = [spot_event(105, 106, bids=[["100.0", "3.0"]]), spot_event(107, 107)]
+
+    asyncio.run(service._sync_book("spot", "btcusdt", state))
+
+    assert len(calls) == 2
+    assert state.synced
+    assert state.book.update_id == 107
+    assert state.book.bids() == [(100.0, 3.0)]
+    assert state.buffer == []
+
+
+def test_gap_in_buffered_events_keeps_resyncing(service):
+    snapshot = {"lastUpdateId": 100, "bids": [], "asks": []}
+    calls = []
+
+    async def fetcher(market_type, symbol, limit):
+        calls.append(symbol)
+        if len(calls) == 2:
+            state.buffer = [spot_event(101, 102)]
+        return snapshot
+
+    service.snapshot_fetcher = fetcher
+    state = DepthState()
+    # 101 ~ 102 之後缺了 103，第一次同步失敗，下一次快照之後才接得起來
+    state.buffer = [spot_event(101, 102), spot_event(104, 105)]
+
+    asyncio.run(service._sync_book("spot", "btcusdt", state))
+
+    assert len(calls) == 2
+    assert state.synced
+    assert state.book.update_id == 102
+
+
+def test_book_is_published_on_subscribed_stream_type(service, fake_manager):
+    service.ws_manager = fake_manager
+    asyncio.run(service.subscribe(["btcusdt"], "depth@100ms"))
+    state = make_state(100)
+    records = service._format_book("spot", "btcusdt", state)
+    assert [topic for topic, _ in records] == ["binance:spot:btcusdt:depth@100ms"]
+    assert records[0][1]["topic"] == "binance:spot:btcusdt:depth@100ms"
+    assert records[0][1]["bids"] == [(100.0, 1.0)]
+
+
+def test_updates_after_unsubscribe_are_ignored(service, fake_manager):
+    service.ws_manager = fake_manager
+
+    async def main():
+        await service.subscribe(["btcusdt"], "depth@100ms")
+        await service.unsubscribe(["btcusdt"], "depth@100ms")
+        service._on_depth_update("spot", {**spot_event(101, 102), "s": "BTCUSDT"})
+
+    asyncio.run(main())
+    assert service.books == {}
+    assert not service.depth_streams
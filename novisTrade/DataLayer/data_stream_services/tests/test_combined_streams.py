@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+from binance_ws import BinanceWebSocket
+
+
+@pytest.fixture
+def service(fake_manager):
+    service = BinanceWebSocket(combined_streams=True)
+    service.ws_manager = fake_manager
+    return service
+
+
+def test_streams_in_url_are_not_subscribed_again(service):
+    assert asyncio.run(service.subscribe(["btcusdt", "ethusdt"], "trade"))
+    (conn,) = service.ws_manager.connections.values()
+    assert conn.uri.endswith("/stream?streams=btcusdt@trade/ethusdt@trade")
+    assert service.ws_manager.sent == []
+
+
+def test_resubscribe_after_unsubscribe_sends_subscribe(service):
+    async def main():
+        await service.subscribe(["btcusdt", "ethusdt"], "trade")
+        await service.unsubscribe(["ethusdt"], "trade")
+        await service.subscribe(["ethusdt"], "trade")
+
+    asyncio.run(main())
+    methods = [(method, params) for _, method, params in service.ws_manager.sent]
+    assert methods == [("UNSUBSCRIBE", ["ethusdt@trade"]), ("SUBSCRIBE", ["ethusdt@trade"])]
+
+
+def test_reconnect_uses_new_url(service):
+    async def main():
+        await service.subscribe(["btcusdt", "ethusdt"], "trade")
+        await service.unsubscribe(["ethusdt"], "trade")
+        (connection_id, conn), = service.ws_manager.connections.items()
+        conn.uri = service._get_reconnect_url(connection_id)
+        await service._handle_reconnection(connection_id)
+        await service.subscribe(["ethusdt"], "trade")
+        return conn
+
+    conn = asyncio.run(main())
+    assert conn.uri.endswith("/stream?streams=btcusdt@trade")
+    assert [method for _, method, _ in service.ws_manager.sent] == ["UNSUBSCRIBE", "SUBSCRIBE"]
@@ -0,0 +1,128 @@
+import asyncio
+
+from shared.core.control import ControlBatcher, ControlCommand
+
+
+class FakeExchange:
+    """和 ExchangeWebSocket 一樣記錄訂閱數：訂閱成功才增加，取消訂閱最多減到零"""
+    def __init__(self, failing=(), subscriptions=None):
+        self.failing = set(failing)
+        self.calls = []
+        self.subscriptions = dict(subscriptions or {})
+
+    def count(self, market_type, stream_type, symbol):
+        return self.subscriptions.get(symbol, 0)
+
+    async def subscribe(self, symbols, stream_type, market_type, request_id=None):
+        self.calls.append(("subscribe", list(symbols), request_id))
+        if self.failing & set(symbols):
+            return False
+        for symbol in symbols:
+            self.subscriptions[symbol] = self.subscriptions.get(symbol, 0) + 1
+        return True
+
+    async def unsubscribe(self, symbols, stream_type, market_type, request_id=None):
+        self.calls.append(("unsubscribe", list(symbols), request_id))
+        for symbol in symbols:
+            count = self.subscriptions.pop(symbol, 0) - 1
+            if count > 0:
+                self.subscriptions[symbol] = count
+        return not self.failing & set(symbols)
+
+
+def command(action, *symbols, request_id=None):
+    return ControlCommand(action, list(symbols), "trade", "spot", request_id=request_id)
+
+
+def run(exchange, batch):
+    async def main():
+        completed = []
+
+        async def on_complete(command, success):
+            completed.append((command.request_id, success, command.failed))
+
+        batcher = ControlBatcher(exchange.subscribe, exchange.unsubscribe, on_complete, get_count=exchange.count)
+        loop = asyncio.get_running_loop()
+        for c in batch:
+            c.future = loop.create_future()
+        await batcher.process(batch)
+        return completed, [c.future.result() for c in batch], batcher.stats
+
+    return asyncio.run(main())
+
+
+def test_nets_opposite_commands():
+    exchange = FakeExchange()
+    completed, results, stats = run(exchange, [
+        command("subscribe", "btcusdt", "ethusdt", request_id=1),
+        command("unsubscribe", "btcusdt", request_id=2),
+    ])
+    assert exchange.calls == [("subscribe", ["ethusdt"], 1)]
+    assert stats.netted_streams == 1
+    assert results == [True, True]
+
+
+def test_each_direction_uses_its_own_request_id():
+    exchange = FakeExchange(subscriptions={"ethusdt": 1})
+    run(exchange, [
+        command("unsubscribe", "ethusdt", request_id=1),
+        command("subscribe", "btcusdt", request_id=2),
+    ])
+    assert exchange.calls == [("subscribe", ["btcusdt"], 2), ("unsubscribe", ["ethusdt"], 1)]
+
+
+def test_unsubscribe_failure_does_not_fail_subscribe():
+    exchange = FakeExchange(failing={"ethusdt"}, subscriptions={"ethusdt": 1})
+    completed, results, _ = run(exchange, [
+        command("subscribe", "btcusdt", request_id=1),
+        command("unsubscribe", "ethusdt", request_id=2),
+    ])
+    assert results == [True, False]
+    assert completed == [(1, True, []), (2, False, ["ethusdt"])]
+
+
+def test_failed_frame_fails_every_command_in_it():
+    exchange = FakeExchange(failing={"solusdt"})
+    completed, results, _ = run(exchange, [
+        command("subscribe", "btcusdt", request_id=1),
+        command("subscribe", "btcusdt", "solusdt", request_id=2),
+    ])
+    # 第一層 btcusdt 和 solusdt 在同一個 frame，交易所只回報整個 frame 失敗，btcusdt 不再送第二層
+    assert exchange.calls == [("subscribe", ["btcusdt", "solusdt"], 1)]
+    assert results == [False, False]
+    assert completed[1] == (2, False, ["btcusdt", "solusdt"])
+    assert exchange.subscriptions == {}
+
+
+def test_other_groups_are_not_affected():
+    exchange = FakeExchange(failing={"solusdt"})
+    batch = [
+        command("subscribe", "btcusdt", request_id=1),
+        ControlCommand("subscribe", ["solusdt"], "depth", "spot", request_id=2),
+    ]
+    completed, results, _ = run(exchange, batch)
+    assert results == [True, False]
+
+
+def test_unsubscribe_then_subscribe_at_zero():
+    exchange = FakeExchange()
+    completed, results, stats = run(exchange, [
+        command("unsubscribe", "ethusdt", request_id=1),
+        command("subscribe", "ethusdt", request_id=2),
+    ])
+    # 逐一處理時取消訂閱不會讓訂閱數小於零，結果是訂閱數 1
+    assert exchange.calls == [("subscribe", ["ethusdt"], 2)]
+    assert exchange.subscriptions == {"ethusdt": 1}
+    assert stats.netted_streams == 0
+    assert results == [True, True]
+
+
+def test_existing_subscriptions_net_like_sequential_calls():
+    exchange = FakeExchange(subscriptions={"btcusdt": 1})
+    run(exchange, [
+        command("unsubscribe", "btcusdt"),
+        command("unsubscribe", "btcusdt"),
+        command("subscribe", "btcusdt"),
+    ])
+    assert exchange.calls == []
+    assert exchange.subscriptions == {"btcusdt": 1}
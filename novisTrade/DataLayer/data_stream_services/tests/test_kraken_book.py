@@ -0,0 +1,137 @@
+import zlib
+import asyncio
+
+from kraken_ws import KrakenBook, KrakenWebSocket, _format_checksum_value
+
+# Kraken 文件中 checksum 範例的快照，價格 5 位小數、數量 8 位小數
+ASKS = [0.05005, 0.05010, 0.05015, 0.05020, 0.05025, 0.05030, 0.05035, 0.05040, 0.05045, 0.05050]
+BIDS = [0.05000, 0.04995, 0.04990, 0.04980, 0.04975, 0.04970, 0.04965, 0.04960, 0.04955, 0.04950]
+QTY = 0.000005
+PUBLISHED_CHECKSUM = 974947235
+
+
+def levels(prices, qty=QTY):
+    return [{"price": price, "qty": qty} for price in prices]
+
+
+def make_book(depth: int = 10) -> KrakenBook:
+    book = KrakenBook(depth=depth, price_decimals=5, qty_decimals=8)
+    book.apply_levels(levels(BIDS), levels(ASKS), snapshot=True)
+    return book
+
+
+def expected_checksum(book: KrakenBook) -> int:
+    """不經過快取的字串，直接依照文件的規則計算"""
+    def level(price, qty):
+        return _format_checksum_value(price, 5) + _format_checksum_value(qty, 8)
+    parts = [level(price, qty) for price, qty in book.asks(10)]
+    parts += [level(price, qty) for price, qty in book.bids(10)]
+    return zlib.crc32("".join(parts).encode())
+
+
+def test_format_checksum_value():
+    assert _format_checksum_value(0.05005, 5) == "5005"
+    assert _format_checksum_value(0.000005, 8) == "500"
+    assert _format_checksum_value(45283.5, 1) == "452835"
+    assert _format_checksum_value(1.0, 8) == "100000000"
+
+
+def test_snapshot_matches_published_checksum():
+    assert make_book().checksum() == PUBLISHED_CHECKSUM
+
+
+def test_updates_keep_checksum_strings_in_sync():
+    book = make_book()
+    book.apply_levels(
+        [{"price": 0.04995, "qty": 0}, {"price": 0.04945, "qty": 0.00001}],
+        [{"price": 0.05010, "qty": 0.0000123}],
+    )
+    assert book.checksum() == expected_checksum(book)
+    assert book.checksum() != PUBLISHED_CHECKSUM
+    assert 0.04995 not in book.bid_strings
+
+
+def test_levels_beyond_depth_are_truncated():
+    book = make_book()
+    # 比最佳價更好的新檔位會把最差的一檔擠出訂閱深度
+    book.apply_levels([{"price": 0.05001, "qty": QTY}], [{"price": 0.05004, "qty": QTY}])
+    assert len(book.bid_prices) == 10 and len(book.ask_prices) == 10
+    assert book.best_bid == 0.05001 and book.best_ask == 0.05004
+    assert 0.04950 not in book.bid_strings and 0.05050 not in book.ask_strings
+    assert book.checksum() == expected_checksum(book)
+
+
+def test_checksum_uses_top_ten_of_deeper_book():
+    book = make_book(depth=25)
+    book.apply_levels(levels([0.04900, 0.04890]), levels([0.05100, 0.05110]))
+    assert book.checksum() == PUBLISHED_CHECKSUM
+
+
+def book_message(kind, checksum, bids=(), asks=(), timestamp=None):
+    update = {"symbol": "BTC/USD", "bids": list(bids), "asks": list(asks), "checksum": checksum}
+    if timestamp:
+        update["timestamp"] = timestamp
+    return {"channel": "book", "type": kind, "data": [update]}
+
+
+def make_service():
+    service = KrakenWebSocket()
+    service.pair_precision["BTC/USD"] = (5, 8)
+    return service
+
+
+def changed_book_checksum():
+    book = make_book()
+    book.apply_levels(levels([0.04999], 0.1), [])
+    return book.checksum()
+
+
+def test_duplicate_and_older_updates_are_dropped():
+    service = make_service()
+    checksum = changed_book_checksum()
+    update = book_message("update", checksum, bids=levels([0.04999], 0.1), timestamp="2023-10-06T17:35:55.440295Z")
+
+    async def main():
+        await service._on_book_message(book_message("snapshot", PUBLISHED_CHECKSUM, levels(BIDS), levels(ASKS)))
+        await service._on_book_message(update)
+        # hot swap 時另一條連線送來同一筆，以及更早的一筆
+        await service._on_book_message(update)
+        await service._on_book_message(
+            book_message("update", 1, bids=levels([0.04998], 0.2), timestamp="2023-10-06T17:35:55.4Z")
+        )
+
+    asyncio.run(main())
+    assert service.checksum_mismatches == 0
+    assert service.book_duplicates == 2
+    assert service.books["BTC/USD"].synced
+
+
+def test_checksum_mismatch_resubscribes_in_background_once():
+    service = make_service()
+    sent = []
+    release = None
+
+    async def send(connection_id, method, streams, market_type, request_id=None):
+        sent.append(method)
+        await release.wait()
+
+    service._send_stream_request = send
+    service.shards.get_connection_id = lambda market_type, stream: "spot:shard-0"
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        await service._on_book_message(book_message("snapshot", PUBLISHED_CHECKSUM, levels(BIDS), levels(ASKS)))
+        for timestamp in ("2023-10-06T17:35:56Z", "2023-10-06T17:35:57Z"):
+            await service._on_book_message(book_message("snapshot", 1, levels(BIDS), levels(ASKS)))
+            await service._on_book_message(book_message("update", 1, timestamp=timestamp))
+        # 處理訊息時沒有等待重新訂閱，而且同一個交易對只有一個進行中
+        assert len(service._book_resubscribes) == 1
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*service._book_resubscribes.values())
+
+    asyncio.run(main())
+    assert service.checksum_mismatches == 2
+    assert sent == ["unsubscribe", "subscribe"]
+    assert service._book_resubscribes == {}
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from binance_ws import BinanceWebSocket
+
+
+@pytest.fixture
+def service(fake_manager):
+    service = BinanceWebSocket(max_streams_per_connection=2)
+    service.ws_manager = fake_manager
+    return service
+
+
+def placement(service):
+    return {
+        connection_id: sorted(service.shards.streams_for(connection_id))
+        for connection_id in service.shards.shards.get("spot", {})
+    }
+
+
+def setup_two_shards(service):
+    """spot:shard-0 有 a、b，spot:shard-1 有 c，取消 b 之後會把一條連線合併到另一條"""
+    async def main():
+        await service.subscribe(["a", "b", "c"], "trade")
+        service.ws_manager.sent.clear()
+    asyncio.run(main())
+    assert placement(service) == {"spot:shard-0": ["a@trade", "b@trade"], "spot:shard-1": ["c@trade"]}
+
+
+def test_rebalance_moves_streams_and_unsubscribes_source(service):
+    setup_two_shards(service)
+    assert asyncio.run(service.unsubscribe(["b"], "trade"))
+    assert placement(service) == {"spot:shard-1": ["a@trade", "c@trade"]}
+    assert service.ws_manager.sent == [
+        ("spot:shard-0", "UNSUBSCRIBE", ["b@trade"]),
+        ("spot:shard-1", "SUBSCRIBE", ["a@trade"]),
+        ("spot:shard-0", "UNSUBSCRIBE", ["a@trade"]),
+    ]
+    assert list(service.ws_manager.connections) == ["spot:shard-1"]
+
+
+def test_rebalance_rolls_back_when_source_unsubscribe_fails(service):
+    setup_two_shards(service)
+
+    # 取消 b 本身也會失敗，不會觸發重新平衡，之後直接呼叫 _rebalance
+    service.ws_manager.failing.add(("spot:shard-0", "UNSUBSCRIBE"))
+
+    async def main():
+        assert not await service.unsubscribe(["b"], "trade")
+        await service._rebalance("spot")
+
+    asyncio.run(main())
+    # 分配紀錄不變，目標連線上的訂閱被取消，stream 不會同時在兩條連線上
+    assert placement(service) == {"spot:shard-0": ["a@trade"], "spot:shard-1": ["c@trade"]}
+    assert service.ws_manager.sent[-2:] == [
+        ("spot:shard-1", "SUBSCRIBE", ["a@trade"]),
+        ("spot:shard-1", "UNSUBSCRIBE", ["a@trade"]),
+    ]
+
+
+def test_rebalance_stops_when_target_subscribe_fails(service):
+    setup_two_shards(service)
+    service.ws_manager.failing.add(("spot:shard-1", "SUBSCRIBE"))
+    asyncio.run(service._rebalance("spot"))
+    assert placement(service) == {"spot:shard-0": ["a@trade", "b@trade"], "spot:shard-1": ["c@trade"]}
+    assert service.ws_manager.sent == []
+
+
+def test_dropped_connection_streams_are_placed_again(service):
+    setup_two_shards(service)
+
+    async def main():
+        # ws_manager 因為發送錯誤移除了 spot:shard-0
+        await service.ws_manager.remove_connection("spot:shard-0")
+        await service._handle_connection_removed("spot:shard-0")
+
+    asyncio.run(main())
+    # a 放進 spot:shard-1 剩下的空位，b 開一條新的連線
+    assert placement(service) == {"spot:shard-1": ["a@trade", "c@trade"], "spot:shard-0": ["b@trade"]}
+    assert "spot:shard-0" in service.ws_manager.connections
+    assert sorted(service.ws_manager.sent) == [
+        ("spot:shard-0", "SUBSCRIBE", ["b@trade"]),
+        ("spot:shard-1", "SUBSCRIBE", ["a@trade"]),
+    ]
+
+
+def test_dropped_connection_releases_streams_without_subscribers(service):
+    setup_two_shards(service)
+    service.remove_subscription(["a@trade", "b@trade"], "spot")
+
+    async def main():
+        await service.ws_manager.remove_connection("spot:shard-0")
+        await service._handle_connection_removed("spot:shard-0")
+
+    asyncio.run(main())
+    assert placement(service) == {"spot:shard-1": ["c@trade"]}
+    assert service.ws_manager.sent == []
+
+
+def test_closed_empty_connection_is_ignored(service):
+    setup_two_shards(service)
+    asyncio.run(service._handle_connection_removed("spot:shard-9"))
+    assert placement(service) == {"spot:shard-0": ["a@trade", "b@trade"], "spot:shard-1": ["c@trade"]}
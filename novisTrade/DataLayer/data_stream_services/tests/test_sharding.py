@@ -0,0 +1,100 @@
+import pytest
+
+from shared.core.sharding import ShardManager
+
+
+def streams(*symbols, stream_type="aggTrade"):
+    return [f"{symbol}@{stream_type}" for symbol in symbols]
+
+
+def test_rejects_invalid_limit():
+    with pytest.raises(ValueError):
+        ShardManager(max_streams_per_connection=0)
+
+
+def test_assign_fills_lowest_load_then_opens_new_shard():
+    shards = ShardManager(max_streams_per_connection=2)
+    placement = shards.assign("spot", streams("a", "b", "c"))
+    assert placement == {"spot:shard-0": streams("a", "b"), "spot:shard-1": streams("c")}
+    # 新的 stream 放到負載最低、還有空間的連線
+    assert shards.assign("spot", streams("d")) == {"spot:shard-1": streams("d")}
+    assert shards.get_connection_id("spot", "c@aggTrade") == "spot:shard-1"
+
+
+def test_assign_skips_streams_already_placed():
+    shards = ShardManager()
+    shards.assign("spot", streams("a"))
+    assert shards.assign("spot", streams("a", "b")) == {"spot:shard-0": streams("b")}
+    # 不同 market type 各自分配
+    assert shards.assign("perp", streams("a")) == {"perp:shard-0": streams("a")}
+
+
+def test_assign_respects_load_limit_and_weights():
+    shards = ShardManager(max_load_per_connection=3, stream_weights={"depth": 2})
+    placement = shards.assign("spot", streams("a", "b", stream_type="depth"))
+    assert placement == {"spot:shard-0": streams("a", stream_type="depth"),
+                         "spot:shard-1": streams("b", stream_type="depth")}
+    assert shards.get_shard_info()["spot:shard-0"] == {"streams": 1, "load": 2}
+
+
+def test_release_returns_removed_streams_per_connection():
+    shards = ShardManager(max_streams_per_connection=1)
+    shards.assign("spot", streams("a", "b"))
+    assert shards.release("spot", streams("b", "missing")) == {"spot:shard-1": streams("b")}
+    assert shards.get_connection_id("spot", "b@aggTrade") is None
+    assert shards.pop_empty_shards("spot") == ["spot:shard-1"]
+    assert list(shards.shards["spot"]) == ["spot:shard-0"]
+
+
+def test_new_shard_reuses_lowest_free_index():
+    shards = ShardManager(max_streams_per_connection=1)
+    shards.assign("spot", streams("a", "b", "c"))
+    shards.release("spot", streams("b"))
+    shards.pop_empty_shards("spot")
+    assert shards.assign("spot", streams("d")) == {"spot:shard-1": streams("d")}
+
+
+def test_plan_rebalance_empties_lowest_loaded_shard():
+    shards = ShardManager(max_streams_per_connection=3)
+    shards.assign("spot", streams("a", "b", "c", "d", "e", "f"))
+    shards.release("spot", streams("b", "c", "e"))
+    # shard-0: a，shard-1: d、f，shard-0 整條搬到 shard-1
+    moves = shards.plan_rebalance("spot")
+    assert moves == [("spot:shard-0", "spot:shard-1", streams("a"))]
+
+    source, target, moved = moves[0]
+    shards.move("spot", moved, target)
+    assert shards.get_connection_id("spot", "a@aggTrade") == target
+    assert shards.streams_for(target) == streams("d", "f", "a")
+    assert shards.pop_empty_shards("spot") == [source]
+
+
+def test_plan_rebalance_spreads_streams_across_targets():
+    shards = ShardManager(max_streams_per_connection=3)
+    shards.assign("spot", streams("a", "b", "c", "d", "e", "f", "g", "h", "i"))
+    shards.release("spot", streams("c", "f", "i"))
+    # 每條連線各剩兩個，shard-0 的兩個 stream 要分到兩條連線才搬得完
+    assert shards.plan_rebalance("spot") == [
+        ("spot:shard-0", "spot:shard-1", streams("a")),
+        ("spot:shard-0", "spot:shard-2", streams("b")),
+    ]
+
+
+def test_plan_rebalance_skips_partial_moves():
+    shards = ShardManager(max_streams_per_connection=2)
+    shards.assign("spot", streams("a", "b", "c", "d"))
+    # 兩條連線都滿了，搬不動就不搬
+    assert shards.plan_rebalance("spot") == []
+
+    shards = ShardManager(max_streams_per_connection=3)
+    shards.assign("spot", streams("a", "b", "c", "d", "e"))
+    shards.release("spot", streams("c"))
+    # shard-0: a、b，shard-1: d、e，只能搬走一個，不會搬一半
+    assert shards.plan_rebalance("spot") == []
+
+
+def test_plan_rebalance_needs_two_shards():
+    shards = ShardManager()
+    shards.assign("spot", streams("a"))
+    assert shards.plan_rebalance("spot") == []
+    assert shards.plan_rebalance("perp") == []
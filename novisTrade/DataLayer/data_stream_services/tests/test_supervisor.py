@@ -0,0 +1,149 @@
+import asyncio
+
+from shared.core.codec import get_codec
+from shared.core.supervisor import Supervisor, get_worker_index
+
+codec = get_codec()
+
+
+class FakeRedis:
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, channel, data):
+        self.published.append((channel, codec.loads(data)))
+
+
+class FakeRegistry:
+    def __init__(self):
+        self.updates = []
+
+    async def update(self, action, market_type, stream_type, symbols):
+        self.updates.append((action, market_type, stream_type, list(symbols)))
+
+
+def make_supervisor(workers=1):
+    supervisor = Supervisor("binance", workers, worker_target=print)
+    supervisor.redis = FakeRedis()
+    supervisor.registry = FakeRegistry()
+    supervisor._ready = {worker_id: True for worker_id in range(workers)}
+    return supervisor
+
+
+def subscribe(*symbols, request_id=None):
+    command = {"action": "subscribe", "symbols": list(symbols), "streamType": "trade", "marketType": "spot"}
+    if request_id is not None:
+        command["requestId"] = request_id
+    return command
+
+
+def ack_for(command, worker=0, success=True, failed=None):
+    ack = {**command, "success": success, "worker": worker}
+    if failed:
+        ack["failedSymbols"] = failed
+    return ack
+
+
+def test_registry_waits_for_ack():
+    async def main():
+        supervisor = make_supervisor()
+        await supervisor._route(subscribe("btcusdt", request_id=7))
+        assert supervisor.registry.updates == []
+        assert supervisor.subscriptions[0] == {}
+
+        (channel, sent), = supervisor.redis.published
+        assert channel == "binance:control:0"
+        await supervisor._on_ack(ack_for(sent))
+        assert supervisor.registry.updates == [("subscribe", "spot", "trade", ["btcusdt"])]
+        assert supervisor.subscriptions[0] == {("spot", "trade", "btcusdt"): 1}
+        assert supervisor._in_flight[0] == []
+
+    asyncio.run(main())
+
+
+def test_request_id_added_when_missing():
+    async def main():
+        supervisor = make_supervisor()
+        await supervisor._route(subscribe("btcusdt"))
+        (_, sent), = supervisor.redis.published
+        assert sent["requestId"] is not None
+
+    asyncio.run(main())
+
+
+def test_failed_symbols_are_not_recorded():
+    async def main():
+        supervisor = make_supervisor()
+        await supervisor._route(subscribe("btcusdt", "ethusdt", request_id=1))
+        (_, sent), = supervisor.redis.published
+        await supervisor._on_ack(ack_for(sent, success=False, failed=["ethusdt"]))
+        assert supervisor.registry.updates == [("subscribe", "spot", "trade", ["btcusdt"])]
+
+        await supervisor._route(subscribe("solusdt", request_id=2))
+        await supervisor._on_ack(ack_for(supervisor.redis.published[-1][1], success=False))
+        assert len(supervisor.registry.updates) == 1
+
+    asyncio.run(main())
+
+
+def test_unknown_ack_is_ignored():
+    async def main():
+        supervisor = make_supervisor()
+        await supervisor._on_ack(ack_for(subscribe("btcusdt", request_id=1)))
+        assert supervisor.registry.updates == []
+
+    asyncio.run(main())
+
+
+def test_commands_split_by_worker_are_acked_separately():
+    async def main():
+        supervisor = make_supervisor(workers=2)
+        symbols = ["btcusdt", "ethusdt", "solusdt", "xrpusdt"]
+        assert len({get_worker_index(symbol, 2) for symbol in symbols}) == 2
+        await supervisor._route(subscribe(*symbols, request_id=1))
+        for channel, sent in supervisor.redis.published:
+            await supervisor._on_ack(ack_for(sent, worker=int(channel.rsplit(":", 1)[1])))
+        assert sorted(s for update in supervisor.registry.updates for s in update[3]) == symbols
+
+    asyncio.run(main())
+
+
+def test_unready_worker_queues_commands():
+    async def main():
+        supervisor = make_supervisor()
+        supervisor._ready[0] = False
+        await supervisor._route(subscribe("btcusdt", request_id=1))
+        assert supervisor.redis.published == []
+        assert len(supervisor._queued[0]) == 1
+
+    asyncio.run(main())
+
+
+def test_worker_that_never_listens_is_restarted():
+    class FakeProcess:
+        terminated = False
+
+        def is_alive(self):
+            return not self.terminated
+
+        def terminate(self):
+            self.terminated = True
+
+    class NoListeners(FakeRedis):
+        async def pubsub_numsub(self, channel):
+            return [(channel, 0)]
+
+    async def main():
+        supervisor = make_supervisor()
+        supervisor.redis = NoListeners()
+        supervisor.ready_timeout = 0.2
+        supervisor._ready[0] = False
+        supervisor._processes[0] = process = FakeProcess()
+        await supervisor._route(subscribe("btcusdt", request_id=1))
+        await supervisor._wait_ready(0)
+        assert process.terminated
+        assert not supervisor._ready[0]
+        # 指令留在佇列，等重新啟動的 worker 準備好再送
+        assert len(supervisor._queued[0]) == 1
+
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+import asyncio
+
+from datetime import datetime
+
+import pytest
+
+from websockets.protocol import State
+
+from shared.core.ws_manager import WebSocketConnection, WebSocketManager
+
+
+class FakeWebSocket:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.state = State.OPEN
+        self.sent = []
+
+    async def send(self, message):
+        if self.fail:
+            raise ConnectionError("closed")
+        self.sent.append(message)
+
+    async def recv(self, decode=False):
+        await asyncio.Event().wait()
+
+    async def close(self):
+        self.state = State.CLOSED
+
+
+def swapping_connection(old, new):
+    conn = WebSocketConnection(ws=old, uri="wss://example", created_at=datetime.now())
+    conn.standby_ws = new
+    conn.swapping = True
+    return conn
+
+
+@pytest.mark.parametrize("old_fails, new_fails", [(False, False), (True, False), (False, True)])
+def test_send_during_swap_reaches_both_sockets(old_fails, new_fails):
+    async def main():
+        manager = WebSocketManager()
+        old, new = FakeWebSocket(old_fails), FakeWebSocket(new_fails)
+        manager.connections["spot:shard-0"] = swapping_connection(old, new)
+        sent = asyncio.get_running_loop().create_future()
+        await manager._handle_send("spot:shard-0", "subscribe", sent)
+        assert sent.result() is True
+        assert "spot:shard-0" in manager.connections
+        return old, new
+
+    old, new = asyncio.run(main())
+    assert old.sent == ([] if old_fails else ["subscribe"])
+    assert new.sent == ([] if new_fails else ["subscribe"])
+
+
+def test_send_during_swap_fails_when_both_sockets_fail():
+    async def main():
+        manager = WebSocketManager()
+        manager.connections["spot:shard-0"] = swapping_connection(FakeWebSocket(True), FakeWebSocket(True))
+        sent = asyncio.get_running_loop().create_future()
+        manager.remove_connection = lambda connection_id: asyncio.sleep(0)
+        await manager._handle_send("spot:shard-0", "subscribe", sent)
+        with pytest.raises(ConnectionError):
+            sent.result()
+
+    asyncio.run(main())
+
+
+def test_reconnects_when_new_socket_closes_during_swap():
+    async def main():
+        manager = WebSocketManager(hot_swap=False)
+        old, new = FakeWebSocket(), FakeWebSocket()
+        conn = WebSocketConnection(ws=old, uri="wss://example", created_at=datetime.now())
+        manager.connections["spot:shard-0"] = conn
+        reconnects = []
+
+        async def connect(uri, connection_id):
+            return new
+
+        async def resubscribe(connection_id):
+            # 新連線已經換上，重新訂閱期間被交易所關閉
+            new.state = State.CLOSED
+
+        async def reconnect(connection_id):
+            reconnects.append(connection_id)
+
+        manager._connect = connect
+        manager.reconnect = reconnect
+        manager.reconnect_callback = resubscribe
+        await manager._swap_connection("spot:shard-0")
+        await asyncio.sleep(0)
+        assert conn.ws is new
+        assert not conn.swapping
+        assert reconnects == ["spot:shard-0"]
+        for task in list(manager._active_tasks):
+            task.cancel()
+
+    asyncio.run(main())
+
+
+def test_remove_calls_remove_callback():
+    async def main():
+        manager = WebSocketManager()
+        manager.connections["spot:shard-0"] = WebSocketConnection(
+            ws=FakeWebSocket(), uri="wss://example", created_at=datetime.now()
+        )
+        removed = []
+
+        async def on_remove(connection_id):
+            removed.append(connection_id)
+
+        manager.set_remove_callback(on_remove)
+        await manager._handle_remove("spot:shard-0")
+        await asyncio.sleep(0)
+        assert removed == ["spot:shard-0"]
+        assert "spot:shard-0" not in manager.connections
+
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+"""
+data_collection_service 寫出的封存檔：
+
+    {log_directory}/{exchange}/{market}/{symbol}/{stream}/YYYYMMDD.jsonl
+
+每一行是服務送進 Redis 的原始 JSON，collector 依照 exchTimestamp（沒有的話用 localTimestamp）
+決定寫進哪一天的檔案。Kraken 的 symbol 帶有斜線（例如 BTC/USD），在磁碟上會多一層目錄。
+"""
+import os
+import datetime
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+ARCHIVE_SUFFIX = ".jsonl"
+
+
+@dataclass(frozen=True)
+class ArchiveFile:
+    path: str
+    exchange: str
+    market: str
+    symbol: str
+    stream: str
+    date: str  # YYYYMMDD
+
+    @property
+    def topic(self) -> str:
+        return f"{self.exchange}:{self.market}:{self.symbol}:{self.stream}"
+
+
+def parse_archive_path(root: str, path: str) -> Optional[ArchiveFile]:
+    """從相對於 root 的路徑解析出 topic 和日期，不符合目錄結構時回傳 None"""
+    parts = os.path.relpath(path, root).split(os.sep)
+    if len(parts) < 5 or not parts[-1].endswith(ARCHIVE_SUFFIX):
+        return None
+    date = parts[-1][:-len(ARCHIVE_SUFFIX)]
+    if len(date) != 8 or not date.isdigit():
+        return None
+    return ArchiveFile(
+        path=path,
+        exchange=parts[0],
+        market=parts[1],
+        symbol="/".join(parts[2:-2]),
+        stream=parts[-2],
+        date=date,
+    )
+
+
+def find_archives(
+    root: str,
+    exchanges: Optional[Sequence[str]] = None,
+    markets: Optional[Sequence[str]] = None,
+    symbols: Optional[Sequence[str]] = None,
+    streams: Optional[Sequence[str]] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+) -> Dict[str, List[ArchiveFile]]:
+    """找出符合條件的封存檔，key 為 topic，每個 topic 的檔案依日期排序
+
+    日期為 YYYYMMDD，start_date 和 end_date 都包含在內。symbol 比對不分大小寫。
+    """
+    symbols = {symbol.lower() for symbol in symbols} if symbols else None
+    archives: Dict[str, List[ArchiveFile]] = {}
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            archive = parse_archive_path(root, os.path.join(directory, filename))
+            if archive is None:
+                continue
+            if exchanges and archive.exchange not in exchanges:
+                continue
+            if markets and archive.market not in markets:
+                continue
+            if symbols and archive.symbol.lower() not in symbols:
+                continue
+            if streams and archive.stream not in streams:
+                continue
+            if start_date and archive.date < start_date:
+                continue
+            if end_date and archive.date > end_date:
+                continue
+            archives.setdefault(archive.topic, []).append(archive)
+
+    for files in archives.values():
+        files.sort(key=lambda archive: archive.date)
+    return dict(sorted(archives.items()))
+
+
+def get_record_timestamp(record: dict) -> Optional[int]:
+    """和 collector 相同的規則：優先使用 exchTimestamp，沒有才用 localTimestamp"""
+    timestamp = record.get("exchTimestamp")
+    if timestamp is None:
+        timestamp = record.get("localTimestamp")
+    return timestamp
+
+
+def parse_time(value: str) -> int:
+    """把 YYYYMMDD、YYYY-MM-DD 或 YYYY-MM-DDTHH:MM[:SS] (UTC) 轉換成毫秒 timestamp"""
+    value = value.strip().rstrip("Z")
+    if len(value) == 8 and value.isdigit():
+        parsed = datetime.datetime.strptime(value, "%Y%m%d")
+    else:
+        parsed = datetime.datetime.fromisoformat(value)
+    return int(parsed.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+def format_date(timestamp_ms: int) -> str:
+    """毫秒 timestamp 所在的 UTC 日期，格式為 YYYYMMDD"""
+    return datetime.datetime.fromtimestamp(timestamp_ms / 1000, tz=datetime.timezone.utc).strftime("%Y%m%d")
+
+
+def split_arg(value: Optional[str]) -> Optional[List[str]]:
+    """命令列中以逗號分隔的清單，空值代表不過濾"""
+    return [item.strip() for item in value.split(",") if item.strip()] if value else None
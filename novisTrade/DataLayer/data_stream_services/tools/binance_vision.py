@@ -0,0 +1,307 @@
+"""
+把已經下載的 Binance Vision 每日成交壓縮檔（data.binance.vision）轉換成和 tools.columnar 相同的欄位格式，
+歷史資料和線上收集的資料可以用同一個 read_ticks 讀取。
+
+支援兩種檔案：
+- {SYMBOL}-trades-YYYY-MM-DD.zip: id, price, qty, quote_qty, time, is_buyer_maker[, is_best_match] -> stream trade
+- {SYMBOL}-aggTrades-YYYY-MM-DD.zip: agg_trade_id, price, quantity, first_trade_id, last_trade_id,
+  transact_time, is_buyer_maker[, is_best_match] -> stream aggTrade
+
+欄位轉換和線上的 _format_trade / _format_agg_trade 相同：is_buyer_maker 為 true 代表 sell。
+Vision 沒有本地接收時間，local_timestamp 和 timestamp 相同。現貨從 2025 年起時間單位改成微秒，這裡會統一成毫秒。
+
+同目錄下有 .zip.CHECKSUM 時會先驗證 sha256，不符合就跳過。zip 不解壓到磁碟，直接串流解析：
+有安裝 pandas 時用 read_csv，沒有的話用 numpy.loadtxt 分段解析。每個檔案在 process pool 中平行處理，
+已經轉換過的日期會跳過。
+
+使用方式（在 data_stream_services 目錄下）:
+    python -m tools.binance_vision --input ./data --out /app/Columnar --market perp --workers 8
+"""
+import io
+import os
+import re
+import sys
+import time
+import hashlib
+import logging
+import argparse
+import zipfile
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from tools.archive import split_arg
+from tools.columnar import TICK_COLUMNS, get_day_dir, is_converted, write_day
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+logger = logging.getLogger(__name__)
+
+VISION_FILE_PATTERN = re.compile(r"^(?P<symbol>[A-Z0-9_]+)-(?P<kind>trades|aggTrades)-(?P<date>\d{4}-\d{2}-\d{2})\.zip$")
+# 每次從 zip 讀出並解析的大小，限制 numpy 路徑的記憶體用量
+CHUNK_BYTES = 32 * 2 ** 20
+CHUNK_ROWS = 1_000_000
+
+
+@dataclass(frozen=True)
+class VisionKind:
+    stream: str
+    # CSV 中 trade_id、price、quantity、timestamp、is_buyer_maker 的欄位位置
+    columns: Tuple[int, int, int, int, int]
+
+
+VISION_KINDS = {
+    "trades": VisionKind("trade", (0, 1, 2, 4, 5)),
+    "aggTrades": VisionKind("aggTrade", (0, 1, 2, 5, 6)),
+}
+_ROW_DTYPE = np.dtype([
+    ("trade_id", np.int64),
+    ("price", np.float64),
+    ("quantity", np.float64),
+    ("timestamp", np.int64),
+    ("is_buyer_maker", np.int8),
+])
+
+
+@dataclass(frozen=True)
+class VisionFile:
+    path: str
+    symbol: str
+    kind: str
+    date: str  # YYYYMMDD
+
+    @property
+    def stream(self) -> str:
+        return VISION_KINDS[self.kind].stream
+
+
+def find_vision_files(input_dir: str, symbols: Optional[List[str]] = None) -> List[VisionFile]:
+    symbols = {symbol.upper() for symbol in symbols} if symbols else None
+    files = []
+    for directory, _, filenames in os.walk(input_dir):
+        for filename in filenames:
+            match = VISION_FILE_PATTERN.match(filename)
+            if match is None:
+                continue
+            if symbols and match["symbol"] not in symbols:
+                continue
+            files.append(VisionFile(
+                path=os.path.join(directory, filename),
+                symbol=match["symbol"],
+                kind=match["kind"],
+                date=match["date"].replace("-", ""),
+            ))
+    return sorted(files, key=lambda vision_file: (vision_file.symbol, vision_file.kind, vision_file.date))
+
+
+def verify_checksum(path: str) -> Optional[bool]:
+    """比對 {path}.CHECKSUM 的 sha256，沒有 checksum 檔時回傳 None"""
+    checksum_path = f"{path}.CHECKSUM"
+    if not os.path.exists(checksum_path):
+        return None
+    with open(checksum_path) as f:
+        expected = f.read().split()[0].lower()
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(block)
+    return digest.hexdigest() == expected
+
+
+def _skip_header(stream: BinaryIO) -> None:
+    """期貨的 CSV 有標題列，現貨沒有"""
+    head = stream.peek(1)[:1]
+    if head and not head.isdigit():
+        stream.readline()
+
+
+def _parse_pandas(stream: BinaryIO, kind: VisionKind) -> np.ndarray:
+    chunks = []
+    reader = pandas.read_csv(
+        stream,
+        header=None,
+        usecols=list(kind.columns),
+        dtype={
+            kind.columns[0]: np.int64,
+            kind.columns[1]: np.float64,
+            kind.columns[2]: np.float64,
+            kind.columns[3]: np.int64,
+        },
+        true_values=["true", "True"],
+        false_values=["false", "False"],
+        chunksize=CHUNK_ROWS,
+        engine="c",
+    )
+    for frame in reader:
+        chunk = np.empty(len(frame), dtype=_ROW_DTYPE)
+        for name, column in zip(_ROW_DTYPE.names, kind.columns):
+            chunk[name] = frame[column].to_numpy()
+        chunks.append(chunk)
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=_ROW_DTYPE)
+
+
+def _load_block(block: bytes, kind: VisionKind) -> np.ndarray:
+    # loadtxt 不認得 true / false，先換成數字，bytes.replace 在 C 裡面執行
+    for text, value in ((b"true", b"1"), (b"false", b"0"), (b"True", b"1"), (b"False", b"0")):
+        block = block.replace(text, value)
+    return np.loadtxt(io.BytesIO(block), delimiter=",", usecols=kind.columns, dtype=_ROW_DTYPE, ndmin=1)
+
+
+def _parse_numpy(stream: BinaryIO, kind: VisionKind) -> np.ndarray:
+    chunks = []
+    remainder = b""
+    while True:
+        data = stream.read(CHUNK_BYTES)
+        if not data:
+            break
+        data = remainder + data
+        # 只解析完整的行，最後不完整的一行留給下一段
+        cut = data.rfind(b"\n") + 1
+        remainder = data[cut:]
+        if cut:
+            chunks.append(_load_block(data[:cut], kind))
+    if remainder.strip():
+        chunks.append(_load_block(remainder, kind))
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=_ROW_DTYPE)
+
+
+def parse_vision_zip(path: str, kind: str) -> Dict[str, np.ndarray]:
+    """串流解壓並解析一個 Vision zip，回傳依 timestamp 排序的 tick 欄位"""
+    vision_kind = VISION_KINDS[kind]
+    with zipfile.ZipFile(path) as archive:
+        name = next(name for name in archive.namelist() if name.endswith(".csv"))
+        with archive.open(name) as raw:
+            stream = io.BufferedReader(raw, buffer_size=2 ** 20)
+            _skip_header(stream)
+            rows = _parse_pandas(stream, vision_kind) if pandas is not None else _parse_numpy(stream, vision_kind)
+
+    timestamps = rows["timestamp"]
+    # 現貨從 2025 年起改用微秒
+    if len(timestamps) and timestamps.max() > 10 ** 14:
+        timestamps = timestamps // 1000
+    columns = {
+        "timestamp": timestamps,
+        "local_timestamp": timestamps,
+        "price": rows["price"],
+        "quantity": rows["quantity"],
+        "side": np.where(rows["is_buyer_maker"] != 0, -1, 1).astype(np.int8),
+        "trade_id": rows["trade_id"],
+    }
+    if len(timestamps) > 1 and np.any(np.diff(timestamps) < 0):
+        order = np.argsort(timestamps, kind="stable")
+        columns = {name: values[order] for name, values in columns.items()}
+    return columns
+
+
+def ingest_file(
+    vision_file: VisionFile,
+    out_root: str,
+    market: str,
+    overwrite: bool = False,
+    require_checksum: bool = False,
+) -> Tuple[VisionFile, Optional[int]]:
+    """轉換一個 zip，回傳 (檔案, 筆數)，已經轉換過時筆數為 None"""
+    symbol = vision_file.symbol.lower()
+    day_dir = get_day_dir(out_root, "binance", market, symbol, vision_file.stream, vision_file.date)
+    if not overwrite and is_converted(day_dir):
+        return vision_file, None
+
+    verified = verify_checksum(vision_file.path)
+    if verified is False:
+        raise ValueError("checksum mismatch")
+    if verified is None and require_checksum:
+        raise ValueError("checksum file not found")
+
+    columns = parse_vision_zip(vision_file.path, vision_file.kind)
+    rows = len(columns["timestamp"])
+    write_day(day_dir, columns, {
+        "topic": f"binance:{market}:{symbol}:{vision_file.stream}",
+        "date": vision_file.date,
+        "rows": rows,
+        "source": vision_file.path,
+        "source_size": os.path.getsize(vision_file.path),
+        "checksum_verified": bool(verified),
+        "columns": {name: dtype.str for name, dtype in TICK_COLUMNS.items()},
+    })
+    return vision_file, rows
+
+
+def ingest_vision(
+    input_dir: str,
+    out_root: str,
+    market: str,
+    symbols: Optional[List[str]] = None,
+    workers: Optional[int] = None,
+    overwrite: bool = False,
+    require_checksum: bool = False,
+) -> List[Tuple[VisionFile, int]]:
+    """平行轉換 input_dir 下所有還沒轉換過的 Vision zip，回傳實際轉換的 (檔案, 筆數)"""
+    jobs = []
+    for vision_file in find_vision_files(input_dir, symbols):
+        day_dir = get_day_dir(
+            out_root, "binance", market, vision_file.symbol.lower(), vision_file.stream, vision_file.date
+        )
+        if overwrite or not is_converted(day_dir):
+            jobs.append(vision_file)
+
+    if not jobs:
+        logger.info("Nothing to ingest")
+        return []
+
+    logger.info(f"Ingesting {len(jobs)} files with {'pandas' if pandas is not None else 'numpy'}")
+    ingested = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(ingest_file, vision_file, out_root, market, overwrite, require_checksum): vision_file
+            for vision_file in jobs
+        }
+        for future in as_completed(futures):
+            vision_file = futures[future]
+            try:
+                _, rows = future.result()
+            except Exception as e:
+                logger.error(f"Failed to ingest {vision_file.path}: {e}")
+                continue
+            if rows is not None:
+                logger.info(f"Ingested {vision_file.symbol} {vision_file.kind} {vision_file.date}: {rows} rows")
+                ingested.append((vision_file, rows))
+    return ingested
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", required=True, help="下載好的 zip 所在目錄（會遞迴搜尋）")
+    parser.add_argument("--out", required=True, help="tools.columnar 的輸出目錄")
+    parser.add_argument("--market", required=True, help="寫入的 market type，例如 spot 或 perp")
+    parser.add_argument("--symbols", default=None, help="以逗號分隔，預設全部")
+    parser.add_argument("--workers", type=int, default=None, help="預設為 CPU 數")
+    parser.add_argument("--overwrite", action="store_true", help="重新轉換已經轉換過的日期")
+    parser.add_argument("--require-checksum", action="store_true", help="沒有 .CHECKSUM 檔時不轉換")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    started = time.perf_counter()
+    ingested = ingest_vision(
+        args.input,
+        args.out,
+        args.market,
+        symbols=split_arg(args.symbols),
+        workers=args.workers,
+        overwrite=args.overwrite,
+        require_checksum=args.require_checksum,
+    )
+    print(
+        f"Ingested {len(ingested)} files, {sum(rows for _, rows in ingested)} rows "
+        f"in {time.perf_counter() - started:.1f}s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""
+把已經結束的日檔（YYYYMMDD.jsonl）轉換成每個欄位一個 .npy 檔，研究時可以直接 memory map，
+不需要每次都用 json.loads 重新解析數 GB 的文字檔。
+
+輸出結構：
+
+    {out}/{exchange}/{market}/{symbol}/{stream}/YYYYMMDD/
+        timestamp.npy        int64   exchTimestamp（毫秒），檔案內依此排序
+        local_timestamp.npy  int64   localTimestamp（毫秒）
+        price.npy            float64
+        quantity.npy         float64
+        side.npy             int8    1 為 buy，-1 為 sell
+        trade_id.npy         int64   aggTradeId 或 tradeId
+        meta.json            筆數和來源檔資訊，最後寫入，存在代表這一天已經轉換完成
+
+轉換以 (topic, 日期) 為單位在 process pool 中平行執行，已經有 meta.json 的日期會跳過。
+只處理逐筆成交（trade、aggTrade），預設不轉換 UTC 今天還在寫入的檔案。
+
+使用方式（在 data_stream_services 目錄下）:
+    python -m tools.columnar --root /app/Data --out /app/Columnar --workers 8
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from shared.core.codec import get_codec
+from tools.archive import ArchiveFile, find_archives, format_date, parse_time, split_arg
+
+logger = logging.getLogger(__name__)
+
+TRADE_STREAMS = ("trade", "aggTrade")
+TICK_COLUMNS: Dict[str, np.dtype] = {
+    "timestamp": np.dtype(np.int64),
+    "local_timestamp": np.dtype(np.int64),
+    "price": np.dtype(np.float64),
+    "quantity": np.dtype(np.float64),
+    "side": np.dtype(np.int8),
+    "trade_id": np.dtype(np.int64),
+}
+SIDES = {"buy": 1, "sell": -1}
+META_FILE = "meta.json"
+
+
+def get_day_dir(out_root: str, exchange: str, market: str, symbol: str, stream: str, date: str) -> str:
+    """和 collector 相同，symbol 中的斜線（Kraken）會變成一層目錄"""
+    return os.path.join(out_root, exchange, market, *symbol.split("/"), stream, date)
+
+
+def is_converted(day_dir: str) -> bool:
+    return os.path.exists(os.path.join(day_dir, META_FILE))
+
+
+def parse_day(path: str) -> Dict[str, np.ndarray]:
+    """解析一個日檔，回傳依 timestamp 排序的欄位"""
+    loads = get_codec().loads
+    timestamps, local_timestamps, trade_ids = array("q"), array("q"), array("q")
+    prices, quantities = array("d"), array("d")
+    sides = array("b")
+
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = loads(line)
+                timestamp = record.get("exchTimestamp")
+                local_timestamp = record.get("localTimestamp")
+                if timestamp is None:
+                    timestamp = local_timestamp
+                trade_id = record.get("aggTradeId", record.get("tradeId"))
+                # Binance 的價格和數量是字串，Kraken 是數字，float() 兩種都能處理
+                price, quantity = float(record["price"]), float(record["quantity"])
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue
+            if timestamp is None:
+                continue
+            timestamps.append(timestamp)
+            local_timestamps.append(local_timestamp if local_timestamp is not None else timestamp)
+            prices.append(price)
+            quantities.append(quantity)
+            sides.append(SIDES.get(record.get("side"), 0))
+            trade_ids.append(trade_id if trade_id is not None else -1)
+
+    columns = {
+        "timestamp": np.frombuffer(timestamps, dtype=np.int64),
+        "local_timestamp": np.frombuffer(local_timestamps, dtype=np.int64),
+        "price": np.frombuffer(prices, dtype=np.float64),
+        "quantity": np.frombuffer(quantities, dtype=np.float64),
+        "side": np.frombuffer(sides, dtype=np.int8),
+        "trade_id": np.frombuffer(trade_ids, dtype=np.int64),
+    }
+    # 交易所時間在檔案中可能有些微亂序，排序後讀取時才能用二分搜尋切出時間範圍
+    order = np.argsort(columns["timestamp"], kind="stable")
+    return {name: values[order] for name, values in columns.items()}
+
+
+def write_day(day_dir: str, columns: Dict[str, np.ndarray], meta: dict) -> None:
+    """先寫到暫存目錄再整個改名，中途失敗不會留下看起來完整的日期"""
+    tmp_dir = f"{day_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(values, dtype=TICK_COLUMNS[name]))
+    with open(os.path.join(tmp_dir, META_FILE), "w") as f:
+        json.dump(meta, f)
+    shutil.rmtree(day_dir, ignore_errors=True)
+    os.replace(tmp_dir, day_dir)
+
+
+def convert_file(archive: ArchiveFile, out_root: str, overwrite: bool = False) -> Tuple[str, str, Optional[int]]:
+    """轉換一個日檔，回傳 (topic, 日期, 筆數)，已經轉換過時筆數為 None"""
+    day_dir = get_day_dir(out_root, archive.exchange, archive.market, archive.symbol, archive.stream, archive.date)
+    if not overwrite and is_converted(day_dir):
+        return archive.topic, archive.date, None
+
+    columns = parse_day(archive.path)
+    write_day(day_dir, columns, {
+        "topic": archive.topic,
+        "date": archive.date,
+        "rows": len(columns["timestamp"]),
+        "source": archive.path,
+        "source_size": os.path.getsize(archive.path),
+        "columns": {name: dtype.str for name, dtype in TICK_COLUMNS.items()},
+    })
+    return archive.topic, archive.date, len(columns["timestamp"])
+
+
+def convert_archives(
+    root: str,
+    out_root: str,
+    exchanges: Optional[Sequence[str]] = None,
+    markets: Optional[Sequence[str]] = None,
+    symbols: Optional[Sequence[str]] = None,
+    streams: Optional[Sequence[str]] = TRADE_STREAMS,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    workers: Optional[int] = None,
+    overwrite: bool = False,
+    include_today: bool = False,
+) -> List[Tuple[str, str, int]]:
+    """平行轉換所有符合條件、還沒轉換過的日檔，回傳實際轉換的 (topic, 日期, 筆數)"""
+    today = format_date(int(time.time() * 1000))
+    jobs = []
+    for files in find_archives(root, exchanges, markets, symbols, streams, start_date, end_date).values():
+        for archive in files:
+            if archive.date >= today and not include_today:
+                continue
+            day_dir = get_day_dir(out_root, archive.exchange, archive.market, archive.symbol, archive.stream, archive.date)
+            if overwrite or not is_converted(day_dir):
+                jobs.append(archive)
+
+    if not jobs:
+        logger.info("Nothing to convert")
+        return []
+
+    logger.info(f"Converting {len(jobs)} files")
+    converted = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(convert_file, archive, out_root, overwrite): archive for archive in jobs}
+        for future in as_completed(futures):
+            archive = futures[future]
+            try:
+                topic, date, rows = future.result()
+            except Exception as e:
+                logger.error(f"Failed to convert {archive.path}: {e}")
+                continue
+            if rows is not None:
+                logger.info(f"Converted {topic} {date}: {rows} rows")
+                converted.append((topic, date, rows))
+    return converted
+
+
+@dataclass
+class TickDay:
+    date: str
+    # memory map 的唯讀陣列（或它們的切片），不會複製資料
+    columns: Dict[str, np.ndarray]
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+
+def read_ticks(
+    out_root: str,
+    exchange: str,
+    market: str,
+    symbol: str,
+    stream: str,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    columns: Optional[Sequence[str]] = None,
+) -> List[TickDay]:
+    """以 memory map 讀取一個 symbol 在 [start, end) 之間的成交，每天一個 TickDay
+
+    start / end 的格式見 tools.archive.parse_time。時間範圍用 timestamp 欄位二分搜尋後切片，
+    回傳的都是 memmap 的 view；需要一個連續陣列時再用 concat_ticks 複製。
+    """
+    columns = list(columns or TICK_COLUMNS)
+    start_ms = parse_time(start) if start else None
+    end_ms = parse_time(end) if end else None
+    start_date = format_date(start_ms) if start_ms is not None else None
+    end_date = format_date(end_ms - 1) if end_ms is not None else None
+
+    stream_dir = os.path.dirname(get_day_dir(out_root, exchange, market, symbol, stream, "00000000"))
+    if not os.path.isdir(stream_dir):
+        return []
+
+    days = []
+    for date in sorted(os.listdir(stream_dir)):
+        if len(date) != 8 or not date.isdigit():
+            continue
+        if (start_date and date < start_date) or (end_date and date > end_date):
+            continue
+        day_dir = os.path.join(stream_dir, date)
+        if not is_converted(day_dir):
+            continue
+
+        timestamps = np.load(os.path.join(day_dir, "timestamp.npy"), mmap_mode="r")
+        lo = int(np.searchsorted(timestamps, start_ms, side="left")) if start_ms is not None else 0
+        hi = int(np.searchsorted(timestamps, end_ms, side="left")) if end_ms is not None else len(timestamps)
+        if lo >= hi:
+            continue
+        days.append(TickDay(date, {
+            name: np.load(os.path.join(day_dir, f"{name}.npy"), mmap_mode="r")[lo:hi]
+            for name in columns
+        }))
+    return days
+
+
+def concat_ticks(days: Sequence[TickDay]) -> Dict[str, np.ndarray]:
+    """把多天的資料接成一個陣列（會複製資料）"""
+    if not days:
+        return {}
+    return {name: np.concatenate([day.columns[name] for day in days]) for name in days[0].columns}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", required=True, help="collector 的 log_directory")
+    parser.add_argument("--out", required=True, help="輸出目錄")
+    parser.add_argument("--exchanges", default=None, help="以逗號分隔，預設全部")
+    parser.add_argument("--markets", default=None)
+    parser.add_argument("--symbols", default=None)
+    parser.add_argument("--streams", default=",".join(TRADE_STREAMS))
+    parser.add_argument("--start-date", default=None, help="YYYYMMDD")
+    parser.add_argument("--end-date", default=None, help="YYYYMMDD，包含在內")
+    parser.add_argument("--workers", type=int, default=None, help="預設為 CPU 數")
+    parser.add_argument("--overwrite", action="store_true", help="重新轉換已經轉換過的日期")
+    parser.add_argument("--include-today", action="store_true", help="也轉換 UTC 今天還在寫入的檔案")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    started = time.perf_counter()
+    converted = convert_archives(
+        args.root,
+        args.out,
+        exchanges=split_arg(args.exchanges),
+        markets=split_arg(args.markets),
+        symbols=split_arg(args.symbols),
+        streams=split_arg(args.streams),
+        start_date=args.start_date,
+        end_date=args.end_date,
+        workers=args.workers,
+        overwrite=args.overwrite,
+        include_today=args.include_today,
+    )
+    print(
+        f"Converted {len(converted)} files, {sum(rows for _, _, rows in converted)} rows "
+        f"in {time.perf_counter() - started:.1f}s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
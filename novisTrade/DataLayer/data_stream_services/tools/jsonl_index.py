@@ -0,0 +1,296 @@
+"""
+JSONL 日檔的稀疏時間索引，取某一段時間時不必從頭掃描、解析整個檔案。
+
+索引檔放在日檔旁邊（YYYYMMDD.jsonl.idx），把日檔切成約 block_size bytes 的區塊，
+每個區塊記錄 (起始 offset, 區塊內最小 timestamp, 區塊內最大 timestamp)。
+交易所時間在檔案中可能有些微亂序，所以讀取時用區塊最大值的前綴最大值找起點、
+區塊最小值的後綴最小值找終點，兩者都是單調的，可以二分搜尋，不會漏掉亂序的紀錄。
+
+索引只涵蓋到最後一個完整區塊為止（indexed_size），還在寫入的當日檔案可以從 indexed_size 繼續建立；
+之後寫入的部分讀取時會直接掃描。已經結束的日期則可以用 process pool 一次平行建立。
+
+使用方式（在 data_stream_services 目錄下）:
+    python -m tools.jsonl_index --root /app/Data --workers 8
+    python -m tools.jsonl_index --root /app/Data --watch 60   # 持續更新當日檔案的索引
+"""
+import os
+import sys
+import mmap
+import time
+import bisect
+import struct
+import logging
+import argparse
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import accumulate
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+from shared.core.codec import get_codec
+from tools.archive import ArchiveFile, find_archives, get_record_timestamp, split_arg
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"JSIX"
+INDEX_VERSION = 1
+# magic, version, block_size, indexed_size, blocks
+_HEADER = struct.Struct("<4sIqqq")
+DEFAULT_BLOCK_SIZE = 2 ** 20
+
+
+class JsonlIndex:
+    """一個日檔的區塊索引，offsets / mins / maxs 一一對應"""
+    def __init__(self, block_size: int = DEFAULT_BLOCK_SIZE):
+        self.block_size = block_size
+        self.indexed_size = 0
+        self.offsets = array("q")
+        self.mins = array("q")
+        self.maxs = array("q")
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def add_block(self, offset: int, min_timestamp: int, max_timestamp: int) -> None:
+        self.offsets.append(offset)
+        self.mins.append(min_timestamp)
+        self.maxs.append(max_timestamp)
+
+    def save(self, path: str) -> None:
+        """寫到暫存檔再改名，讀取的一方不會看到寫到一半的索引"""
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.block_size, self.indexed_size, len(self)))
+            self.offsets.tofile(f)
+            self.mins.tofile(f)
+            self.maxs.tofile(f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["JsonlIndex"]:
+        """讀取索引，檔案不存在或格式不符時回傳 None"""
+        try:
+            with open(path, "rb") as f:
+                magic, version, block_size, indexed_size, blocks = _HEADER.unpack(f.read(_HEADER.size))
+                if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                    return None
+                index = cls(block_size)
+                index.indexed_size = indexed_size
+                index.offsets.fromfile(f, blocks)
+                index.mins.fromfile(f, blocks)
+                index.maxs.fromfile(f, blocks)
+        except (OSError, EOFError, struct.error):
+            return None
+        return index
+
+    def find_range(self, start_ms: Optional[int], end_ms: Optional[int]) -> Tuple[int, Optional[int]]:
+        """回傳需要掃描的 byte 範圍 [start, end)，end 為 None 代表掃到檔案結尾
+
+        起點：第一個「前綴最大值 >= start_ms」的區塊，在它之前的紀錄都比 start_ms 早。
+        終點：第一個「後綴最小值 >= end_ms」的區塊，從它開始的紀錄都不早於 end_ms。
+        """
+        if not len(self):
+            return 0, None
+
+        first = 0
+        if start_ms is not None:
+            prefix_max = list(accumulate(self.maxs, max))
+            first = bisect.bisect_left(prefix_max, start_ms)
+            if first == len(self):
+                return self.indexed_size, None
+
+        if end_ms is not None:
+            suffix_min = list(accumulate(reversed(self.mins), min))[::-1]
+            last = bisect.bisect_left(suffix_min, end_ms)
+            if last < len(self):
+                return self.offsets[first], max(self.offsets[last], self.offsets[first])
+        return self.offsets[first], None
+
+
+def get_index_path(path: str) -> str:
+    return path + INDEX_SUFFIX
+
+
+def update_index(
+    path: str,
+    loads: Optional[Callable[[bytes], dict]] = None,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+) -> JsonlIndex:
+    """建立或延伸 path 的索引，只讀取上次 indexed_size 之後的部分
+
+    日檔變短（被改寫或換掉）或區塊大小不同時會重新建立。
+    """
+    loads = loads or get_codec().loads
+    index_path = get_index_path(path)
+    size = os.path.getsize(path)
+    index = JsonlIndex.load(index_path)
+    if index is None or index.block_size != block_size or index.indexed_size > size:
+        index = JsonlIndex(block_size)
+    if size - index.indexed_size < block_size:
+        return index
+
+    with open(path, "rb") as f:
+        f.seek(index.indexed_size)
+        offset = block_start = index.indexed_size
+        block_min = block_max = None
+        for line in f:
+            if not line.endswith(b"\n"):
+                # collector 還在寫的最後一行
+                break
+            offset += len(line)
+            try:
+                timestamp = get_record_timestamp(loads(line))
+            except (ValueError, AttributeError):
+                timestamp = None
+            if timestamp is not None:
+                block_min = timestamp if block_min is None else min(block_min, timestamp)
+                block_max = timestamp if block_max is None else max(block_max, timestamp)
+            if offset - block_start >= block_size:
+                if block_min is not None:
+                    index.add_block(block_start, block_min, block_max)
+                block_start = offset
+                block_min = block_max = None
+                index.indexed_size = offset
+
+    index.save(index_path)
+    return index
+
+
+def iter_range(
+    path: str,
+    loads: Callable[[bytes], dict],
+    start_ms: Optional[int] = None,
+    end_ms: Optional[int] = None,
+) -> Iterator[Tuple[int, bytes]]:
+    """用索引找到要掃描的範圍，mmap 日檔後逐行產生 [start_ms, end_ms) 之間的 (timestamp, 原始行)
+
+    沒有索引時等同從頭掃描。索引之後才寫入的部分一律掃描。
+    """
+    index = JsonlIndex.load(get_index_path(path))
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        if index is None or index.indexed_size > size:
+            ranges = [(0, size)]
+        else:
+            begin, stop = index.find_range(start_ms, end_ms)
+            if stop is None:
+                ranges = [(begin, size)]
+            else:
+                # 索引之後才寫入的部分沒有區塊資訊，一定要掃描
+                ranges = [(begin, stop), (max(stop, index.indexed_size), size)]
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            for position, stop in ranges:
+                while position < stop:
+                    newline = view.find(b"\n", position, size)
+                    if newline < 0:
+                        break
+                    line = view[position:newline]
+                    position = newline + 1
+                    if not line:
+                        continue
+                    try:
+                        timestamp = get_record_timestamp(loads(line))
+                    except (ValueError, AttributeError):
+                        continue
+                    if timestamp is None:
+                        continue
+                    if start_ms is not None and timestamp < start_ms:
+                        continue
+                    if end_ms is not None and timestamp >= end_ms:
+                        continue
+                    yield timestamp, line
+
+
+def iter_indexed_records(
+    files: Sequence[ArchiveFile],
+    loads: Callable[[bytes], dict],
+    start_ms: Optional[int] = None,
+    end_ms: Optional[int] = None,
+) -> Iterator[Tuple[int, bytes]]:
+    """依序讀取同一個 topic 的日檔，產生時間範圍內的 (timestamp, 原始行)
+
+    原始行保留下來，重播時不需要重新序列化；有索引的檔案只讀取需要的區段。
+    """
+    for archive in files:
+        yield from iter_range(archive.path, loads, start_ms, end_ms)
+
+
+def _update_file(path: str, block_size: int) -> Tuple[str, int]:
+    return path, len(update_index(path, block_size=block_size))
+
+
+def build_indexes(
+    root: str,
+    exchanges: Optional[Sequence[str]] = None,
+    markets: Optional[Sequence[str]] = None,
+    symbols: Optional[Sequence[str]] = None,
+    streams: Optional[Sequence[str]] = None,
+    workers: Optional[int] = None,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+) -> List[Tuple[str, int]]:
+    """在 process pool 中建立或更新所有日檔的索引，已經是最新的檔案幾乎不需要時間"""
+    paths = []
+    for files in find_archives(root, exchanges, markets, symbols, streams).values():
+        for archive in files:
+            index = JsonlIndex.load(get_index_path(archive.path))
+            if (
+                index is None
+                or index.block_size != block_size
+                or os.path.getsize(archive.path) - index.indexed_size >= block_size
+            ):
+                paths.append(archive.path)
+
+    results = []
+    if not paths:
+        return results
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_update_file, path, block_size): path for path in paths}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f"Failed to index {futures[future]}: {e}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", required=True, help="collector 的 log_directory")
+    parser.add_argument("--exchanges", default=None, help="以逗號分隔，預設全部")
+    parser.add_argument("--markets", default=None)
+    parser.add_argument("--symbols", default=None)
+    parser.add_argument("--streams", default=None)
+    parser.add_argument("--workers", type=int, default=None, help="預設為 CPU 數")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE, help="區塊大小（bytes）")
+    parser.add_argument("--watch", type=float, default=0, help="每隔幾秒更新一次，0 為只執行一次")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    while True:
+        started = time.perf_counter()
+        results = build_indexes(
+            args.root,
+            exchanges=split_arg(args.exchanges),
+            markets=split_arg(args.markets),
+            symbols=split_arg(args.symbols),
+            streams=split_arg(args.streams),
+            workers=args.workers,
+            block_size=args.block_size,
+        )
+        print(
+            f"Indexed {len(results)} files ({sum(blocks for _, blocks in results)} blocks) "
+            f"in {time.perf_counter() - started:.1f}s",
+            file=sys.stderr,
+        )
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+把 data_collection_service 的 JSONL 封存檔依照時間順序重播回 Redis，topic 名稱和線上相同，
+策略和 collector 不需要連到交易所就能用實際資料做回測和壓力測試。
+
+- 每個 topic 逐行讀取，再用 heap 依 timestamp 合併，不會把檔案載入記憶體
+- 送出的是檔案中的原始 JSON，不重新序列化
+- 同一時間到期的訊息用 pipeline 一次送出
+- speed=1 為實際速度，speed=N 為 N 倍速，speed=0 為不等待、盡快送出
+
+使用方式（在 data_stream_services 目錄下）:
+    python -m tools.replay --root /app/Data --exchanges binance --symbols btcusdt,ethusdt \\
+        --start 2024-11-12T14:00 --end 2024-11-12T15:00 --speed 10
+"""
+import sys
+import time
+import heapq
+import asyncio
+import logging
+import argparse
+
+from dataclasses import dataclass
+from operator import itemgetter
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from redis.asyncio import Redis
+
+from shared.core.codec import get_codec
+from shared.core.sinks import get_sink
+from tools.archive import ArchiveFile, find_archives, format_date, parse_time, split_arg
+from tools.jsonl_index import iter_indexed_records
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ReplayStats:
+    messages: int = 0
+    batches: int = 0
+    elapsed: float = 0.0
+    # 訊息實際送出時間比預定時間晚最多多少（只有 speed > 0 時有意義）
+    max_lag_ms: float = 0.0
+    first_timestamp: Optional[int] = None
+    last_timestamp: Optional[int] = None
+
+    def to_dict(self) -> dict:
+        span = (
+            (self.last_timestamp - self.first_timestamp) / 1000
+            if self.first_timestamp is not None else 0.0
+        )
+        return {
+            "messages": self.messages,
+            "batches": self.batches,
+            "elapsed": self.elapsed,
+            "messages_per_sec": self.messages / self.elapsed if self.elapsed else 0.0,
+            "data_span_sec": span,
+            "max_lag_ms": self.max_lag_ms,
+        }
+
+
+def merge_archives(
+    archives: Dict[str, List[ArchiveFile]],
+    loads: Callable[[bytes], dict],
+    start_ms: Optional[int] = None,
+    end_ms: Optional[int] = None,
+) -> Iterator[Tuple[int, str, bytes]]:
+    """把每個 topic 的紀錄依 timestamp 合併成一個序列，產生 (timestamp, topic, 原始行)
+
+    日檔旁邊有 tools.jsonl_index 建立的索引時，只會讀取時間範圍內的區段。
+    """
+    def tagged(topic: str, files: List[ArchiveFile]) -> Iterator[Tuple[int, str, bytes]]:
+        for timestamp, line in iter_indexed_records(files, loads, start_ms, end_ms):
+            yield timestamp, topic, line
+
+    return heapq.merge(
+        *(tagged(topic, files) for topic, files in archives.items()),
+        key=itemgetter(0),
+    )
+
+
+class Replayer:
+    """
+    依照紀錄的 timestamp 控制送出速度，把到期的訊息累積成 batch，用 pipeline 送進 Redis。
+
+    實際速度下，下一筆還沒到期時會先送出手上的 batch 再等待，所以延遲不會超過一次 pipeline 的時間；
+    落後的時候會一直累積到 batch_size 才送出，自然提高吞吐量追上進度。
+    """
+    def __init__(
+        self,
+        redis: Redis,
+        speed: float = 1.0,
+        batch_size: int = 500,
+        sink=None,
+    ):
+        if speed < 0:
+            raise ValueError("speed must be >= 0")
+        self.redis = redis
+        self.speed = speed
+        self.batch_size = batch_size
+        self.sink = sink or get_sink("pubsub")
+        self.stats = ReplayStats()
+
+    async def _flush(self, batch: List[Tuple[str, bytes]]) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for topic, payload in batch:
+                self.sink.add(pipe, topic, payload)
+            await pipe.execute()
+        self.stats.messages += len(batch)
+        self.stats.batches += 1
+        batch.clear()
+
+    async def replay(self, records: Iterable[Tuple[int, str, bytes]]) -> ReplayStats:
+        stats = self.stats
+        batch: List[Tuple[str, bytes]] = []
+        started = time.monotonic()
+
+        for timestamp, topic, payload in records:
+            if stats.first_timestamp is None:
+                stats.first_timestamp = timestamp
+            stats.last_timestamp = timestamp
+
+            if self.speed:
+                due = started + (timestamp - stats.first_timestamp) / 1000 / self.speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    if batch:
+                        await self._flush(batch)
+                        delay = due - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                else:
+                    stats.max_lag_ms = max(stats.max_lag_ms, -delay * 1000)
+
+            batch.append((topic, payload))
+            if len(batch) >= self.batch_size:
+                await self._flush(batch)
+
+        if batch:
+            await self._flush(batch)
+        stats.elapsed = time.monotonic() - started
+        return stats
+
+
+async def replay_archives(
+    redis: Redis,
+    root: str,
+    exchanges: Optional[Sequence[str]] = None,
+    markets: Optional[Sequence[str]] = None,
+    symbols: Optional[Sequence[str]] = None,
+    streams: Optional[Sequence[str]] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    speed: float = 1.0,
+    batch_size: int = 500,
+    sink=None,
+) -> ReplayStats:
+    """找出符合條件的封存檔並重播，start / end 的格式見 tools.archive.parse_time"""
+    start_ms = parse_time(start) if start else None
+    end_ms = parse_time(end) if end else None
+    # 檔案依 timestamp 所在的 UTC 日期命名，用日期先過濾掉不需要開啟的檔案
+    start_date = format_date(start_ms) if start_ms is not None else None
+    end_date = format_date(end_ms - 1) if end_ms is not None else None
+
+    archives = find_archives(root, exchanges, markets, symbols, streams, start_date, end_date)
+    if not archives:
+        logger.warning(f"No archives found under {root}")
+        return ReplayStats()
+    logger.info(
+        f"Replaying {len(archives)} topics from "
+        f"{sum(len(files) for files in archives.values())} files at "
+        f"{'max' if not speed else f'{speed}x'} speed"
+    )
+
+    records = merge_archives(archives, get_codec().loads, start_ms, end_ms)
+    return await Replayer(redis, speed=speed, batch_size=batch_size, sink=sink).replay(records)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", required=True, help="collector 的 log_directory")
+    parser.add_argument("--exchanges", default=None, help="以逗號分隔，預設全部")
+    parser.add_argument("--markets", default=None)
+    parser.add_argument("--symbols", default=None)
+    parser.add_argument("--streams", default=None)
+    parser.add_argument("--start", default=None, help="UTC，例如 20241112 或 2024-11-12T14:00")
+    parser.add_argument("--end", default=None, help="不包含")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 為實際速度，0 為盡快送出")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--sink", default="pubsub", help="pubsub 或 stream")
+    parser.add_argument("--redis-url", default="redis://localhost:6379/0")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    redis = Redis.from_url(args.redis_url)
+    try:
+        stats = await replay_archives(
+            redis,
+            args.root,
+            exchanges=split_arg(args.exchanges),
+            markets=split_arg(args.markets),
+            symbols=split_arg(args.symbols),
+            streams=split_arg(args.streams),
+            start=args.start,
+            end=args.end,
+            speed=args.speed,
+            batch_size=args.batch_size,
+            sink=get_sink(args.sink),
+        )
+    finally:
+        await redis.aclose()
+
+    result = stats.to_dict()
+    print(
+        f"Replayed {result['messages']} messages in {result['elapsed']:.2f}s "
+        f"({result['messages_per_sec']:.0f} msg/s, {result['batches']} batches, "
+        f"data span {result['data_span_sec']:.1f}s, max lag {result['max_lag_ms']:.1f} ms)",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
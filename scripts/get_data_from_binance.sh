@@ -2,10 +2,11 @@
 
 # 顯示使用方法
 usage() {
-    echo "Usage: $0 [-s symbol] [-d days] [-p path]"
+    echo "Usage: $0 [-s symbol] [-d days] [-p path] [-k]"
     echo "  -s: Trading symbol (default: BTCUSD_PERP)"
     echo "  -d: Number of days to download (default: 7)"
     echo "  -p: Base path for data storage (default: ./data)"
+    echo "  -k: Keep verified zip and checksum files without extracting (for tools.binance_vision)"
     exit 1
 }
 
@@ -13,13 +14,15 @@ usage() {
 SYMBOL="BTCUSD_PERP"
 DAYS=7
 BASE_PATH="./data"
+KEEP_ZIP=0
 
 # 解析命令列參數
-while getopts "s:d:p:h" opt; do
+while getopts "s:d:p:kh" opt; do
     case $opt in
         s) SYMBOL="$OPTARG";;
         d) DAYS="$OPTARG";;
         p) BASE_PATH="$OPTARG";;
+        k) KEEP_ZIP=1;;
         h) usage;;
         ?) usage;;
     esac
@@ -63,13 +66,18 @@ while [ $current_seconds -le $end_seconds ]; do
             if sha256sum -c "$checksum_filename" > /dev/null 2>&1; then
                 echo "✓ Checksum verified for $filename"
                 
-                # 解壓縮到當前目錄
-                unzip -q -o "$filename"
-                
-                # 刪除 zip 和 checksum 文件
-                rm -f "$filename" "$checksum_filename"
-                
-                echo "✓ Extracted and cleaned up $filename"
+                if [ "$KEEP_ZIP" -eq 1 ]; then
+                    # 保留 zip 和 checksum，交給 tools.binance_vision 轉換
+                    echo "✓ Kept $filename"
+                else
+                    # 解壓縮到當前目錄
+                    unzip -q -o "$filename"
+                    
+                    # 刪除 zip 和 checksum 文件
+                    rm -f "$filename" "$checksum_filename"
+                    
+                    echo "✓ Extracted and cleaned up $filename"
+                fi
             else
                 echo "✗ Checksum verification failed for $filename"
                 rm -f "$filename" "$checksum_filename"